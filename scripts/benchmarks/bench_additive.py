@@ -0,0 +1,130 @@
+import argparse
+import multiprocessing as mp
+import resource
+import time
+
+import numpy as np
+import torch
+
+from scipy.spatial.distance import cdist
+from tqdm import tqdm
+
+from thermompnn.run import format_output_double
+
+
+# previous run.format_output_double and its helpers, verbatim
+def get_dmat(pdb):
+    """Get LxL dmat from PDB"""
+
+    # get distance matrix
+    coords = [k for k in pdb.keys() if k.startswith("coords_chain_")]
+    # compile all-by-all coords into big matrix
+    coo_all = []
+    for coord in coords:
+        ch = coord.split("_")[-1]
+        coo = np.stack(pdb[coord][f"CA_chain_{ch}"])  # [L, 3]
+        coo_all.append(coo)
+    coo_all = np.concatenate(coo_all)  # [L_total, 3]
+    dmat = cdist(coo_all, coo_all)
+    return dmat
+
+
+def expand_additive(ddg):
+    """Uses torch broadcasting to add all possible single mutants to each other in a vectorized operation."""
+    # ddg [L, 21]
+    dims = ddg.shape
+    ddgA = ddg.reshape(dims[0], dims[1], 1, 1)  # [L, 21, 1, 1]
+    ddgB = ddg.reshape(1, 1, dims[0], dims[1])  # [1, 1, L, 21]
+    ddg = ddgA + ddgB  # L, 21, L, 21
+
+    # mask out diagonal representing two mutations at the same position - this is invalid
+    for i in range(dims[0]):
+        ddg[i, :, i, :] = torch.nan
+
+    return ddg
+
+
+def dense_format_output_double(ddg, S, threshold, pdb, distance):
+    """Converts raw SSM predictions into nice format for analysis"""
+    stime = time.time()
+    ALPHABET = "ACDEFGHIKLMNPQRSTVWYX"
+    ddg = ddg.cpu().detach().numpy()  # [L, 21]
+    L, AA = ddg.shape
+
+    ddg = expand_additive(ddg)  # [L, 21, L, 21]
+    ddg = ddg[:, :20, :, :20]  # drop X predictions
+
+    # Pre-mask matrix with distance constraints for speedup
+    dmat = get_dmat(pdb)
+    assert ddg.shape[0] == dmat.shape[0]
+    valid_mask = (
+        (ddg <= threshold)
+        * (dmat < distance)[:, None, :, None]
+        * (dmat != 0.0)[:, None, :, None]
+    )
+    p1s, a1s, p2s, a2s = np.where(valid_mask)
+
+    cond = p1s < p2s  # filter to keep only upper triangle
+    p1s, a1s, p2s, a2s = p1s[cond], a1s[cond], p2s[cond], a2s[cond]
+    wt_seq = [ALPHABET[S[ppp]] for ppp in np.arange(L)]
+
+    mutlist, ddglist = [], []
+    for p1, a1, p2, a2 in tqdm(zip(p1s, a1s, p2s, a2s)):
+        wt1, wt2 = wt_seq[p1], wt_seq[p2]
+        mut1, mut2 = ALPHABET[a1], ALPHABET[a2]
+
+        if (wt1 != mut1) and (wt2 != mut2):  # drop self-mutations
+            mutation = f"{wt1}{p1 + 1}{mut1}:{wt2}{p2 + 1}{mut2}"
+            mutlist.append(mutation)
+            ddglist.append(ddg[p1, a1, p2, a2])
+
+    etime = time.time()
+    elapsed = etime - stime
+    print(
+        f"ThermoMPNN double mutant additive model predictions calculated in {round(elapsed, 2)} seconds."
+    )
+    return ddglist, mutlist
+
+
+def run_additive(dense, length, distance, threshold):
+    rng = np.random.default_rng(0)
+    # random walk CA trace with ~3.8 A steps so contacts look like a real chain
+    ca = np.cumsum(rng.normal(size=(length, 3)) * 2.2, axis=0)
+    pdb = {"coords_chain_A": {"CA_chain_A": ca}}
+    ddg = torch.from_numpy(rng.normal(size=(length, 21)).astype(np.float32))
+    S = torch.from_numpy(rng.integers(0, 20, size=length))
+
+    start = time.perf_counter()
+    if dense:
+        n = len(dense_format_output_double(ddg, S, threshold, pdb, distance)[0])
+    else:
+        n = len(format_output_double(ddg, S, threshold, pdb, distance)[0])
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+    return elapsed, peak, n
+
+
+def main(args):
+    """Times the KD-tree additive engine against the dense [L, 21, L, 21] expansion"""
+    # a fresh process per measurement so peak RSS is not shared between runs
+    ctx = mp.get_context("spawn")
+    print(f'{"L":>6}{"mutants":>12}{"dense (s)":>12}{"sparse (s)":>12}{"dense RSS (MB)":>18}{"sparse RSS (MB)":>18}')
+    for length in args.lengths:
+        results = []
+        for dense in (True, False):
+            if dense and length > args.max_dense:
+                results.append((float("nan"), float("nan"), 0))
+                continue
+            with ctx.Pool(1) as pool:
+                results.append(pool.apply(run_additive, (dense, length, args.distance, args.threshold)))
+        (t_dense, m_dense, _), (t_sparse, m_sparse, n) = results
+        print(f"{length:>6}{n:>12}{t_dense:>12.2f}{t_sparse:>12.2f}{m_dense:>18.0f}{m_sparse:>18.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lengths", type=int, nargs="+", default=[100, 500, 1000, 1500, 3000])
+    parser.add_argument("--distance", type=float, default=5.0)
+    parser.add_argument("--threshold", type=float, default=-0.5)
+    parser.add_argument("--max_dense", type=int, default=1500, help="skip the dense baseline above this length")
+    main(parser.parse_args())
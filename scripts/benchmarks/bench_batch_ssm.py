@@ -0,0 +1,35 @@
+import argparse
+import tempfile
+import time
+
+from thermompnn.batch_ssm import ThermoMPNNBatch, resolve_inputs
+from thermompnn.run import ThermoMPNN
+
+
+def main(args):
+    """Times per-protein ThermoMPNN runs (model loaded for each PDB) against one ThermoMPNNBatch run"""
+    paths = [path for path, _ in resolve_inputs(args.inputs)]
+
+    start = time.perf_counter()
+    for path in paths:
+        ThermoMPNN(path, mode=args.mode, threshold=args.threshold, device=args.device).process(save_csv=False)
+    t_loop = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as out:
+        start = time.perf_counter()
+        ThermoMPNNBatch(paths, out=out, mode=args.mode, threshold=args.threshold, device=args.device,
+                        max_residues=args.max_residues).process()
+        t_batch = time.perf_counter() - start
+
+    print(f"structures: {len(paths)}  mode: {args.mode}")
+    print(f"per-protein: {t_loop:.2f} s  batch: {t_batch:.2f} s  speedup: {t_loop / t_batch:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--inputs", nargs="+", default=["examples/pdbs"])
+    parser.add_argument("--mode", type=str, default="single")
+    parser.add_argument("--threshold", type=float, default=-0.5)
+    parser.add_argument("--max_residues", type=int, default=None)
+    parser.add_argument("--device", type=str, default="cpu")
+    main(parser.parse_args())
@@ -0,0 +1,69 @@
+import argparse
+import copy
+import time
+
+import numpy as np
+import torch
+
+from thermompnn.datasets.dataset_utils import Mutation
+from thermompnn.datasets.v2_datasets import tied_featurize_mut, tied_featurize_mut_dedup
+from thermompnn.ssm_utils import get_config, get_model, load_pdb
+
+AAS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def random_mutations(pdbs, batch_size, seed=0):
+    """batch_size single mutants spread over the given structures (sorted by structure, as MegaScale batches)"""
+    rng = np.random.default_rng(seed)
+    items = []
+    for i in range(batch_size):
+        pdb = pdbs[i * len(pdbs) // batch_size]
+        pos = int(rng.choice([p for p, aa in enumerate(pdb["seq"]) if aa != "-"]))
+        item = copy.copy(pdb)
+        item["mutation"] = Mutation([pos], [pdb["seq"][pos]], [AAS[rng.integers(20)]], 0.0, "")
+        items.append(item)
+    return items
+
+
+def run(model, batch, device, struct_idx=None):
+    X, S, mask, _, chain_M, chain_encoding_all, residue_idx = batch[:7]
+    args = [t.to(device) for t in (X, S, mask, chain_M, residue_idx, chain_encoding_all) + batch[7:12]]
+    if struct_idx is not None:
+        struct_idx = struct_idx.to(device)
+    start = time.perf_counter()
+    with torch.no_grad():
+        pred, _ = model(*args, struct_idx=struct_idx)
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return pred, time.perf_counter() - start
+
+
+def main(args):
+    """Times the model on a regular batch against a structure-deduplicated batch of the same mutations"""
+    cfg = get_config("single")
+    model = get_model("single", cfg).to(args.device).eval()
+    pdbs = [load_pdb(p, None) for p in args.pdbs]
+    items = random_mutations(pdbs, args.batch_size)
+
+    start = time.perf_counter()
+    batch = tied_featurize_mut(items)
+    t_collate = time.perf_counter() - start
+    start = time.perf_counter()
+    dedup = tied_featurize_mut_dedup(items)
+    t_collate_dedup = time.perf_counter() - start
+
+    pred, t_model = run(model, batch, args.device)
+    pred_dedup, t_model_dedup = run(model, dedup, args.device, struct_idx=dedup[12])
+
+    print(f"mutations: {len(items)}  structure rows: {batch[0].shape[0]} -> {dedup[0].shape[0]}")
+    print(f"collate: {t_collate:.2f} s -> {t_collate_dedup:.2f} s")
+    print(f"model: {t_model:.2f} s -> {t_model_dedup:.2f} s  speedup: {t_model / t_model_dedup:.1f}x")
+    print(f"max abs difference: {(pred - pred_dedup).abs().max():.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdbs", nargs="+", default=["examples/pdbs/1VII.pdb", "examples/pdbs/4ajy.pdb"])
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--device", type=str, default="cpu")
+    main(parser.parse_args())
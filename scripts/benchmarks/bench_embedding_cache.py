@@ -0,0 +1,66 @@
+import argparse
+import tempfile
+import time
+
+import torch
+
+from thermompnn.datasets.embedding_cache import EmbeddingCache, precompute_embeddings
+from thermompnn.datasets.v2_datasets import get_collate_fn
+from thermompnn.ssm_utils import get_config, get_model, load_pdb
+
+from bench_dedup_batches import random_mutations
+
+
+def step(model, batch, device):
+    X, S, mask, _, chain_M, chain_encoding_all, residue_idx = batch[:7]
+    args = [t.to(device) for t in (X, S, mask, chain_M, residue_idx, chain_encoding_all) + batch[7:12]]
+    kwargs = {}
+    if len(batch) > 12:
+        kwargs["struct_idx"] = batch[12].to(device)
+    if len(batch) > 13:
+        hid, embed, edges = batch[13]
+        kwargs["embeddings"] = ([h.to(device) for h in hid], embed.to(device), edges)
+    with torch.no_grad():
+        pred, _ = model(*args, **kwargs)
+    return pred
+
+
+def time_epoch(model, items, collate_fn, batch_size, device):
+    start = time.perf_counter()
+    preds = [step(model, collate_fn(items[i:i + batch_size]), device) for i in range(0, len(items), batch_size)]
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return torch.cat(preds), time.perf_counter() - start
+
+
+def main(args):
+    """Times an epoch of the single mutant model with and without the frozen-backbone embedding cache"""
+    cfg = get_config("single")
+    model = get_model("single", cfg).to(args.device).eval()
+    pdbs = [load_pdb(p, None) for p in args.pdbs]
+    items = random_mutations(pdbs, args.n_mutations)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = EmbeddingCache(cache_dir, cfg.model.num_final_layers, edges=cfg.model.edges)
+        start = time.perf_counter()
+        precompute_embeddings(model, items, cache, get_collate_fn(cfg, dedup=True), batch_size=args.batch_size)
+        t_precompute = time.perf_counter() - start
+
+        pred, t_epoch = time_epoch(model, items, get_collate_fn(cfg), args.batch_size, args.device)
+        pred_cached, t_cached = time_epoch(model, items, get_collate_fn(cfg, cache=cache), args.batch_size,
+                                           args.device)
+
+    print(f"mutations: {len(items)}  batch size: {args.batch_size}")
+    print(f"precompute (once): {t_precompute:.2f} s")
+    print(f"epoch: {t_epoch:.2f} s -> {t_cached:.2f} s  speedup: {t_epoch / t_cached:.1f}x")
+    print(f"max abs difference: {(pred - pred_cached).abs().max():.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # one structure per batch: padding a short chain next to a longer one changes its ProteinMPNN neighbors
+    parser.add_argument("--pdbs", nargs="+", default=["examples/pdbs/4ajy.pdb"])
+    parser.add_argument("--n_mutations", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--device", type=str, default="cpu")
+    main(parser.parse_args())
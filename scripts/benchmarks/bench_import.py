@@ -0,0 +1,48 @@
+import argparse
+import json
+import subprocess
+import sys
+
+HEAVY_MODULES = ["pytorch_lightning", "lightning_fabric", "torchmetrics", "wandb", "sklearn", "Bio", "torch"]
+
+COLD_START = """
+import json, sys, time
+start = time.perf_counter()
+import thermompnn
+timings = {{"import thermompnn": time.perf_counter() - start}}
+from thermompnn.run import ThermoMPNN
+timings["import thermompnn.run"] = time.perf_counter() - start
+if {pdb!r}:
+    runner = ThermoMPNN({pdb!r}, mode={mode!r}, device={device!r})
+    runner.load_model()
+    timings["load model"] = time.perf_counter() - start
+    runner.process(save_csv=False)
+    timings["first prediction"] = time.perf_counter() - start
+loaded = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{"timings": timings, "loaded": loaded}}))
+"""
+
+
+def cold_start(pdb, mode, device):
+    code = COLD_START.format(pdb=pdb, mode=mode, device=device, heavy=HEAVY_MODULES)
+    out = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main(args):
+    """Times a cold start in fresh interpreters: `import thermompnn`, importing the inference runtime and (with --pdb)
+    loading the model and the first SSM, and lists which heavy training dependencies got imported"""
+    runs = [cold_start(args.pdb, args.mode, args.device) for _ in range(args.repeats)]
+    for name in runs[0]["timings"]:
+        times = sorted(run["timings"][name] for run in runs)
+        print(f"{name}: {times[len(times) // 2]:.2f} s (cumulative, median of {len(times)})")
+    print(f"imported: {', '.join(runs[0]['loaded']) or 'none'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdb", type=str, default=None)
+    parser.add_argument("--mode", type=str, default="single")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", type=str, default="cpu")
+    main(parser.parse_args())
@@ -0,0 +1,54 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from thermompnn.ssm_utils import FUSED_SUFFIX, checkpoint_name, export_fused
+from thermompnn.utils.get_weights import thermompnn_weigths
+
+LOAD = """
+import time
+start = time.perf_counter()
+from thermompnn.model.v2_model import TransferModelv2, TransferModelv2Siamese
+from thermompnn.ssm_utils import get_config, load_checkpoint, load_fused
+config = get_config({mode!r})
+model_class = TransferModelv2Siamese if {mode!r} == "epistatic" else TransferModelv2
+imported = time.perf_counter()
+for path in {paths!r}:
+    load_fused(path) if path.endswith({suffix!r}) else load_checkpoint(model_class(config), path)
+print(time.perf_counter() - imported)
+"""
+
+
+def load_time(mode, paths):
+    code = LOAD.format(mode=mode, paths=paths, suffix=FUSED_SUFFIX)
+    out = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def main(args):
+    """Times loading the first --ensemble checkpoints of a mode in fresh interpreters, from the Lightning checkpoints
+    (plus the vanilla ProteinMPNN weights) against the fused weight files of `thermompnn export`"""
+    model_dir = thermompnn_weigths.setup()
+    names = [checkpoint_name(args.mode, member) for member in range(1, args.ensemble + 1)]
+    if args.export or not all(os.path.isfile(os.path.join(model_dir, n + FUSED_SUFFIX)) for n in names):
+        start = time.perf_counter()
+        export_fused(args.mode, args.ensemble)
+        print(f"export: {time.perf_counter() - start:.2f} s")
+
+    for label, suffix in (("checkpoint", ".ckpt"), ("fused", FUSED_SUFFIX)):
+        paths = [os.path.join(model_dir, n + suffix) for n in names]
+        times = sorted(load_time(args.mode, paths) for _ in range(args.repeats))
+        size = sum(os.path.getsize(p) for p in paths) / 1e6
+        print(f"{label}: {times[len(times) // 2]:.3f} s for {len(paths)} model(s) ({size:.1f} MB, median of "
+              f"{len(times)} fresh interpreters)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", type=str, default="single")
+    parser.add_argument("--ensemble", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--export", action="store_true", help="re-export the fused files before timing")
+    main(parser.parse_args())
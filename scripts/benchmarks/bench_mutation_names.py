@@ -0,0 +1,69 @@
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+
+from thermompnn.run import double_mutation_names, single_mutation_names
+from thermompnn.ssm_utils import load_pdb, residue_labels
+
+
+def loop_names(pos, wtAA, mutAA, labels):
+    """Previous formatting: one f-string per mutation"""
+    ALPHABET = "ACDEFGHIKLMNPQRSTVWYX"
+    names = []
+    for b in range(pos.shape[0]):
+        names.append(":".join(ALPHABET[wtAA[b, i]] + labels[pos[b, i]] + ALPHABET[mutAA[b, i]]
+                              for i in range(pos.shape[1])))
+    return names
+
+
+def dict_labels(pdb, poslist):
+    """Previous renumbering: a dict of every residue, built on each call"""
+    converter = {}
+    offset = 0
+    for key in [key for key in pdb.keys() if key.startswith("resn_list_")]:
+        for idx, resid in enumerate(pdb[key]):
+            converter[idx + offset] = key[-1] + resid
+        offset += idx + 1
+    return [converter[pos] for pos in poslist]
+
+
+def main(args):
+    """Times building the mutation names of a full single mutant scan (L x 20) and of random double mutants for every
+    PDB in --pdbs (--repeats times, as in a batch run), per-row formatting against single_mutation_names /
+    double_mutation_names on the cached residue labels"""
+    pdbs = [load_pdb(path, None) for path in sorted(glob.glob(os.path.join(args.pdbs, "*.pdb")))]
+    rng = np.random.default_rng(0)
+    inputs = []
+    for pdb in pdbs:
+        length = len(pdb["seq"])
+        wt = rng.integers(0, 20, length)
+        single = (np.repeat(np.arange(length), 20)[:, None], np.repeat(wt, 20)[:, None],
+                  np.tile(np.arange(20), length)[:, None])
+        pos = rng.integers(0, length, (args.doubles, 2))
+        double = (pos, wt[pos], rng.integers(0, 20, (args.doubles, 2)))
+        inputs.append((pdb, single, double))
+
+    for vectorized in (False, True):
+        start = time.perf_counter()
+        n = 0
+        for _ in range(args.repeats):
+            for pdb, single, double in inputs:
+                for rows in (single, double):
+                    if vectorized:
+                        names = single_mutation_names if rows[0].shape[1] == 1 else double_mutation_names
+                        n += len(names(*rows, residue_labels(pdb)))
+                    else:
+                        n += len(loop_names(*rows, dict_labels(pdb, range(len(pdb["seq"])))))
+        label = "vectorized" if vectorized else "per-row"
+        print(f"{label}: {time.perf_counter() - start:.2f} s for {n} names")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdbs", type=str, default="examples/pdbs")
+    parser.add_argument("--doubles", type=int, default=100000, help="random double mutants per PDB")
+    parser.add_argument("--repeats", type=int, default=5)
+    main(parser.parse_args())
@@ -0,0 +1,47 @@
+import argparse
+import glob
+import os
+import time
+
+from thermompnn.pdb_utils import CHAIN_ALPHABET
+from thermompnn.protein_mpnn_utils import alt_parse_PDB, parse_PDB
+from thermompnn.ssm_utils import custom_parse_PDB_biounits, load_pdb
+
+
+def per_chain_rescan(pdb_file):
+    """Old access pattern: one full read of the file for every candidate chain id"""
+    for letter in CHAIN_ALPHABET:
+        custom_parse_PDB_biounits(pdb_file, atoms=["N", "CA", "C", "O"], chain=letter)
+
+
+def timed(fn, *args, repeats=1, **kwargs):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(*args, **kwargs)
+    return (time.perf_counter() - start) / repeats
+
+
+def main(args):
+    """Times the single-pass PDB parsers against re-reading the file once per chain id"""
+    if os.path.isdir(args.pdbs):
+        pdb_list = sorted(glob.glob(os.path.join(args.pdbs, '*.pdb')))
+    else:
+        pdb_list = [args.pdbs]
+
+    print(f'{"pdb":<12}{"chains":>8}{"rescan (s)":>14}{"load_pdb (s)":>14}{"parse_PDB (s)":>15}{"alt_parse (s)":>15}')
+    for pdb_file in pdb_list:
+        pdb = load_pdb(pdb_file, None)
+        rescan = timed(per_chain_rescan, pdb_file) if not args.skip_rescan else float('nan')
+        single = timed(load_pdb, pdb_file, None, repeats=args.repeats)
+        mpnn = timed(parse_PDB, pdb_file, side_chains=True, repeats=args.repeats)
+        alt = timed(alt_parse_PDB, pdb_file, repeats=args.repeats)
+        name = os.path.basename(pdb_file)
+        print(f'{name:<12}{pdb["num_of_chains"]:>8}{rescan:>14.3f}{single:>14.3f}{mpnn:>15.3f}{alt:>15.3f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pdbs', type=str, default='examples/pdbs', help='PDB file or directory of PDB files')
+    parser.add_argument('--repeats', type=int, default=5, help='repeats for the single-pass parsers')
+    parser.add_argument('--skip_rescan', action='store_true', help='skip the slow per-chain rescan baseline')
+    main(parser.parse_args())
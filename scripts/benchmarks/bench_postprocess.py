@@ -0,0 +1,208 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from scipy.spatial.distance import cdist
+from tqdm import tqdm
+
+from thermompnn.run import (additive_ssm_rows, double_mutation_names,
+                            format_ssm_rows)
+from thermompnn.ssm_utils import load_pdb
+
+
+# previous ssm_utils post-processing, verbatim
+def get_dmat(pdb):
+    """Get LxL dmat from PDB"""
+
+    # get distance matrix
+    coords = [k for k in pdb.keys() if k.startswith("coords_chain_")]
+    # compile all-by-all coords into big matrix
+    coo_all = []
+    for coord in coords:
+        ch = coord.split("_")[-1]
+        coo = np.stack(pdb[coord][f"CA_chain_{ch}"])  # [L, 3]
+        coo_all.append(coo)
+    coo_all = np.concatenate(coo_all)  # [L_total, 3]
+    dmat = cdist(coo_all, coo_all)
+    return dmat
+
+
+def idx_to_pdb_num(pdb, poslist):
+    # set up PDB resns and boundaries
+    chains = [key[-1] for key in pdb.keys() if key.startswith("resn_list_")]
+    resn_lists = [pdb[key] for key in pdb.keys() if key.startswith("resn_list")]
+    converter = {}
+    offset = 0
+    for n, rlist in enumerate(resn_lists):
+        chain = chains[n]
+        for idx, resid in enumerate(rlist):
+            converter[idx + offset] = chain + resid
+        offset += idx + 1
+
+    return [converter[pos] for pos in poslist]
+
+
+def distance_filter(df, pdb, distance=5.0):
+    """filter df based on pdb distances"""
+    dmat = get_dmat(pdb)
+
+    # grab positions
+    df[["mut1", "mut2"]] = df["Mutation"].str.split(":", n=2, expand=True)
+    df["pos1"] = df["mut1"].str[1:-1].astype(int) - 1
+    df["pos2"] = df["mut2"].str[1:-1].astype(int) - 1
+
+    # filter df based on positions
+    pos1, pos2 = df["pos1"].values, df["pos2"].values
+    dist_list = []
+    for p1, p2 in tqdm(zip(pos1, pos2)):
+        dist_list.append(dmat[p1, p2])
+
+    df["CA-CA Distance"] = dist_list
+    mask = (df["CA-CA Distance"] <= distance) & (df["CA-CA Distance"] != 0.0)
+    df = df.loc[mask]
+    df.loc[:, "CA-CA Distance"] = df["CA-CA Distance"].round(2)
+
+    df = df[["ddG (kcal/mol)", "Mutation", "CA-CA Distance"]].reset_index(drop=True)
+    print("Distance matrix generated.")
+    return df
+
+
+def renumber_pdb(df, pdb, mode):
+    """Renumber output mutations to match PDB numbering for interpretation"""
+
+    if (mode.lower() == "additive") or (mode.lower() == "epistatic"):
+        # grab positions
+        df[["mut1", "mut2"]] = df["Mutation"].str.split(":", n=2, expand=True)
+        df["pos1"] = df["mut1"].str[1:-1].astype(int) - 1
+        df["pos2"] = df["mut2"].str[1:-1].astype(int) - 1
+
+        df["pos1"] = idx_to_pdb_num(pdb, df["pos1"].values)
+        df["pos2"] = idx_to_pdb_num(pdb, df["pos2"].values)
+
+        df["wt1"], df["wt2"] = df["mut1"].str[0], df["mut2"].str[0]
+        df["mt1"], df["mt2"] = df["mut1"].str[-1], df["mut2"].str[-1]
+
+        df["Mutation"] = (
+            df["wt1"]
+            + df["pos1"]
+            + df["mt1"]
+            + ":"
+            + df["wt2"]
+            + df["pos2"]
+            + df["mt2"]
+        )
+        df = df[["ddG (kcal/mol)", "Mutation", "CA-CA Distance"]].reset_index(drop=True)
+
+    else:
+        # grab position
+        df["pos"] = df["Mutation"].str[1:-1].astype(int) - 1
+
+        df["pos"] = idx_to_pdb_num(pdb, df["pos"].values)
+        df["wt"] = df["Mutation"].str[0]
+        df["mt"] = df["Mutation"].str[-1]
+
+        df["Mutation"] = df["wt"] + df["pos"] + df["mt"]
+        df = df[["ddG (kcal/mol)", "Mutation"]].reset_index(drop=True)
+
+    print("ThermoMPNN predictions renumbered.")
+    return df
+
+
+def disulfide_penalty(df, pdb, mode):
+    """Automatically detects disulfide breakage based on Cys-Cys distance."""
+
+    # collect all SG coordinates from all chains
+    coords_all = [k for k in pdb.keys() if k.startswith("coords")]
+    chains = [c[-1] for c in coords_all]
+    sg_coords = [pdb[c][f"SG_chain_{chain}"] for c, chain in zip(coords_all, chains)]
+    sg_coords = np.concatenate(sg_coords, axis=0)
+
+    # calculate pairwise distance and threshold to find disulfides
+    dist = cdist(sg_coords, sg_coords)
+    dist = np.nan_to_num(dist, 10000)
+    hits = np.where((dist < 3) & (dist > 0))  # tuple of two [N] arrays of indices
+
+    # match hit indices to actual resns for penalty
+    bad_resns = []
+    for h in hits[0]:
+        bad_resns.append(h)
+    penalty = 2  # in kcal/mol - higher is less stable
+    print("Identified the following disulfide engaged residues:", bad_resns)
+
+    if mode.lower() == "single":
+        df["wtAA"] = df["Mutation"].str[0]
+        df["mutAA"] = df["Mutation"].str[-1]
+        df["pos"] = df["Mutation"].str[1:-1].astype(int) - 1
+
+        mask = df["pos"].isin(bad_resns) & (df["wtAA"] != df["mutAA"])
+        df.loc[mask, "ddG (kcal/mol)"] = df.loc[mask, "ddG (kcal/mol)"] + penalty
+        return df[["Mutation", "ddG (kcal/mol)"]].reset_index(drop=True)
+
+    else:
+        df[["mut1", "mut2"]] = df["Mutation"].str.split(":", n=2, expand=True)
+        df["wtAA1"] = df["mut1"].str[0]
+        df["mutAA1"] = df["mut1"].str[-1]
+        df["pos1"] = df["mut1"].str[1:-1].astype(int) - 1
+
+        df["wtAA2"] = df["mut2"].str[0]
+        df["mutAA2"] = df["mut2"].str[-1]
+        df["pos2"] = df["mut2"].str[1:-1].astype(int) - 1
+
+        mask = df["pos1"].isin(bad_resns) & (df["wtAA1"] != df["mutAA1"])
+        mask2 = df["pos2"].isin(bad_resns) & (df["wtAA2"] != df["mutAA2"])
+        mask = mask | mask2
+
+        df.loc[mask, "ddG (kcal/mol)"] = df.loc[mask, "ddG (kcal/mol)"] + penalty
+        return df[["Mutation", "ddG (kcal/mol)", "CA-CA Distance"]].reset_index(
+            drop=True
+        )
+
+
+def format_strings(ddg, mutations, pdb, threshold, distance, ss_penalty):
+    """Previous post-processing: every step re-parses the mutation names of the DataFrame"""
+    df = pd.DataFrame({"ddG (kcal/mol)": ddg, "Mutation": mutations})
+    df = distance_filter(df, pdb, distance)
+    if ss_penalty:
+        df = disulfide_penalty(df, pdb, "additive")
+    df = df.dropna(subset=["ddG (kcal/mol)"])
+    if threshold <= -0.0:
+        df = df.sort_values(by=["ddG (kcal/mol)"])
+    df[["mut1", "mut2"]] = df["Mutation"].str.split(":", n=2, expand=True)
+    df["pos1"] = df["mut1"].str[1:-1].astype(int) + 1
+    df["pos2"] = df["mut2"].str[1:-1].astype(int) + 1
+    df = df.sort_values(by=["pos1", "pos2"])
+    df = df[["ddG (kcal/mol)", "Mutation", "CA-CA Distance"]].reset_index(drop=True)
+    return renumber_pdb(df, pdb, "additive")
+
+
+def main(args):
+    """Times post-processing of additive double mutants (random ddGs on a real structure) into the output DataFrame:
+    mutation names re-parsed by every step against format_ssm_rows on position and amino acid arrays"""
+    pdb = load_pdb(args.pdb, None)
+    rng = np.random.default_rng(0)
+    ddg = torch.from_numpy(rng.normal(size=(len(pdb["seq"]), 21)).astype(np.float32))
+    S = torch.from_numpy(rng.integers(0, 20, size=len(pdb["seq"])))
+    rows = additive_ssm_rows(ddg, S, args.threshold, pdb, args.distance)  # not timed
+
+    start = time.perf_counter()
+    old = format_strings(list(rows[3]), double_mutation_names(*rows[:3]), pdb, args.threshold, args.distance,
+                         args.ss_penalty)
+    t_strings = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new = format_ssm_rows(*rows, pdb, "additive", args.threshold, args.distance, args.ss_penalty)
+    t_arrays = time.perf_counter() - start
+
+    assert old["Mutation"].tolist() == new["Mutation"].tolist()
+    print(f"{len(new)} mutations: strings {t_strings:.2f} s  arrays {t_arrays:.2f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdb", type=str, default="examples/pdbs/1igy.pdb")
+    parser.add_argument("--threshold", type=float, default=100.0)
+    parser.add_argument("--distance", type=float, default=8.0)
+    parser.add_argument("--ss_penalty", action="store_true")
+    main(parser.parse_args())
@@ -0,0 +1,96 @@
+import argparse
+import multiprocessing as mp
+import resource
+import time
+
+import torch
+
+from thermompnn.protein_mpnn_utils import ProteinFeatures, gather_edges
+
+
+class DenseProteinFeatures(ProteinFeatures):
+    """Previous featurization: full [B, L, L] distance matrix per atom pair, then gather the K neighbors"""
+
+    def _get_rbf(self, A, B, E_idx):
+        D_A_B = torch.sqrt(torch.sum((A[:, :, None, :] - B[:, None, :, :]) ** 2, -1) + 1e-6)  # [B, L, L]
+        D_A_B_neighbors = gather_edges(D_A_B[:, :, :, None], E_idx)[:, :, :, 0]  # [B,L,K]
+        return self._rbf(D_A_B_neighbors)
+
+    def forward(self, X, mask, residue_idx, chain_labels):
+        b = X[:, :, 1, :] - X[:, :, 0, :]
+        c = X[:, :, 2, :] - X[:, :, 1, :]
+        a = torch.cross(b, c, dim=-1)
+        Cb = -0.58273431 * a + 0.56802827 * b - 0.54067466 * c + X[:, :, 1, :]
+        atoms = [X[:, :, 0, :], X[:, :, 1, :], X[:, :, 2, :], X[:, :, 3, :], Cb]
+
+        D_neighbors, E_idx = self._dist(atoms[1], mask)
+        RBF_all = [self._rbf(D_neighbors)]
+        for i, j in zip(*self.rbf_pairs):
+            RBF_all.append(self._get_rbf(atoms[i], atoms[j], E_idx))
+        RBF_all = torch.cat(tuple(RBF_all), dim=-1)
+
+        offset = residue_idx[:, :, None] - residue_idx[:, None, :]
+        offset = gather_edges(offset[:, :, :, None], E_idx)[:, :, :, 0]  # [B, L, K]
+        d_chains = ((chain_labels[:, :, None] - chain_labels[:, None, :]) == 0).long()
+        E_chains = gather_edges(d_chains[:, :, :, None], E_idx)[:, :, :, 0]
+        E_positional = self.embeddings(offset.long(), E_chains)
+        E = torch.cat((E_positional, RBF_all), -1)
+        E = self.edge_embedding(E)
+        E = self.norm_edges(E)
+        return E, E_idx
+
+
+def run_features(dense, length, batch_size, device, repeats):
+    torch.manual_seed(0)
+    cls = DenseProteinFeatures if dense else ProteinFeatures
+    features = cls(128, 128, top_k=48, augment_eps=0.).to(device).eval()
+    # random walk backbone so neighbor lists look like a real chain
+    X = torch.cumsum(torch.randn(batch_size, length, 4, 3, device=device) * 2.2, dim=1)
+    mask = torch.ones(batch_size, length, device=device)
+    residue_idx = torch.arange(length, device=device)[None].repeat(batch_size, 1)
+    chain_labels = torch.ones(batch_size, length, dtype=torch.long, device=device)
+
+    if device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    with torch.no_grad():
+        features(X, mask, residue_idx, chain_labels)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            features(X, mask, residue_idx, chain_labels)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = (time.perf_counter() - start) / repeats
+
+    if device == 'cuda':
+        peak = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+    return elapsed, peak
+
+
+def main(args):
+    """Times ProteinFeatures (gather-first neighbor RBFs) against the dense [L, L] featurization"""
+    # a fresh process per measurement so peak RSS is not shared between runs
+    ctx = mp.get_context('spawn')
+    mem = 'peak CUDA (MB)' if args.device == 'cuda' else 'peak RSS (MB)'
+    print(f'{"L":>6}{"dense (s)":>12}{"gather (s)":>12}{"dense " + mem:>24}{"gather " + mem:>24}')
+    for length in args.lengths:
+        results = []
+        for dense in (True, False):
+            if dense and length > args.max_dense:
+                results.append((float('nan'), float('nan')))
+                continue
+            with ctx.Pool(1) as pool:
+                results.append(pool.apply(run_features, (dense, length, args.batch_size, args.device, args.repeats)))
+        (t_dense, m_dense), (t_gather, m_gather) = results
+        print(f'{length:>6}{t_dense:>12.3f}{t_gather:>12.3f}{m_dense:>24.0f}{m_gather:>24.0f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lengths', type=int, nargs='+', default=[100, 500, 1000, 2000, 5000])
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--max_dense', type=int, default=5000, help='skip the dense baseline above this length')
+    parser.add_argument('--device', type=str, default='cpu')
+    main(parser.parse_args())
@@ -0,0 +1,49 @@
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from thermompnn.run import ThermoMPNN
+from thermompnn.server import SSMServer, request_ssm
+
+
+def main(args):
+    """Times small SSM requests as separate ThermoMPNN runs (model loaded per request, as the CLI does) against a
+    resident SSMServer on localhost with concurrent clients"""
+    pdbs = [args.pdbs[i % len(args.pdbs)] for i in range(args.n_requests)]
+
+    start = time.perf_counter()
+    for pdb in pdbs:
+        ThermoMPNN(pdb, mode=args.mode, threshold=args.threshold, device=args.device).process(save_csv=False)
+    t_separate = time.perf_counter() - start
+
+    server = SSMServer(device=args.device, max_residues=args.max_residues, max_wait=args.max_wait)
+    http_server = server.serve(port=0)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    address = f"127.0.0.1:{http_server.server_address[1]}"
+    server.load_model("epistatic" if args.mode == "epistatic" else "single")  # resident before timing
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.clients) as pool:
+        list(pool.map(lambda pdb: request_ssm(address, pdb, mode=args.mode, threshold=args.threshold), pdbs))
+    t_server = time.perf_counter() - start
+    stats = server.stats()
+    server.close()
+
+    print(f"requests: {len(pdbs)}  clients: {args.clients}  mode: {args.mode}")
+    print(f"separate runs: {t_separate:.2f} s  server: {t_server:.2f} s  speedup: {t_separate / t_server:.1f}x")
+    print(json.dumps(stats, indent=1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdbs", nargs="+", default=["examples/pdbs/1VII.pdb"])
+    parser.add_argument("--n_requests", type=int, default=32)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--mode", type=str, default="single")
+    parser.add_argument("--threshold", type=float, default=-0.5)
+    parser.add_argument("--max_residues", type=int, default=None)
+    parser.add_argument("--max_wait", type=float, default=0.01)
+    parser.add_argument("--device", type=str, default="cpu")
+    main(parser.parse_args())
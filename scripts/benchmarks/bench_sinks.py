@@ -0,0 +1,57 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from thermompnn.run import ThermoMPNN
+from thermompnn.sinks import load_ssm_arrays, read_ssm_table
+
+
+def read_output(path, output_format):
+    """Number of mutations of an output file read back into memory"""
+    if output_format == "csv":
+        return len(pd.read_csv(path))
+    if output_format == "npy":
+        arrays, _ = load_ssm_arrays(path)
+        return np.asarray(arrays["ddg"]).size
+    return len(read_ssm_table(path))
+
+
+def output_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def main(args):
+    """Times ThermoMPNN.stream with csv, parquet, arrow and npy output on one PDB (write), the output size and reading
+    the output back into memory (pd.read_csv, read_ssm_table or load_ssm_arrays)"""
+    for output_format in args.formats:
+        runner = ThermoMPNN(args.pdb, out=os.path.join(args.out, output_format), mode=args.mode,
+                            batch_size=args.batch_size, threshold=args.threshold, distance=args.distance,
+                            device=args.device, output_format=output_format)
+        runner.load_model()  # not timed
+        start = time.perf_counter()
+        path = runner.stream()
+        t_write = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rows = read_output(path, output_format)
+        t_read = time.perf_counter() - start
+        print(f"{output_format}: write {t_write:.2f} s  read {t_read:.2f} s  {output_size(path) / 1e6:.1f} MB  "
+              f"({rows} rows)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdb", type=str, default="examples/pdbs/4ajy.pdb")
+    parser.add_argument("--mode", type=str, default="epistatic")
+    parser.add_argument("--formats", nargs="+", default=["csv", "parquet", "arrow", "npy"])
+    parser.add_argument("--out", type=str, default="/tmp")
+    parser.add_argument("--batch_size", type=int, default=2048)
+    parser.add_argument("--threshold", type=float, default=100.0)
+    parser.add_argument("--distance", type=float, default=8.0)
+    parser.add_argument("--device", type=str, default="cpu")
+    main(parser.parse_args())
@@ -0,0 +1,68 @@
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+
+from thermompnn.ssm_utils import get_ca_coords, spatial_index
+
+
+def make_structure(length, seed=0):
+    """Random walk CA trace (~3.8 A steps) with a Cys SG next to 5% of the residues, in the parsed PDB layout"""
+    rng = np.random.default_rng(seed)
+    ca = np.cumsum(rng.normal(size=(length, 3)) * 2.2, axis=0)
+    sg = np.full_like(ca, np.nan)
+    cys = rng.choice(length, length // 20, replace=False)
+    sg[cys] = ca[cys] + rng.normal(size=(len(cys), 3))
+    return {"coords_chain_A": {"CA_chain_A": ca, "SG_chain_A": sg}}
+
+
+def previous_queries(pdb, distance, repeats):
+    """Previous geometry: a new KD-tree and CA array per contact query, a full SG-SG distance matrix for disulfides"""
+    for _ in range(repeats):
+        ca = get_ca_coords(pdb)
+        present = np.flatnonzero(np.isfinite(ca).all(-1))
+        cKDTree(ca[present]).query_pairs(distance, output_type="ndarray")
+    sg = pdb["coords_chain_A"]["SG_chain_A"]
+    dist = np.nan_to_num(cdist(sg, sg))
+    return np.where((dist < 3) & (dist > 0))[0]
+
+
+def indexed_queries(pdb, distance, repeats):
+    for _ in range(repeats):
+        spatial_index(pdb).contact_pairs(distance)
+    return spatial_index(pdb).disulfide_residues()
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main(args):
+    """Times the geometry queries of one SSM run (--repeats CA contact queries plus disulfide detection) on synthetic
+    structures, rebuilding trees and distance matrices per query against the cached spatial_index"""
+    print(f'{"L":>7}{"previous (s)":>15}{"indexed (s)":>14}{"previous (MB)":>16}{"indexed (MB)":>15}')
+    for length in args.lengths:
+        t_old = m_old = float("nan")
+        if length <= args.max_previous:
+            t_old, m_old = measure(previous_queries, make_structure(length), args.distance, args.repeats)
+        t_new, m_new = measure(indexed_queries, make_structure(length), args.distance, args.repeats)
+        print(f"{length:>7}{t_old:>15.3f}{t_new:>14.3f}{m_old:>16.0f}{m_new:>15.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lengths", type=int, nargs="+", default=[1000, 5000, 10000, 50000])
+    parser.add_argument("--distance", type=float, default=8.0)
+    parser.add_argument("--repeats", type=int, default=3, help="contact queries per run")
+    parser.add_argument("--max_previous", type=int, default=10000,
+                        help="skip the previous queries above this length (the SG-SG matrix takes 8 L^2 bytes)")
+    main(parser.parse_args())
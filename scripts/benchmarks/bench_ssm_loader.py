@@ -0,0 +1,63 @@
+import argparse
+import time
+
+import torch
+from bench_epistatic import embed_structure
+from torch.utils.data import DataLoader
+
+from thermompnn.run import (SSMDataset, TensorBatches,
+                            get_ssm_mutations_double, run_double)
+from thermompnn.ssm_utils import get_config, get_model, load_pdb
+
+
+def iterate(loader, device):
+    rows = 0
+    for pos, wtAA, mutAA in loader:
+        pos, wtAA, mutAA = pos.to(device), wtAA.to(device), mutAA.to(device)
+        rows += pos.shape[0]
+    return rows
+
+
+def main(args):
+    """Times DataLoader(SSMDataset, num_workers) against TensorBatches over the double mutants of a PDB, iterating
+    only and (with --score) feeding the row-wise epistatic scorer"""
+    pdb = load_pdb(args.pdb, args.chains)
+    pos, wtAA, mutAA = get_ssm_mutations_double(pdb, args.distance)
+    loaders = {
+        f"DataLoader(num_workers={args.num_workers})": lambda: DataLoader(
+            SSMDataset(pos, wtAA, mutAA), shuffle=False, batch_size=args.batch_size, num_workers=args.num_workers
+        ),
+        "TensorBatches": lambda: TensorBatches(pos, wtAA, mutAA, batch_size=args.batch_size, device=args.device),
+        "TensorBatches(prefetch)": lambda: TensorBatches(pos, wtAA, mutAA, batch_size=args.batch_size,
+                                                         device=args.device, prefetch=True),
+    }
+    print(f"double mutants: {pos.shape[0]}  batch size: {args.batch_size}")
+
+    for name, make_loader in loaders.items():
+        start = time.perf_counter()
+        rows = iterate(make_loader(), args.device)
+        print(f"{name}: iterate {time.perf_counter() - start:.2f} s ({rows} rows)")
+
+    if not args.score:
+        return
+    cfg = get_config("epistatic")
+    model = get_model("epistatic", cfg).to(args.device).eval()
+    X, mask, all_mpnn_hid, mpnn_embed, mpnn_edges = embed_structure(pdb, model, args.device)
+    for name, make_loader in loaders.items():
+        start = time.perf_counter()
+        with torch.no_grad():
+            run_double(all_mpnn_hid, mpnn_embed, cfg, make_loader(), args.batch_size, model, X, mask, mpnn_edges,
+                       device=args.device)
+        print(f"{name}: score {time.perf_counter() - start:.2f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdb", type=str, default="examples/pdbs/1VII.pdb")
+    parser.add_argument("--chains", nargs="+", default=None)
+    parser.add_argument("--distance", type=float, default=5.0)
+    parser.add_argument("--batch_size", type=int, default=2048)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--score", action="store_true")
+    parser.add_argument("--device", type=str, default="cpu")
+    main(parser.parse_args())
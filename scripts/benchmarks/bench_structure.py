@@ -0,0 +1,68 @@
+import argparse
+import glob
+import os
+import time
+import tracemalloc
+from copy import deepcopy
+
+import numpy as np
+
+from thermompnn.datasets.dataset_utils import Mutation
+from thermompnn.datasets.v2_datasets import tied_featurize_mut
+from thermompnn.protein_mpnn_utils import parse_PDB
+
+
+def legacy_dict(pdb):
+    """Previous layout: a plain dict with one float64 array per atom and chain"""
+    return {key: {atom: np.array(xyz, dtype=np.float64) for atom, xyz in value.items()}
+            if key.startswith("coords_chain_") else value for key, value in pdb.items()}
+
+
+def samples(pdb, n, rng):
+    """Dataset __getitem__ pattern: a deep copy of the parsed structure per mutation"""
+    items = []
+    for pos in rng.integers(0, len(pdb["seq"]), n):
+        item = deepcopy(pdb)
+        item["mutation"] = Mutation([int(pos)], ["A"], ["C"], 0.0, "")
+        items.append(item)
+    return items
+
+
+def run(pdbs, args):
+    rng = np.random.default_rng(0)
+    tracemalloc.start()
+    start = time.perf_counter()
+    items = [item for pdb in pdbs for item in samples(pdb, args.mutations, rng)]
+    t_copy = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0] / 2 ** 20
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for i in range(0, len(items), args.batch_size):
+        tied_featurize_mut(items[i:i + args.batch_size], side_chains=args.side_chains)
+    return t_copy, memory, time.perf_counter() - start
+
+
+def main(args):
+    """Times parsing every PDB in --pdbs with parse_PDB, then --mutations deep copies per structure (as the training
+    datasets do) and featurizing them in batches with tied_featurize_mut, for plain dicts of per-atom float64 arrays
+    against the Structure returned by parse_PDB. Memory is what the copies hold."""
+    files = sorted(glob.glob(os.path.join(args.pdbs, "*.pdb")))
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        structures = [parse_PDB(f, side_chains=args.side_chains)[0] for f in files]
+    print(f"parse_PDB: {(time.perf_counter() - start) / args.repeats:.3f} s for {len(files)} PDBs")
+
+    for label, pdbs in (("dict", [legacy_dict(s) for s in structures]), ("Structure", structures)):
+        t_copy, memory, t_feat = run(pdbs, args)
+        print(f"{label}: copies {t_copy:.2f} s  {memory:.0f} MB  featurize {t_feat:.2f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdbs", type=str, default="examples/pdbs")
+    parser.add_argument("--mutations", type=int, default=500, help="samples per structure")
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--side_chains", action="store_true")
+    main(parser.parse_args())
@@ -2,8 +2,14 @@
 ThermoMPNN
 '''
 
-from thermompnn.run import ThermoMPNN
-
 __version__ = 'v1.0.1'
 
 __all__ = ['ThermoMPNN']
+
+
+def __getattr__(name):
+    # ThermoMPNN pulls in torch and the models, so `import thermompnn` (e.g. for __version__) stays cheap until used
+    if name == 'ThermoMPNN':
+        from thermompnn.run import ThermoMPNN
+        return ThermoMPNN
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
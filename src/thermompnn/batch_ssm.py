@@ -0,0 +1,223 @@
+import glob
+import os
+from typing import List, Literal, Optional, Union
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from thermompnn.encoder_cache import EncoderCache
+from thermompnn.run import (ThermoMPNN, add_cache_arguments,
+                            additive_ssm_rows, cache_from_args, empty_rows,
+                            format_ssm_rows, run_single_ssm_batch,
+                            single_mutation_rows, stream_ssm_table)
+from thermompnn.ssm_utils import load_pdb
+
+
+def resolve_inputs(inputs):
+    """Lists (PDB path, chains) for a list of PDB files, directories, glob patterns or manifests.
+
+    A manifest is a text file with one PDB path per line (relative to the manifest), optionally followed by
+    the chains to use, e.g. "designs/d1.pdb A B". Empty lines and lines starting with # are skipped.
+    """
+    if isinstance(inputs, str):
+        inputs = [inputs]
+
+    found = []
+    for item in inputs:
+        if os.path.isdir(item):
+            found += [(path, None) for path in sorted(glob.glob(os.path.join(item, "*.pdb")))]
+        elif os.path.isfile(item) and not item.lower().endswith(".pdb"):
+            root = os.path.dirname(item)
+            with open(item) as f:
+                for line in f:
+                    fields = line.split()
+                    if fields and not fields[0].startswith("#"):
+                        found.append((os.path.join(root, fields[0]), fields[1:] or None))
+        else:
+            paths = sorted(glob.glob(item))
+            if not paths:
+                raise FileNotFoundError(f"No PDB files found for {item}")
+            found += [(path, None) for path in paths]
+
+    # keep the first occurrence of each file
+    seen, unique = set(), []
+    for path, chains in found:
+        if os.path.abspath(path) not in seen:
+            seen.add(os.path.abspath(path))
+            unique.append((path, chains))
+    return unique
+
+
+def bucket_by_length(lengths, max_residues, exact=None):
+    """Groups structure indices into batches of similar length with at most max_residues padded residues each.
+
+    Structures flagged in exact are only batched with structures of identical length.
+    """
+    exact = np.zeros(len(lengths), dtype=bool) if exact is None else np.asarray(exact)
+    buckets, current = [], []
+    for i in np.argsort(lengths, kind="stable"):
+        if current:
+            first = current[0]
+            full = (len(current) + 1) * lengths[i] > max_residues
+            if full or ((exact[i] or exact[first]) and lengths[i] != lengths[first]):
+                buckets.append(current)
+                current = []
+        current.append(int(i))
+    if current:
+        buckets.append(current)
+    return buckets
+
+
+def _count_resolved(pdb):
+    """Number of residues with a complete backbone (the residues ProteinMPNN sees)"""
+    backbone = [pdb.atom_names.index(atom) for atom in ("N", "CA", "C", "O")]
+    return int(pdb.atom_mask[:, backbone].all(-1).sum())
+
+
+class ThermoMPNNBatch(ThermoMPNN):
+    """
+    Runs ThermoMPNN SSM sweeps over many PDB files with a single model load.
+    Single and additive sweeps encode several length-bucketed structures per ProteinMPNN pass.
+    Each protein is written to <out>/<pdb name>.csv. Proteins with an existing output are skipped, so an
+    interrupted run resumes where it stopped.
+    Args:
+        inputs (Union[str, List[str]]): PDB files, directories, glob patterns or manifests (see resolve_inputs).
+        out (str, optional): Output directory. Defaults to 'ssm'.
+        max_residues (int, optional): Maximum number of (padded) residues per ProteinMPNN pass. Defaults to 4096 on
+            GPU and to one structure per pass on CPU, where batching does not pay off.
+        chunk_size (int, optional): Number of PDB files loaded into memory at once. Defaults to 256.
+        Other arguments are the same as for ThermoMPNN.
+    """
+
+    def __init__(
+            self,
+            inputs: Union[str, List[str]],
+            out: str = 'ssm',
+            chains: Optional[List[str]] = None,
+            mode: Literal["single", "additive", "epistatic"] = 'single',
+            batch_size: int = 256,
+            threshold: float = -0.5,
+            distance: float = 5.0,
+            ss_penalty: bool = False,
+            device: str = 'cuda',
+            max_residues: Optional[int] = None,
+            chunk_size: int = 256,
+            top_k: Optional[int] = None,
+            ensemble: int = 1,
+            cache: Optional[EncoderCache] = None,
+    ) -> None:
+        super().__init__(None, out=out, chains=chains, mode=mode, batch_size=batch_size, threshold=threshold,
+                         distance=distance, ss_penalty=ss_penalty, device=device, top_k=top_k, ensemble=ensemble,
+                         cache=cache)
+        self.inputs = inputs
+        if max_residues is None:
+            max_residues = 0 if self.device == 'cpu' else 4096
+        self.max_residues = max_residues
+        self.chunk_size = chunk_size
+
+    def output_path(self, pdb_path):
+        return os.path.join(self.out, os.path.splitext(os.path.basename(pdb_path))[0] + ".csv")
+
+    def _save(self, pdb_path, rows, pdb_data):
+        order = rows[0].shape[1]
+        try:
+            df = format_ssm_rows(*rows, pdb_data, self.mode, self.threshold, self.distance, self.ss_penalty)
+        except ValueError as e:  # nothing passed the filters; an empty output still marks the protein as done
+            print(f"{os.path.basename(pdb_path)}: {e}")
+            df = pd.DataFrame(columns=["ddG (kcal/mol)", "Mutation"] + (["CA-CA Distance"] if order == 2 else []))
+
+        # write to a temporary file first so that an interrupted write is not mistaken for a finished protein
+        out = self.output_path(pdb_path)
+        df.to_csv(out + ".tmp")
+        os.replace(out + ".tmp", out)
+
+    def process(self, save_csv: bool = True) -> List[str]:
+        '''
+        Run ThermoMPNN on every input PDB file. Returns the output CSV paths.
+        '''
+        if self.mode not in ("single", "additive", "epistatic"):
+            raise ValueError("Invalid mode selected!")
+
+        inputs = resolve_inputs(self.inputs)
+        names = [os.path.basename(self.output_path(path)) for path, _ in inputs]
+        if len(set(names)) != len(names):
+            raise ValueError("Input PDB files must have unique file names")
+
+        os.makedirs(self.out, exist_ok=True)
+        todo = [(path, chains) for path, chains in inputs if not os.path.isfile(self.output_path(path))]
+        print(f"{len(inputs) - len(todo)} of {len(inputs)} structures already processed")
+
+        cfg, model = self.load_model()
+        for start in range(0, len(todo), self.chunk_size):
+            chunk = todo[start: start + self.chunk_size]
+            pdbs = [load_pdb(path, chains or self.chains) for path, chains in chunk]
+            keys = [self.cache_key(path, chains or self.chains) for path, chains in chunk]
+
+            if self.mode == "epistatic":
+                for (path, _), pdb_data, key in zip(chunk, pdbs, keys):
+                    try:
+                        stream_ssm_table(
+                            pdb_data, cfg, model, "epistatic", self.output_path(path), "csv", self.threshold,
+                            self.distance, self.batch_size, device=self.device, top_k=self.top_k,
+                            ss_penalty=self.ss_penalty, cache=self.cache, key=key
+                        )
+                    except ValueError:  # nothing passed the filters
+                        self._save(path, empty_rows(2), pdb_data)
+                continue
+
+            # structures with at most top_k resolved residues are sensitive to padding: padded residues tie with
+            # their farthest real neighbor, so these are only batched with structures of the same length
+            k_neighbors = model.prot_mpnn.features.top_k
+            lengths = [len(pdb_data["seq"]) for pdb_data in pdbs]
+            exact = [_count_resolved(pdb_data) <= k_neighbors for pdb_data in pdbs]
+            for bucket in tqdm(bucket_by_length(lengths, self.max_residues, exact)):
+                results = run_single_ssm_batch([pdbs[i] for i in bucket], cfg, model, device=self.device,
+                                               cache=self.cache, keys=[keys[i] for i in bucket])
+                for i, (ddg, S) in zip(bucket, results):
+                    if self.mode == "single":
+                        rows = single_mutation_rows(ddg, S, self.threshold)
+                    else:
+                        rows = additive_ssm_rows(ddg, S, self.threshold, pdbs[i], self.distance)
+                    self._save(chunk[i][0], rows, pdbs[i])
+
+        return [self.output_path(path) for path, _ in inputs]
+
+
+def add_batch_arguments(parser):
+    """Command line options of `thermompnn batch`"""
+    parser.add_argument("inputs", nargs="+", help="PDB files, directories, glob patterns or manifest files")
+    parser.add_argument("--mode", type=str, help="SSM mode to use (single | additive | epistatic)", default="single")
+    parser.add_argument("--out", type=str, help="output directory (one csv per PDB)", default="ssm")
+    parser.add_argument("--chains", nargs="+", help="chain(s) to use for every PDB. Default is all chains.")
+    parser.add_argument("--batch_size", type=int, help="batch size for the epistatic model", default=256)
+    parser.add_argument(
+        "--max_residues", type=int, default=None,
+        help="maximum number of padded residues per ProteinMPNN pass (single/additive). "
+             "Default is 4096 on GPU and one structure per pass on CPU.",
+    )
+    parser.add_argument("--threshold", type=float, default=-0.5, help="Threshold for SSM sweep (see thermompnn -h)")
+    parser.add_argument("--distance", type=float, default=5.0, help="Ca distance cutoff for double mutants.")
+    parser.add_argument("--ss_penalty", action="store_true", help="Add explicit disulfide breakage penalty.")
+    parser.add_argument("--device", type=str, help="device to use", default="cpu")
+    parser.add_argument("--top_k", type=int, help="only keep the top K epistatic double mutants (lowest ddG)")
+    parser.add_argument("--ensemble", type=int, default=1, help="number of ensemble checkpoints to average")
+    add_cache_arguments(parser)
+
+
+def batch_main(args):
+    ThermoMPNNBatch(
+        inputs=args.inputs,
+        out=args.out,
+        chains=args.chains,
+        mode=args.mode,
+        batch_size=args.batch_size,
+        threshold=args.threshold,
+        distance=args.distance,
+        ss_penalty=args.ss_penalty,
+        device=args.device,
+        max_residues=args.max_residues,
+        top_k=args.top_k,
+        ensemble=args.ensemble,
+        cache=cache_from_args(args),
+    ).process()
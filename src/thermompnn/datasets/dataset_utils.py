@@ -1,8 +1,13 @@
 from __future__ import annotations
 
+import hashlib
 from dataclasses import dataclass
 from typing import Optional
 
+import numpy as np
+
+from thermompnn.pdb_utils import Structure
+
 ALPHABET = 'ACDEFGHIKLMNPQRSTVWY-'
 
 
@@ -41,3 +46,24 @@ def seq1_index_to_seq2_index(align, index):
         return None
 
     return seq2_idx
+
+
+def structure_hash(pdb):
+    """Content hash of a parsed structure dict. The attached mutation (if any) is ignored."""
+    h = hashlib.sha1()
+    keys = list(pdb)
+    if isinstance(pdb, Structure):  # all coordinates are hashed at once
+        h.update(np.ascontiguousarray(pdb.xyz).tobytes())
+        keys = [key for key in keys if not key.startswith('coords_chain_')]
+    for key in sorted(keys):
+        if key == 'mutation':
+            continue
+        value = pdb[key]
+        h.update(key.encode())
+        if isinstance(value, dict):  # coords_chain_* dicts of per-atom coordinate arrays
+            for atom in sorted(value):
+                h.update(atom.encode())
+                h.update(np.ascontiguousarray(value[atom], dtype=np.float64).tobytes())
+        else:
+            h.update(repr(value).encode())
+    return h.hexdigest()
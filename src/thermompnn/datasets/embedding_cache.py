@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from thermompnn.datasets.v2_datasets import tied_featurize_mut_dedup
+
+
+class EmbeddingCache:
+    """On-disk store of frozen ProteinMPNN outputs for head-only training.
+
+    Each entry holds the outputs for one encoded structure row as memory-mapped .npy files: hid [nfl, L, H]
+    (the last num_final_layers hidden states), embed [L, H] and, with edges, edges [L, K, H].
+    Entries are keyed by a hash of the encoder inputs. A structure encoded with a different sequence (e.g.,
+    after the wildtype overwrite of the multi-mutant models) therefore gets its own entry.
+    """
+
+    def __init__(self, path, num_final_layers, edges=False):
+        self.path = path
+        self.num_final_layers = num_final_layers
+        self.edges = edges
+
+        os.makedirs(path, exist_ok=True)
+        meta = {'num_final_layers': num_final_layers, 'edges': edges}
+        meta_file = os.path.join(path, 'meta.json')
+        if os.path.isfile(meta_file):
+            with open(meta_file) as f:
+                found = json.load(f)
+            if found != meta:
+                raise ValueError(f'Embedding cache {path} was built with {found}, but {meta} was requested')
+        else:
+            with open(meta_file, 'w') as f:
+                json.dump(meta, f)
+
+    @staticmethod
+    def row_keys(X, S, mask, lengths, chain_M, chain_encoding_all, residue_idx):
+        """Cache keys of the (unpadded) structure rows of a featurized batch"""
+        X = torch.nan_to_num(X, nan=0.0)
+        keys = []
+        for u, length in enumerate(lengths):
+            h = hashlib.sha1()
+            for t in (X, S, mask, chain_M, residue_idx, chain_encoding_all):
+                h.update(t[u, :length].cpu().contiguous().numpy().tobytes())
+            keys.append(h.hexdigest())
+        return keys
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def __contains__(self, key):
+        return os.path.isdir(self._entry(key))
+
+    def write(self, key, hid, embed, edges=None):
+        entry = self._entry(key)
+        tmp = f'{entry}.{os.getpid()}.tmp'
+        os.makedirs(tmp, exist_ok=True)
+        np.save(os.path.join(tmp, 'hid.npy'), hid)
+        np.save(os.path.join(tmp, 'embed.npy'), embed)
+        if self.edges:
+            np.save(os.path.join(tmp, 'edges.npy'), edges)
+        try:
+            os.rename(tmp, entry)  # entries appear atomically
+        except OSError:  # written concurrently by another process
+            shutil.rmtree(tmp)
+
+    def read(self, key):
+        """Memory-mapped (hid, embed, edges) arrays of an entry. edges is None unless the cache stores edges."""
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            raise KeyError(f'Structure {key} is not in embedding cache {self.path}. Run precompute_embeddings first.')
+        hid = np.load(os.path.join(entry, 'hid.npy'), mmap_mode='r')
+        embed = np.load(os.path.join(entry, 'embed.npy'), mmap_mode='r')
+        edges = np.load(os.path.join(entry, 'edges.npy'), mmap_mode='r') if self.edges else None
+        return hid, embed, edges
+
+    def featurize(self, batch, side_chains=False, wt_overwrite=False):
+        """tied_featurize_mut_dedup with the cached (all_mpnn_hid, mpnn_embed, mpnn_edges) of each row appended"""
+        feats = tied_featurize_mut_dedup(batch, side_chains=side_chains, wt_overwrite=wt_overwrite)
+        if feats is None:
+            return None
+        entries = [self.read(key) for key in self.row_keys(*feats[:7])]
+
+        U, L = feats[1].shape
+        H = entries[0][1].shape[-1]
+        hid = np.zeros([self.num_final_layers, U, L, H], dtype=np.float32)
+        embed = np.zeros([U, L, H], dtype=np.float32)
+        if self.edges:
+            K = max(e[2].shape[1] for e in entries)
+            edges = np.zeros([U, L, K, H], dtype=np.float32)
+        for u, (h, e, ed) in enumerate(entries):
+            length = e.shape[0]
+            hid[:, u, :length] = h
+            embed[u, :length] = e
+            if self.edges:
+                edges[u, :length, :ed.shape[1]] = ed  # neighbors beyond the structure length are padding
+
+        embeddings = (list(torch.from_numpy(hid).unbind(0)), torch.from_numpy(embed),
+                      torch.from_numpy(edges) if self.edges else None)
+        return feats + (embeddings,)
+
+
+def precompute_embeddings(model, dataset, cache, collate_fn, batch_size=256, num_workers=0):
+    """Runs the frozen ProteinMPNN encoder of model once for every structure row of dataset missing from cache.
+
+    collate_fn must be the structure-deduplicated collate used for training (see get_collate_fn).
+    """
+    if not hasattr(model.prot_mpnn, 'embed'):
+        raise ValueError('Embedding cache requires a ProteinMPNN model with an embed method')
+    device = torch.device("cuda:0" if (torch.cuda.is_available()) else "cpu")
+    prot_mpnn = model.prot_mpnn.to(device).eval()
+
+    loader = DataLoader(dataset, collate_fn=collate_fn, shuffle=False, num_workers=num_workers,
+                        batch_size=batch_size)
+    added = 0
+    for batch in tqdm(loader):
+        if batch is None:
+            continue
+        X, S, mask, lengths, chain_M, chain_encoding_all, residue_idx = batch[:7]
+        keys = cache.row_keys(X, S, mask, lengths, chain_M, chain_encoding_all, residue_idx)
+        todo = {}
+        for u, key in enumerate(keys):
+            if key not in cache and key not in keys[:u]:
+                todo.setdefault(int(lengths[u]), []).append(u)
+
+        # rows are encoded without padding: for structures shorter than the neighbor count, padded residues
+        # would otherwise tie with (and replace) the farthest real neighbor
+        X = torch.nan_to_num(X, nan=0.0)
+        for length, group in todo.items():
+            rows = torch.tensor(group)
+            with torch.no_grad():
+                all_mpnn_hid, mpnn_embed, mpnn_edges, _ = prot_mpnn.embed(
+                    *(t[rows, :length].to(device) for t in (X, S, mask, chain_M, residue_idx, chain_encoding_all)))
+            hid = torch.stack(all_mpnn_hid[:cache.num_final_layers]) if cache.num_final_layers > 0 \
+                else mpnn_embed.new_zeros((0,) + mpnn_embed.shape)
+
+            for i, u in enumerate(group):
+                edges = mpnn_edges[i].cpu().numpy() if cache.edges else None
+                cache.write(keys[u], hid[:, i].cpu().numpy(), mpnn_embed[i].cpu().numpy(), edges)
+            added += len(group)
+
+    print(f'{added} structures added to embedding cache {cache.path}')
@@ -7,15 +7,27 @@ from itertools import permutations
 import numpy as np
 import pandas as pd
 import torch
-from Bio import pairwise2
-from sklearn.preprocessing import minmax_scale
 from tqdm import tqdm
 
 from thermompnn.datasets.dataset_utils import (ALPHABET, Mutation,
-                                               seq1_index_to_seq2_index)
+                                               seq1_index_to_seq2_index,
+                                               structure_hash)
+from thermompnn.model.v2_model import _check_sequence_match
+from thermompnn.pdb_utils import BACKBONE_ATOMS, Structure
 from thermompnn.protein_mpnn_utils import alt_parse_PDB, parse_PDB
 
 
+def _chain_atoms(b, letter, atoms=None):
+    """[chain length, atoms, 3] coordinates of one chain (all stored atoms by default). A Structure slices its
+    coordinate array, parsed PDB dicts are stacked from the per-atom arrays."""
+    if isinstance(b, Structure):
+        return b.chain_xyz(letter, atoms)
+    chain_coords = b[f'coords_chain_{letter}']
+    if atoms is None:
+        return np.stack([chain_coords[c] for c in chain_coords.keys()], 1)
+    return np.stack([chain_coords[f'{atom}_chain_{letter}'] for atom in atoms], 1)
+
+
 def tied_featurize_mut(
         batch,
         device='cpu',
@@ -103,19 +115,17 @@ def tied_featurize_mut(
                 letter_list.append(letter)
                 visible_list.append(letter)
                 chain_seq = b[f'seq_chain_{letter}']
-                chain_seq = ''.join([a if a != '-' else 'X' for a in chain_seq])
+                chain_seq = chain_seq.replace('-', 'X')
                 chain_length = len(chain_seq)
                 global_idx_start_list.append(global_idx_start_list[-1] + chain_length)
-                chain_coords = b[f'coords_chain_{letter}']  # this is a dictionary
                 chain_mask = np.zeros(chain_length)  # 0.0 for visible chains
                 if ca_only:
+                    chain_coords = b[f'coords_chain_{letter}']  # this is a dictionary
                     x_chain = np.array(chain_coords[f'CA_chain_{letter}'])  # [chain_lenght,1,3] #CA_diff
                     if len(x_chain.shape) == 2:
                         x_chain = x_chain[:, None, :]
                 else:
-                    x_chain = np.stack([chain_coords[c] for c in
-                                        [f'N_chain_{letter}', f'CA_chain_{letter}', f'C_chain_{letter}',
-                                         f'O_chain_{letter}']], 1)  # [chain_lenght,4,3]
+                    x_chain = _chain_atoms(b, letter, BACKBONE_ATOMS)  # [chain_lenght,4,3]
                 x_chain_list.append(x_chain)
                 chain_mask_list.append(chain_mask)
                 chain_seq_list.append(chain_seq)
@@ -139,22 +149,20 @@ def tied_featurize_mut(
                 masked_list.append(letter)
                 letter_list.append(letter)
                 chain_seq = b[f'seq_chain_{letter}']
-                chain_seq = ''.join([a if a != '-' else 'X' for a in chain_seq])
+                chain_seq = chain_seq.replace('-', 'X')
                 chain_length = len(chain_seq)
                 global_idx_start_list.append(global_idx_start_list[-1] + chain_length)
                 masked_chain_length_list.append(chain_length)
-                chain_coords = b[f'coords_chain_{letter}']  # this is a dictionary
                 chain_mask = np.ones(chain_length)  # 1.0 for masked
                 if ca_only:
+                    chain_coords = b[f'coords_chain_{letter}']  # this is a dictionary
                     x_chain = np.array(chain_coords[f'CA_chain_{letter}'])  # [chain_lenght,1,3] #CA_diff
                     if len(x_chain.shape) == 2:
                         x_chain = x_chain[:, None, :]
                 elif side_chains:
-                    x_chain = np.stack([chain_coords[c] for c in chain_coords.keys()], 1)  # [chain_length, 14, 3]
+                    x_chain = _chain_atoms(b, letter)  # [chain_length, 14, 3]
                 else:
-                    x_chain = np.stack([chain_coords[c] for c in
-                                        [f'N_chain_{letter}', f'CA_chain_{letter}', f'C_chain_{letter}',
-                                         f'O_chain_{letter}']], 1)  # [chain_lenght,4,3]
+                    x_chain = _chain_atoms(b, letter, BACKBONE_ATOMS)  # [chain_lenght,4,3]
                 x_chain_list.append(x_chain)
                 chain_mask_list.append(chain_mask)
                 chain_seq_list.append(chain_seq)
@@ -259,7 +267,10 @@ def tied_featurize_mut(
         bias_by_res_all[i, :] = bias_by_res_pad
 
         # Convert to labels
-        indices = np.asarray([alphabet.index(a) for a in all_sequence], dtype=np.int32)
+        if isinstance(b, Structure) and letter_list == b.chains:
+            indices = b.seq_idx  # already encoded, in chain order
+        else:
+            indices = np.asarray([alphabet.index(a) for a in all_sequence], dtype=np.int32)
         S[i, :l] = indices
         letter_list_list.append(letter_list)
         visible_list_list.append(visible_list)
@@ -325,6 +336,81 @@ def tied_featurize_mut(
     return X_out, S, mask, lengths, chain_M, chain_encoding_all, residue_idx, MUT_POS, MUT_WT_AA, MUT_MUT_AA, MUT_DDG, atom_mask
 
 
+def tied_featurize_mut_dedup(batch, device='cpu', side_chains=False, wt_overwrite=False):
+    """Structure-deduplicated version of tied_featurize_mut.
+
+    Each unique (structure, sequence) pair in the batch is featurized once. Returns the same 12 items as
+    tied_featurize_mut, except that the structure tensors (X, S, mask, lengths, chain_M, chain_encoding_all,
+    residue_idx, atom_mask) have one row per unique structure, plus struct_idx [B] mapping each mutation to its row.
+    With wt_overwrite, S is matched to the mutation wildtypes first (as done by the multi-mutant models).
+    """
+    try:
+        keys = [structure_hash(b) for b in batch]
+    except TypeError:
+        return None
+    unique_keys = list(dict.fromkeys(keys))
+    reps = [batch[keys.index(k)] for k in unique_keys]
+    feats = tied_featurize_mut(reps, device=device, side_chains=side_chains)
+    if feats is None:
+        return None
+    X, S, mask, lengths, chain_M, chain_encoding_all, residue_idx, _, _, _, _, atom_mask = feats
+
+    B = len(batch)
+    N_MUT = max([len(b['mutation'].position) for b in batch])
+    MUT_POS = np.zeros([B, N_MUT], dtype=np.int32)
+    MUT_WT_AA = np.zeros([B, N_MUT], dtype=np.int32)
+    MUT_MUT_AA = np.zeros([B, N_MUT], dtype=np.int32)
+    MUT_DDG = np.zeros([B, 1], dtype=np.float32)
+    for i, b in enumerate(batch):
+        mut = b['mutation']
+        MUT_DDG[i, :] = mut.ddG
+        for nm in range(len(mut.position)):
+            MUT_POS[i, nm] = mut.position[nm]
+            MUT_WT_AA[i, nm] = ALPHABET.index(mut.wildtype[nm])
+            MUT_MUT_AA[i, nm] = ALPHABET.index(mut.mutation[nm])
+    MUT_POS = torch.from_numpy(MUT_POS).to(dtype=torch.long, device=device)
+    MUT_WT_AA = torch.from_numpy(MUT_WT_AA).to(dtype=torch.long, device=device)
+    MUT_MUT_AA = torch.from_numpy(MUT_MUT_AA).to(dtype=torch.long, device=device)
+    MUT_DDG = torch.from_numpy(MUT_DDG).to(dtype=torch.float32, device=device)
+
+    struct_idx = torch.tensor([unique_keys.index(k) for k in keys], dtype=torch.long, device=device)
+    if wt_overwrite:
+        # the overwrite makes S mutation-specific, so structures are shared only between identical sequences
+        S_mut = _check_sequence_match(S[struct_idx], MUT_WT_AA, MUT_MUT_AA, MUT_POS)
+        rows, struct_idx = torch.unique(torch.cat([struct_idx[:, None], S_mut], -1), dim=0, return_inverse=True)
+        X, mask, chain_M, chain_encoding_all, residue_idx, atom_mask = (
+            t[rows[:, 0]] for t in (X, mask, chain_M, chain_encoding_all, residue_idx, atom_mask))
+        lengths = lengths[rows[:, 0].cpu().numpy()]
+        S = rows[:, 1:]
+
+    return X, S, mask, lengths, chain_M, chain_encoding_all, residue_idx, MUT_POS, MUT_WT_AA, MUT_MUT_AA, MUT_DDG, \
+        atom_mask, struct_idx
+
+
+def expand_dedup_batch(batch):
+    """Expands a tied_featurize_mut_dedup batch back to one structure row per mutation (tied_featurize_mut layout)"""
+    X, S, mask, lengths, chain_M, chain_encoding_all, residue_idx, MUT_POS, MUT_WT_AA, MUT_MUT_AA, MUT_DDG, \
+        atom_mask, struct_idx = batch
+    X, S, mask, chain_M, chain_encoding_all, residue_idx, atom_mask = (
+        t[struct_idx] for t in (X, S, mask, chain_M, chain_encoding_all, residue_idx, atom_mask))
+    lengths = lengths[struct_idx.cpu().numpy()]
+    return X, S, mask, lengths, chain_M, chain_encoding_all, residue_idx, MUT_POS, MUT_WT_AA, MUT_MUT_AA, MUT_DDG, \
+        atom_mask
+
+
+def get_collate_fn(cfg, dedup=False, cache=None):
+    """Batch collate function for a config, optionally structure-deduplicated (see tied_featurize_mut_dedup)
+    or reading ProteinMPNN outputs from an EmbeddingCache (which implies dedup)"""
+    side_chains = cfg.data.get('side_chains', False)
+    # multi-mutant models overwrite S with the mutation wildtypes before encoding
+    wt_overwrite = cfg.model.get('aggregation', None) is not None
+    if cache is not None:
+        return lambda b: cache.featurize(b, side_chains=side_chains, wt_overwrite=wt_overwrite)
+    if dedup:
+        return lambda b: tied_featurize_mut_dedup(b, side_chains=side_chains, wt_overwrite=wt_overwrite)
+    return lambda b: tied_featurize_mut(b, side_chains=side_chains)
+
+
 class ddgBenchDatasetv2(torch.utils.data.Dataset):
 
     def __init__(self, cfg, pdb_dir, csv_fname, flip=False):
@@ -520,6 +606,7 @@ class FireProtDatasetv2(torch.utils.data.Dataset):
             assert pdb['seq'][pdb_idx] == row.wild_type == row.pdb_sequence[row.pdb_position]
 
         except AssertionError:  # contingency for mis-alignments
+            from Bio import pairwise2  # deprecated and slow to import, so only loaded when needed
             align, *rest = pairwise2.align.globalxx(row.pdb_sequence, pdb['seq'].replace("-", "X"))
             pdb_idx = seq1_index_to_seq2_index(align, row.pdb_position)
 
@@ -0,0 +1,157 @@
+import hashlib
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+import torch
+
+
+def _nbytes(entry):
+    return sum(t.numel() * t.element_size() for t in entry)
+
+
+class EncoderCache:
+    """Content-addressed LRU cache of ProteinMPNN encoder outputs for SSM runs.
+
+    An entry holds (hidden states [layers, L, H], sequence embedding [L, H], edges [L, K, H], E_idx [L, K]) of one
+    structure without padding. Entries are keyed by the PDB file contents, the chain selection and the ProteinMPNN
+    weights, so single, additive and epistatic runs on the same structure share an entry whenever their checkpoints
+    share the encoder weights.
+
+    Up to max_memory bytes of entries are kept in memory. With a path, entries are also written to disk as .pt
+    files, and the least recently used files are removed once they take more than max_disk bytes. The cache can be
+    shared between threads (e.g. the workers of server.SSMServer).
+    """
+
+    def __init__(self, path=None, max_memory=2 ** 30, max_disk=8 * 2 ** 30):
+        self.path = path
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._fingerprints = weakref.WeakKeyDictionary()
+        self._lock = threading.RLock()  # guards the in-memory entries and fingerprints
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def fingerprint(self, model):
+        """Hash of the ProteinMPNN weights (and neighbor count) of model, computed once per model"""
+        prot_mpnn = model.prot_mpnn
+        with self._lock:
+            if prot_mpnn not in self._fingerprints:
+                h = hashlib.sha1(f"{type(prot_mpnn).__name__} {prot_mpnn.features.top_k}".encode())
+                for name, t in prot_mpnn.state_dict().items():
+                    h.update(f"{name} {tuple(t.shape)} {t.dtype}".encode())
+                    h.update(t.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+                self._fingerprints[prot_mpnn] = h.hexdigest()
+            return self._fingerprints[prot_mpnn]
+
+    def key(self, pdb_path, chains, model):
+        """Cache key of a PDB file run with the given chains (None for all chains) and model"""
+        h = hashlib.sha1()
+        with open(pdb_path, "rb") as f:
+            h.update(f.read())
+        h.update((" ".join(chains) if chains else "all").encode())
+        h.update(self.fingerprint(model).encode())
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + ".pt")
+
+    def get(self, key):
+        """Cached entry of key or None"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+
+        if self.path is None or not os.path.isfile(self._file(key)):
+            return None
+        try:
+            entry = tuple(torch.load(self._file(key), map_location="cpu", weights_only=True))
+            os.utime(self._file(key))  # mark as recently used
+        except (OSError, RuntimeError):  # removed by another process in the meantime, or a partial file
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        entry = tuple(t.detach().cpu() for t in entry)
+        self._remember(key, entry)
+        if self.path is None:
+            return
+
+        tmp = f"{self._file(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        torch.save(list(entry), tmp)
+        os.replace(tmp, self._file(key))  # entries appear atomically
+
+        # evict least recently used files
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith(".pt"):
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, name))
+        size = sum(f[1] for f in files)
+        for _, nbytes, name in sorted(files):
+            if size <= self.max_disk or name == key + ".pt":
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            size -= nbytes
+
+    def _remember(self, key, entry):
+        nbytes = _nbytes(entry)
+        if nbytes > self.max_memory:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory_size -= _nbytes(self._memory.pop(key))
+            self._memory[key] = entry
+            self._memory_size += nbytes
+            while self._memory_size > self.max_memory:
+                _, old = self._memory.popitem(last=False)
+                self._memory_size -= _nbytes(old)
+
+    def embed(self, model, keys, X, S, mask, chain_M, residue_idx, chain_encoding_all, lengths):
+        """Drop-in for model.prot_mpnn.embed on a featurized batch that only encodes structures missing from the cache.
+
+        keys has one cache key per structure row. Missing rows are encoded in groups of equal length, i.e. without
+        padding, so that an entry does not depend on the batch it was computed in.
+        """
+        entries = [self.get(key) for key in keys]
+        missing = {}
+        for b, entry in enumerate(entries):
+            if entry is None:
+                missing.setdefault(int(lengths[b]), []).append(b)
+
+        for length, rows in missing.items():
+            rows_t = torch.tensor(rows, device=X.device)
+            with torch.no_grad():
+                all_mpnn_hid, mpnn_embed, mpnn_edges, E_idx = model.prot_mpnn.embed(
+                    *(t[rows_t, :length] for t in (X, S, mask, chain_M, residue_idx, chain_encoding_all))
+                )
+            hid = torch.stack(all_mpnn_hid, 1)  # [B, layers, L, H]
+            for i, b in enumerate(rows):
+                entries[b] = (hid[i].cpu(), mpnn_embed[i].cpu(), mpnn_edges[i].cpu(), E_idx[i].cpu())
+                self.put(keys[b], entries[b])
+
+        # pad rows back to the batch length
+        B, L = S.shape
+        hid = torch.zeros((entries[0][0].shape[0], B, L, entries[0][0].shape[-1]), device=X.device)
+        mpnn_embed = torch.zeros((B, L, entries[0][1].shape[-1]), device=X.device)
+        K = max(entry[3].shape[-1] for entry in entries)
+        mpnn_edges = torch.zeros((B, L, K, entries[0][2].shape[-1]), device=X.device)
+        E_idx = torch.zeros((B, L, K), dtype=torch.long, device=X.device)
+        for b, (h, e, ed, idx) in enumerate(entries):
+            n, k = idx.shape
+            hid[:, b, :n] = h.to(X.device)
+            mpnn_embed[b, :n] = e.to(X.device)
+            mpnn_edges[b, :n, :k] = ed.to(X.device)
+            E_idx[b, :n, :k] = idx.to(X.device)
+        return list(hid.unbind(0)), mpnn_embed, mpnn_edges, E_idx
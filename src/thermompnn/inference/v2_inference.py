@@ -10,7 +10,7 @@ from thermompnn.datasets.v2_datasets import (FireProtDatasetv2,
                                              MegaScaleDatasetv2,
                                              ProteinGymDataset,
                                              ddgBenchDatasetv2,
-                                             tied_featurize_mut)
+                                             get_collate_fn)
 from thermompnn.inference.inference_utils import get_metrics_full
 from thermompnn.model.v2_model import batched_index_select
 
@@ -33,19 +33,20 @@ def run_prediction_batched(name, model, dataset_name, dataset, results, keep=Tru
     print(f'Testing Model {name} on dataset {dataset_name}')
     preds, ddgs = [], []
 
+    # zero-shot scoring calls ProteinMPNN directly and needs one structure row per mutation
+    dedup = cfg.training.get('dedup_structures', False) and not zero_shot
     loader = DataLoader(
-        dataset, collate_fn=lambda b: tied_featurize_mut(
-            b, side_chains=cfg.data.get(
-                'side_chains', False)), shuffle=False, num_workers=cfg.training.get(
+        dataset, collate_fn=get_collate_fn(cfg, dedup=dedup), shuffle=False, num_workers=cfg.training.get(
             'num_workers', 8), batch_size=cfg.training.get(
-                    'batch_size', 256))
+                'batch_size', 256))
 
     batches = []
     for i, batch in enumerate(tqdm(loader)):
 
         if batch is None:
             continue
-        X, S, mask, lengths, chain_M, chain_encoding_all, residue_idx, mut_positions, mut_wildtype_AAs, mut_mutant_AAs, mut_ddGs, atom_mask = batch
+        struct_idx = batch[12].to(device) if dedup else None
+        X, S, mask, lengths, chain_M, chain_encoding_all, residue_idx, mut_positions, mut_wildtype_AAs, mut_mutant_AAs, mut_ddGs, atom_mask = batch[:12]
         X = X.to(device)
         S = S.to(device)
         mask = mask.to(device)
@@ -62,11 +63,12 @@ def run_prediction_batched(name, model, dataset_name, dataset, results, keep=Tru
         if cfg.model.get('aggregation', '') == 'siamese':
             # average both siamese network passes
             predA, predB = model(X, S, mask, chain_M, residue_idx, chain_encoding_all,
-                                 mut_positions, mut_wildtype_AAs, mut_mutant_AAs, mut_ddGs, atom_mask)
+                                 mut_positions, mut_wildtype_AAs, mut_mutant_AAs, mut_ddGs, atom_mask,
+                                 struct_idx=struct_idx)
             pred = torch.mean(torch.cat([predA, predB], dim=-1), dim=-1)
         elif not zero_shot:
             pred, _ = model(X, S, mask, chain_M, residue_idx, chain_encoding_all, mut_positions,
-                            mut_wildtype_AAs, mut_mutant_AAs, mut_ddGs, atom_mask)
+                            mut_wildtype_AAs, mut_mutant_AAs, mut_ddGs, atom_mask, struct_idx=struct_idx)
         else:
             # non-epistatic (single mut) zero-shot
             pred = model(X, S, mask, chain_M, residue_idx, chain_encoding_all)[-2]
@@ -26,10 +26,14 @@ def get_protein_mpnn(cfg, version='v_48_020.pt'):
     else:
         use_IPMP = False
 
-    model_weight_dir = vanilla_weigths.setup()
-    checkpoint_path = os.path.join(model_weight_dir, version)
-    print('Loading model %s', checkpoint_path)
-    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    # fused checkpoints (ssm_utils.export_fused) carry all weights and the neighbor count, so skip the vanilla file
+    k_neighbors = cfg.model.get('k_neighbors', None)
+    if cfg.model.load_pretrained or k_neighbors is None:
+        model_weight_dir = vanilla_weigths.setup()
+        checkpoint_path = os.path.join(model_weight_dir, version)
+        print('Loading model %s', checkpoint_path)
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        k_neighbors = checkpoint['num_edges']
 
     dropout = cfg.model.proteinmpnn_dropout if 'proteinmpnn_dropout' in cfg.model else 0.1
     if dropout != 0.1:
@@ -43,7 +47,7 @@ def get_protein_mpnn(cfg, version='v_48_020.pt'):
         hidden_dim=hidden_dim,
         num_encoder_layers=num_layers,
         num_decoder_layers=num_layers,
-        k_neighbors=checkpoint['num_edges'],
+        k_neighbors=k_neighbors,
         augment_eps=0.0,
         dropout=dropout)
 
@@ -157,22 +161,6 @@ class SideChainProteinFeatures(nn.Module):
 
         return RBF
 
-    def _get_rbf(self, A, B, E_idx, A_mask, B_mask):
-        D_A_B = torch.sqrt(torch.sum((A[:, :, None, :] - B[:, None, :, :])**2, -1) + 1e-6)  # [B, L, L]
-        D_A_B_neighbors = gather_edges(D_A_B[:, :, :, None], E_idx)[:, :, :, 0]  # [B,L,K]
-
-        # make pairwise atom mask
-        combo = torch.unsqueeze(torch.unsqueeze(A_mask, 2) * torch.unsqueeze(B_mask, 1), -1)  # [B, L, L, 1]
-
-        # gather K neighbors out of overall mask
-        combo = torch.unsqueeze(gather_edges(combo, E_idx)[..., 0], -1)  # [B, L, K, 1]
-
-        # mask RBFs directly using paired atom mask
-        # RBF_A_B = self._rbf(D_A_B_neighbors) # un-masked original command
-        RBF_A_B = self._rbf(D_A_B_neighbors) * \
-            combo.expand(combo.shape[0], combo.shape[1], combo.shape[2], self.num_rbf)  # [B, L, K, N_RBF]
-        return RBF_A_B
-
     def _impute_CB(self, N, CA, C):
         b = CA - N
         c = C - CA
@@ -181,17 +169,19 @@ class SideChainProteinFeatures(nn.Module):
         return Cb
 
     def _atomic_distances(self, X, E_idx, atom_mask, S=None):
-        RBF_all = []
-
         if self.action_centers is not None:
             X, atom_mask = self._action_centers(X, atom_mask, S)
 
-        for i in range(X.shape[-2]):
-            for j in range(X.shape[-2]):
-                # pass specific  atom masks to RBF fxn
-                RBF_all.append(self._get_rbf(X[..., i, :], X[..., j, :], E_idx, atom_mask[..., i], atom_mask[..., j]))
+        # every (i, j) atom pair at once from a single neighbor gather, laid out i-major like the pairwise loop
+        B, L, A = X.shape[:3]
+        X_neighbors = gather_nodes(X.flatten(2), E_idx).view(B, L, -1, A, 3)  # [B, L, K, A, 3]
+        D = torch.sqrt(torch.sum((X[:, :, None, :, None, :] - X_neighbors[:, :, :, None, :, :])**2, -1) + 1e-6)
+        mask_neighbors = gather_nodes(atom_mask, E_idx)  # [B, L, K, A]
+        combo = atom_mask[:, :, None, :, None] * mask_neighbors[:, :, :, None, :]  # [B, L, K, A, A]
 
-        RBF_all = torch.cat(tuple(RBF_all), dim=-1)
+        # mask RBFs directly using paired atom mask
+        RBF_all = self._rbf(D) * combo[..., None]  # [B, L, K, A, A, N_RBF]
+        RBF_all = RBF_all.flatten(3)
         return RBF_all
 
     def _action_centers(self, X, atom_mask, S=None):
@@ -3,6 +3,7 @@ from itertools import permutations
 import numpy as np
 import torch
 import torch.nn as nn
+from torch.func import functional_call, vmap
 
 from thermompnn.model.modules import (LightAttention, MPNNLayer,
                                       SideChainModule, get_protein_mpnn)
@@ -20,6 +21,34 @@ def batched_index_select(input, dim, index):
     return torch.gather(input, dim, index)
 
 
+def gather_pair_edges(mpnn_edges, E_idx, mut_positions):
+    """
+    Batched lookup of the ProteinMPNN edges between mutated residues.
+    mpnn_edges [B, L, K, E] and E_idx [B, L, K] may also have batch size 1 to share one structure across mutations.
+    For each mutation, the edges to the other mutations found in its neighbor list are averaged.
+    Mutations without a mutated neighbor (e.g., single mutations) get an empty (zero) edge.
+    Returns edges of shape [B, E, N_muts].
+    """
+    B, N = mut_positions.shape
+    device = mut_positions.device
+    batch_idx = torch.arange(B, device=device)[:, None, None] if E_idx.shape[0] > 1 else 0
+
+    # match[b, i, j, k] is True if neighbor k of mutation i is mutation j
+    E_idx_mut = E_idx[batch_idx, mut_positions[:, :, None]].squeeze(2)  # [B, N, K]
+    match = E_idx_mut[:, :, None, :] == mut_positions[:, None, :, None]  # [B, N, N, K]
+    found = match.any(-1, keepdim=True)
+    first = match.int().argmax(-1)  # first matching neighbor [B, N, N]
+
+    pair_edges = mpnn_edges[batch_idx, mut_positions[:, :, None], first]  # [B, N, N, E]
+    pair_edges = pair_edges.masked_fill(~found, torch.nan)
+
+    # drop self pairs and take the mean of valid edges over the other mutations
+    others = ~torch.eye(N, dtype=torch.bool, device=device)
+    pair_edges = pair_edges[:, others].view(B, N, N - 1, mpnn_edges.shape[-1]).transpose(2, 3)  # [B, N, E, N - 1]
+    edges = torch.nan_to_num(torch.nanmean(pair_edges, dim=-1), nan=0)
+    return edges.transpose(1, 2)
+
+
 def _dist(X, mask, eps=1E-6, top_k=48):
     """ProteinMPNN distance calculation"""
     mask_2D = torch.unsqueeze(mask, 1) * torch.unsqueeze(mask, 2)
@@ -58,6 +87,12 @@ def _check_sequence_match(S, wt, mut, pos):
     return S
 
 
+def _expand_structures(struct_idx, *tensors):
+    """Gathers per-structure tensors (or lists of tensors) to one row per mutation. None entries are kept."""
+    return [[t[struct_idx] for t in x] if isinstance(x, list) else None if x is None else x[struct_idx]
+            for x in tensors]
+
+
 class TransferModelv2(nn.Module):
     """Rewritten TransferModel class using Batched datasets for faster training"""
 
@@ -125,6 +160,16 @@ class TransferModelv2(nn.Module):
             self.ddg_out.append(nn.ReLU())
             self.ddg_out.append(nn.Linear(sz1, sz2))
 
+    def _embed(self, X, S, mask, chain_M, residue_idx, chain_encoding_all):
+        """ProteinMPNN hidden states, sequence and edge embeddings (sequence logits are skipped when supported)"""
+        if hasattr(self.prot_mpnn, 'embed'):
+            all_mpnn_hid, mpnn_embed, mpnn_edges, _ = self.prot_mpnn.embed(
+                X, S, mask, chain_M, residue_idx, chain_encoding_all)
+        else:  # side chain aware ProteinMPNN variants only provide the full forward pass
+            all_mpnn_hid, mpnn_embed, _, mpnn_edges = self.prot_mpnn(
+                X, S, mask, chain_M, residue_idx, chain_encoding_all)
+        return all_mpnn_hid, mpnn_embed, mpnn_edges
+
     def forward(
             self,
             X,
@@ -138,22 +183,37 @@ class TransferModelv2(nn.Module):
             mut_mutant_AAs,
             mut_ddGs,
             atom_mask,
-            esm_emb=None):
-        """Vectorized fwd function for arbitrary batches of mutations"""
+            esm_emb=None,
+            struct_idx=None,
+            embeddings=None):
+        """Vectorized fwd function for arbitrary batches of mutations
+
+        With struct_idx (see tied_featurize_mut_dedup), the structure inputs hold one row per unique structure
+        and are encoded once, then gathered to one row per mutation.
+        embeddings are precomputed (all_mpnn_hid, mpnn_embed, mpnn_edges) of those rows (see EmbeddingCache),
+        in which case ProteinMPNN is skipped.
+        """
 
         # getting ProteinMPNN embeddings (use only backbone atoms)
-        if self.multi_mutations:
+        if self.multi_mutations and struct_idx is None:
             # check if S matches mut_wildtype_AAs - if not, overwrite it
             S = _check_sequence_match(S, mut_wildtype_AAs, mut_mutant_AAs, mut_positions)
 
         X = torch.nan_to_num(X, nan=0.0)
-        if self.cfg.model.side_chain_module:
-            all_mpnn_hid, mpnn_embed, _, mpnn_edges = self.prot_mpnn(
+        if embeddings is not None:
+            all_mpnn_hid, mpnn_embed, mpnn_edges = embeddings
+        elif self.cfg.model.side_chain_module:
+            all_mpnn_hid, mpnn_embed, mpnn_edges = self._embed(
                 X[:, :, :4, :], S, mask, chain_M, residue_idx, chain_encoding_all)
         else:
-            all_mpnn_hid, mpnn_embed, _, mpnn_edges = self.prot_mpnn(
+            all_mpnn_hid, mpnn_embed, mpnn_edges = self._embed(
                 X, S, mask, chain_M, residue_idx, chain_encoding_all)
 
+        if struct_idx is not None:
+            all_mpnn_hid, mpnn_embed, mpnn_edges, X, S, mask, chain_M, residue_idx, chain_encoding_all, atom_mask = \
+                _expand_structures(struct_idx, all_mpnn_hid, mpnn_embed, mpnn_edges, X, S, mask, chain_M,
+                                   residue_idx, chain_encoding_all, atom_mask)
+
         if self.cfg.model.dist:
             X = _get_cbeta(X)
 
@@ -179,41 +239,7 @@ class TransferModelv2(nn.Module):
                     # E_idx is [B, K, L] and is a tensor of indices in X that should match neighbors
                     D_n, E_idx = _dist(X[:, :, 1, :], mask)
 
-                    all_mpnn_edges = []
-                    n_mutations = [a for a in range(mut_positions.shape[-1])]
-                    for n_current in n_mutations:  # iterate over N-order mutations
-
-                        # select the edges at the current mutated positions
-                        mpnn_edges_tmp = torch.squeeze(batched_index_select(
-                            mpnn_edges, 1, mut_positions[:, n_current:n_current + 1]), 1)
-                        E_idx_tmp = torch.squeeze(batched_index_select(
-                            E_idx, 1, mut_positions[:, n_current:n_current + 1]), 1)
-
-                        # find matches for each position in the array of neighbors, grab edges, and add to list
-                        edges = []
-                        for b in range(E_idx_tmp.shape[0]):
-                            # iterate over all neighbors for each sample
-                            n_other = [a for a in n_mutations if a != n_current]
-                            tmp_edges = []
-                            for n_o in n_other:
-                                idx = torch.where(E_idx_tmp[b, :] == mut_positions[b,
-                                                  n_o:n_o + 1].expand(1, E_idx_tmp.shape[-1]))
-                                if len(idx[0]) == 0:  # if no edge exists, fill with empty edge for now
-                                    edge = torch.full([mpnn_edges_tmp.shape[-1]], torch.nan, device=E_idx.device)
-                                else:
-                                    edge = mpnn_edges_tmp[b, idx[1][0], :]
-                                tmp_edges.append(edge)
-
-                            # aggregate when multiple edges are returned (take mean of valid edges)
-                            tmp_edges = torch.stack(tmp_edges, dim=-1)
-                            edge = torch.nanmean(tmp_edges, dim=-1)
-                            edge = torch.nan_to_num(edge, nan=0)
-                            edges.append(edge)
-
-                        edges_compiled = torch.stack(edges, dim=0)
-                        all_mpnn_edges.append(edges_compiled)
-
-                    mpnn_edges = torch.stack(all_mpnn_edges, dim=-1)  # shape: (Batch, Embed, N_muts)
+                    mpnn_edges = gather_pair_edges(mpnn_edges, E_idx, mut_positions)  # shape: (Batch, Embed, N_muts)
 
                 elif self.cfg.model.dist:
                     # X is coord matrix of size [B, L, 5, 3]
@@ -469,15 +495,26 @@ class TransferModelv2Siamese(nn.Module):
             mut_mutant_AAs,
             mut_ddGs,
             atom_mask,
-            esm_emb=None):
-        """Vectorized fwd function for arbitrary batches of mutations"""
+            esm_emb=None,
+            struct_idx=None,
+            embeddings=None):
+        """Vectorized fwd function for arbitrary batches of mutations (struct_idx, embeddings as in TransferModelv2)"""
 
-        # check if S matches mut_wildtype_AAs - if not, overwrite it
-        S = _check_sequence_match(S, mut_wildtype_AAs, mut_mutant_AAs, mut_positions)
+        # check if S matches mut_wildtype_AAs - if not, overwrite it (already done by the deduplicating collate)
+        if struct_idx is None:
+            S = _check_sequence_match(S, mut_wildtype_AAs, mut_mutant_AAs, mut_positions)
 
         # get MPNN embeddings
         X = torch.nan_to_num(X, nan=0.0)
-        all_mpnn_hid, wt_embed, _, mpnn_edges = self.prot_mpnn(X, S, mask, chain_M, residue_idx, chain_encoding_all)
+        if embeddings is not None:
+            all_mpnn_hid, wt_embed, mpnn_edges = embeddings
+        else:
+            all_mpnn_hid, wt_embed, mpnn_edges, _ = self.prot_mpnn.embed(
+                X, S, mask, chain_M, residue_idx, chain_encoding_all)
+
+        if struct_idx is not None:
+            all_mpnn_hid, wt_embed, mpnn_edges, X, mask = _expand_structures(
+                struct_idx, all_mpnn_hid, wt_embed, mpnn_edges, X, mask)
 
         assert self.cfg.model.num_final_layers > 0
         all_mpnn_hid = torch.cat(all_mpnn_hid[:self.cfg.model.num_final_layers], -1)  # [B, L, Embed * N]
@@ -496,46 +533,7 @@ class TransferModelv2Siamese(nn.Module):
             # E_idx is [B, K, L] and is a tensor of indices in X that should match neighbors of each residue
             D_n, E_idx = _dist(X[:, :, 1, :], mask)
 
-            all_mpnn_edges = []
-            n_mutations = [a for a in range(mut_positions.shape[-1])]
-            for n_current in n_mutations:  # iterate over N-order mutations
-
-                # select the edges at the current mutated positions
-                mpnn_edges_tmp = torch.squeeze(batched_index_select(
-                    mpnn_edges, 1, mut_positions[:, n_current:n_current + 1]), 1)
-                E_idx_tmp = torch.squeeze(batched_index_select(E_idx, 1, mut_positions[:, n_current:n_current + 1]), 1)
-
-                # find matches for each position in the array of neighbors, grab edges, and add to list
-                edges = []
-                for b in range(E_idx_tmp.shape[0]):
-                    # iterate over all neighbors for each sample
-                    n_other = [a for a in n_mutations if a != n_current]
-                    tmp_edges = []
-                    for n_o in n_other:
-                        idx = torch.where(E_idx_tmp[b, :] == mut_positions[b,
-                                          n_o:n_o + 1].expand(1, E_idx_tmp.shape[-1]))
-                        if len(idx[0]) == 0:  # if no edge exists, fill with empty edge for now
-                            edge = torch.full([mpnn_edges_tmp.shape[-1]], torch.nan, device=E_idx.device)
-                        else:
-                            edge = mpnn_edges_tmp[b, idx[1][0], :]
-                        tmp_edges.append(edge)
-
-                    # impute an empty edge if no neighbors exist
-                    try:
-                        tmp_edges = torch.stack(tmp_edges, dim=-1)
-                    except RuntimeError:  # if no neighbors exist, impute an empty edge
-                        edge_shape = [self.HIDDEN_DIM, 1]
-                        tmp_edges = torch.zeros(edge_shape, dtype=torch.float32, device=E_idx.device)
-
-                    # aggregate when multiple edges are returned (take mean of valid edges)
-                    edge = torch.nanmean(tmp_edges, dim=-1)
-                    edge = torch.nan_to_num(edge, nan=0)
-                    edges.append(edge)
-
-                edges_compiled = torch.stack(edges, dim=0)
-                all_mpnn_edges.append(edges_compiled)
-
-            mpnn_edges = torch.stack(all_mpnn_edges, dim=-1)  # shape: (Batch, Embed, N_muts)
+            mpnn_edges = gather_pair_edges(mpnn_edges, E_idx, mut_positions)  # shape: (Batch, Embed, N_muts)
 
         # gather final representation from seq and structure embeddings
         final_embed = []
@@ -631,3 +629,62 @@ class TransferModelv2Siamese(nn.Module):
         VOCAB_DIM = 441 if not self.cfg.model.single_target else 1
 
         return HIDDEN_DIM, EMBED_DIM, VOCAB_DIM
+
+
+class _Apply(nn.Module):
+    """Runs fn(model, *args) as a module forward, so that torch.func.functional_call can swap the model weights"""
+
+    def __init__(self, model, fn):
+        super().__init__()
+        self.model = model
+        self.fn = fn
+
+    def forward(self, *args):
+        return self.fn(self.model, *args)
+
+
+class ModelEnsemble(nn.Module):
+    """Ensemble of ThermoMPNN models (same architecture) that share a frozen ProteinMPNN encoder.
+
+    The encoder runs once and members(fn, *args) evaluates a head function fn(model, *args) for all members in one
+    vmapped call over the stacked head weights, returning the outputs stacked along a leading member dimension.
+    The head weights are stacked once per device, so members must not be modified afterwards.
+    """
+
+    def __init__(self, models):
+        super().__init__()
+        shared = models[0].prot_mpnn.state_dict()
+        for model in models[1:]:
+            other = model.prot_mpnn.state_dict()
+            if other.keys() != shared.keys() or any(not torch.equal(shared[k], other[k]) for k in shared):
+                raise ValueError('Ensemble members must share the same ProteinMPNN weights')
+            model.prot_mpnn = models[0].prot_mpnn
+        self.models = nn.ModuleList(models)
+        self.cfg = models[0].cfg
+        self._stacked = {}
+
+    @property
+    def prot_mpnn(self):
+        return self.models[0].prot_mpnn
+
+    def __len__(self):
+        return len(self.models)
+
+    def _head_weights(self):
+        device = next(self.models[0].parameters()).device
+        if device not in self._stacked:
+            head_weights = [
+                {f'model.{k}': v.detach() for k, v in list(m.named_parameters()) + list(m.named_buffers())
+                 if not k.startswith('prot_mpnn.')}
+                for m in self.models
+            ]
+            self._stacked = {device: {k: torch.stack([w[k] for w in head_weights]) for k in head_weights[0]}}
+        return self._stacked[device]
+
+    def members(self, fn, *args, in_dims=None):
+        """fn(model, *args) of every member. in_dims marks args that are already stacked per member (0) or shared
+        (None, the default for all args)."""
+        in_dims = (None,) * len(args) if in_dims is None else tuple(in_dims)
+        apply = _Apply(self.models[0], fn)
+        return vmap(lambda weights, *a: functional_call(apply, weights, a), in_dims=(0,) + in_dims)(
+            self._head_weights(), *args)
@@ -0,0 +1,322 @@
+import re
+from collections.abc import MutableMapping
+from copy import deepcopy
+
+import numpy as np
+
+# Single-pass PDB reader shared by parse_PDB, alt_parse_PDB and custom_parse_PDB.
+# The file is read once and split by chain; per-chain arrays are built on request.
+
+ALPHA_1 = "ARNDCQEGHILKMFPSTWYV-"
+ALPHA_3 = ['ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'GLN', 'GLU', 'GLY', 'HIS', 'ILE',
+           'LEU', 'LYS', 'MET', 'PHE', 'PRO', 'SER', 'THR', 'TRP', 'TYR', 'VAL', 'GAP']
+AA_3_TO_1 = {b: a for a, b in zip(ALPHA_1, ALPHA_3)}
+
+CHAIN_ALPHABET = list("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz") + [str(item) for item in range(300)]
+
+BACKBONE_ATOMS = ["N", "CA", "C", "O"]
+ALL_ATOMS = ["N", "CA", "C", "O", "CB",
+             "CG", "CG1", "OG1", "OG2", "CG2", "OG", "SG",
+             "CD", "SD", "CD1", "ND1", "CD2", "OD1", "OD2", "ND2",
+             "CE", "CE1", "NE1", "OE1", "NE2", "OE2", "NE", "CE2", "CE3",
+             "NZ", "CZ", "CZ2", "CZ3", "CH2", "OH", "NH1", "NH2"]
+
+# residue renames applied to ATOM records by the SSM parser (HETATM MSE is always read as MET)
+SSM_RESIDUE_MAP = {"MSE": "MET", "SEC": "CYS"}
+
+
+class ChainRecords:
+    """ATOM records of a single chain. Only the first occurrence of each residue / atom is kept."""
+
+    __slots__ = ("residues", "events", "seen", "last_resn", "current")
+
+    def __init__(self):
+        self.residues = {}  # resn -> {insertion code: (resi, {atom: coordinate columns})}
+        self.events = []  # (raw resn, raw resn of the previous ATOM line) for every new raw resn
+        self.seen = set()
+        self.last_resn = None
+        self.current = None
+
+
+def read_pdb_chains(path, split_chains=True):
+    """Reads a PDB file once and groups its ATOM records by chain id.
+
+    Chains are returned in order of first appearance. Chains made only of HETATM records are kept (without
+    residues) so that the keys list every chain in the file. With split_chains=False all records are
+    grouped under a single None key.
+    """
+    chains = {}
+    for line in open(path, "rb"):
+        line = line.decode("utf-8", "ignore").rstrip()
+
+        ch = line[21:22] if split_chains else None
+        if line[:6] == "HETATM":
+            if line[17:20] != "MSE":
+                if ch not in chains:
+                    chains[ch] = ChainRecords()
+                continue
+            resi = "MET"
+        elif line[:4] == "ATOM":
+            resi = line[17:20]
+        else:
+            continue
+
+        rec = chains.get(ch)
+        if rec is None:
+            rec = chains[ch] = ChainRecords()
+
+        raw = line[22:27].strip()
+        if raw != rec.last_resn:
+            if raw not in rec.seen:
+                rec.seen.add(raw)
+                rec.events.append((raw, rec.last_resn))
+            if raw[-1].isalpha():
+                resa, resn = raw[-1], int(raw[:-1]) - 1
+            else:
+                resa, resn = "", int(raw) - 1
+            group = rec.residues.setdefault(resn, {})
+            if resa not in group:
+                group[resa] = (resi, {})
+            rec.current = group[resa][1]
+            rec.last_resn = raw
+
+        atom = line[12:16].strip()
+        if atom not in rec.current:
+            rec.current[atom] = line[30:54]
+    return chains
+
+
+def _gap_filled_resn_list(events):
+    """Replays the residue-number gap filling of the SSM parser on the first occurrence of each raw resn"""
+    resn_list, seen = [], set()
+    for raw, prior in events:
+        if raw not in seen and resn_list:
+            _, num, _ = re.split(r"(\d+)", raw)
+            _, num_prior, _ = re.split(r"(\d+)", prior)
+            for g in range(int(num) - int(num_prior)):
+                filled = str(int(num_prior) + g)
+                if filled not in seen:
+                    seen.add(filled)
+                    resn_list.append(filled)
+        if raw not in seen:
+            seen.add(raw)
+            resn_list.append(raw)
+    return resn_list
+
+
+def chain_arrays(rec, atoms, residue_map=None, resn_mode=None):
+    """Converts the records of one chain to (xyz [L, atoms, 3], seq, resn_list).
+
+    Residue numbers missing between the first and last residue are filled with gaps (NaN coordinates, '-').
+    resn_mode selects the residue numbering that is returned: None, 'unique' (raw PDB numbers in order of
+    appearance, as alt_parse_PDB) or 'gapfill' (as custom_parse_PDB). Returns None for chains without residues.
+    """
+    if rec is None or not rec.residues:
+        return None
+    residue_map = residue_map or {}
+
+    rows = []
+    for resn in range(min(rec.residues), max(rec.residues) + 1):
+        group = rec.residues.get(resn)
+        if group is None:
+            rows.append(None)
+        else:
+            rows.extend(group[k] for k in sorted(group))
+
+    atom_index = {atom: i for i, atom in enumerate(atoms)}
+    xyz = np.full((len(rows), len(atoms), 3), np.nan)
+    seq, res_idx, atom_idx, coords = [], [], [], []
+    for r, row in enumerate(rows):
+        if row is None:
+            seq.append("-")
+            continue
+        resi, atom_coords = row
+        seq.append(AA_3_TO_1.get(residue_map.get(resi, resi), "-"))
+        for atom, text in atom_coords.items():
+            a = atom_index.get(atom)
+            if a is not None:
+                res_idx.append(r)
+                atom_idx.append(a)
+                coords.append((float(text[0:8]), float(text[8:16]), float(text[16:24])))
+    if coords:
+        xyz[res_idx, atom_idx] = coords
+
+    if resn_mode == 'unique':
+        resn_list = [raw for raw, _ in rec.events]
+    elif resn_mode == 'gapfill':
+        resn_list = _gap_filled_resn_list(rec.events)
+    else:
+        resn_list = None
+    return xyz, "".join(seq), resn_list
+
+
+PRECISE_ATOMS = ("CA", "SG")  # also kept in float64, so CA contacts and disulfides use the parsed coordinates
+SEQ_ALPHABET = "ACDEFGHIKLMNPQRSTVWYX"
+_SEQ_INDEX = np.full(256, -1, dtype=np.int32)
+_SEQ_INDEX[np.frombuffer(SEQ_ALPHABET.encode(), np.uint8)] = np.arange(len(SEQ_ALPHABET))
+_SEQ_INDEX[ord("-")] = SEQ_ALPHABET.index("X")  # gaps are featurized as X
+
+
+def encode_sequence(seq):
+    """Indices of seq in SEQ_ALPHABET (the ProteinMPNN alphabet), gaps ('-') as X"""
+    idx = _SEQ_INDEX[np.frombuffer(seq.encode("ascii", "replace"), np.uint8)]
+    if (idx < 0).any():
+        raise ValueError(f"Unknown residue in sequence: {seq[int(np.argmax(idx < 0))]}")
+    return idx
+
+
+class Structure(MutableMapping):
+    """Parsed structure held in contiguous arrays, returned by parse_PDB, alt_parse_PDB and load_pdb.
+
+    xyz [L, atoms, 3] (float32) holds the coordinates of all chains, in the order of atom_names, with NaN for missing
+    atoms (atom_mask [L, atoms] is True for present atoms). The PRECISE_ATOMS columns are also kept as parsed (float64),
+    see atoms. Chain i spans residues chain_starts[i]:chain_starts[i + 1]
+    and seq_idx [L] is the concatenated chain sequence as SEQ_ALPHABET indices.
+
+    The structure can also be used as the parsed PDB dict: seq_chain_<c>, coords_chain_<c> (a dict of per-atom
+    coordinate views), resn_list_<c> (if parsed with residue numbers), name, num_of_chains and seq. Sequences and any
+    other keys (e.g. mutation) can be set; the coordinates are read-only, so copies share them.
+    """
+
+    __slots__ = ("name", "chains", "chain_starts", "xyz", "atom_names", "atom_mask", "seq_idx", "_seq", "_chain_seqs",
+                 "_resn_lists", "_extra", "_precise")
+
+    def __init__(self, name, chains, xyz_list, seq_list, atom_names, resn_lists=None):
+        self.name = name
+        self.chains = list(chains)
+        self.chain_starts = np.cumsum([0] + [len(s) for s in seq_list])
+        self.xyz = np.concatenate(xyz_list, 0, dtype=np.float32) if xyz_list else np.zeros((0, len(atom_names), 3),
+                                                                                           np.float32)
+        self.xyz.flags.writeable = False
+        self.atom_names = list(atom_names)
+        self._precise = {}
+        for atom in PRECISE_ATOMS:
+            if atom in self.atom_names:
+                i = self.atom_names.index(atom)
+                xyz = np.concatenate([x[:, i] for x in xyz_list], 0, dtype=np.float64) if xyz_list else np.zeros((0, 3))
+                xyz.flags.writeable = False
+                self._precise[atom] = xyz
+        self.atom_mask = np.isfinite(self.xyz).all(-1)
+        self.atom_mask.flags.writeable = False
+        self._chain_seqs = dict(zip(self.chains, seq_list))
+        self._seq = "".join(seq_list)
+        self.seq_idx = encode_sequence(self._seq)
+        self._resn_lists = None if resn_lists is None else dict(zip(self.chains, resn_lists))
+        self._extra = {}
+
+    def chain_slice(self, letter):
+        i = self.chains.index(letter)
+        return slice(int(self.chain_starts[i]), int(self.chain_starts[i + 1]))
+
+    def atoms(self, atom, precise=False):
+        """[L, 3] coordinates of one atom over all chains (a view of xyz), as parsed (float64) with precise for the
+        PRECISE_ATOMS"""
+        if precise:
+            return self._precise[atom]
+        return self.xyz[:, self.atom_names.index(atom)]
+
+    def chain_xyz(self, letter, atoms=None):
+        """[chain length, atoms, 3] coordinates of one chain, all atoms by default (a view for consecutive atoms)"""
+        xyz = self.xyz[self.chain_slice(letter)]
+        if atoms is None:
+            return xyz
+        idx = [self.atom_names.index(a) for a in atoms]
+        if idx == list(range(idx[0], idx[0] + len(idx))):
+            return xyz[:, idx[0]:idx[0] + len(idx)]
+        return xyz[:, idx]
+
+    def _coords_dict(self, letter):
+        xyz = self.chain_xyz(letter)
+        if self.atom_names == ["CA"]:  # CA-only structures keep the [L, 1, 3] layout
+            return {f"CA_chain_{letter}": xyz}
+        return {f"{atom}_chain_{letter}": xyz[:, i] for i, atom in enumerate(self.atom_names)}
+
+    def _set_chain_seq(self, letter, seq):
+        chain = self.chain_slice(letter)
+        if len(seq) != chain.stop - chain.start:
+            raise ValueError(f"Sequence of chain {letter} has {len(seq)} residues, expected {chain.stop - chain.start}")
+        self._chain_seqs[letter] = seq
+        seq_idx = self.seq_idx.copy()  # copies may share the previous array
+        seq_idx[chain] = encode_sequence(seq)
+        self.seq_idx = seq_idx
+
+    def __getitem__(self, key):
+        if key in self._extra:
+            return self._extra[key]
+        if key == "name":
+            return self.name
+        if key == "num_of_chains":
+            return len(self.chains)
+        if key == "seq":
+            return self._seq
+        prefix, _, letter = key.rpartition("_")
+        if letter in self._chain_seqs:
+            if prefix == "seq_chain":
+                return self._chain_seqs[letter]
+            if prefix == "coords_chain":
+                return self._coords_dict(letter)
+            if prefix == "resn_list" and self._resn_lists is not None:
+                return self._resn_lists[letter]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == "seq":
+            self._seq = value
+        elif key == "name":
+            self.name = value
+        elif key.startswith("seq_chain_") and key[len("seq_chain_"):] in self._chain_seqs:
+            self._set_chain_seq(key[len("seq_chain_"):], value)
+        elif key == "num_of_chains" or key in self._core_keys():
+            raise ValueError(f"{key} of a parsed structure is read-only")
+        else:
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._extra:
+            del self._extra[key]
+        elif key in self:
+            raise ValueError(f"{key} of a parsed structure cannot be deleted")
+        else:
+            raise KeyError(key)
+
+    def _core_keys(self):
+        keys = []
+        for letter in self.chains:
+            if self._resn_lists is not None:
+                keys.append(f"resn_list_{letter}")
+            keys += [f"seq_chain_{letter}", f"coords_chain_{letter}"]
+        return keys + ["name", "num_of_chains", "seq"]
+
+    def __iter__(self):
+        yield from self._core_keys()
+        yield from list(self._extra)
+
+    def __len__(self):
+        return len(self._core_keys()) + len(self._extra)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __copy__(self):
+        new = Structure.__new__(Structure)
+        for slot in Structure.__slots__:
+            setattr(new, slot, getattr(self, slot))
+        new._chain_seqs = dict(self._chain_seqs)
+        new._extra = dict(self._extra)
+        return new
+
+    def __deepcopy__(self, memo):
+        # coordinates, masks and seq_idx are never modified in place, so the copy shares them
+        new = self.__copy__()
+        if self._resn_lists is not None:
+            new._resn_lists = {k: list(v) for k, v in self._resn_lists.items()}
+        new._extra = deepcopy(self._extra, memo)
+        return new
+
+    def __repr__(self):
+        return (f"Structure(name={self.name!r}, chains={self.chains}, length={self.xyz.shape[0]}, "
+                f"atoms={self.atom_names})")
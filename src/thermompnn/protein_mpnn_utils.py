@@ -7,6 +7,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from thermompnn.pdb_utils import (ALL_ATOMS, BACKBONE_ATOMS, CHAIN_ALPHABET,
+                                  Structure, chain_arrays, read_pdb_chains)
 from thermompnn.proteinmpnn.model_utils import IPMPDecoder, IPMPEncoder
 
 # A number of functions/classes are adopted from: https://github.com/jingraham/neurips19-graph-protein-design
@@ -32,167 +34,74 @@ def _S_to_seq(S, mask):
 def collapse_side_chains(xyz):
     """Takes raw input coordinates [L, 37, 3] and converts to standard [L, 14, 3] format"""
     # mask out nan values
-    exist = ~np.isnan(xyz)
-    new_xyz = np.zeros((xyz.shape[0], 14, xyz.shape[-1]))
-    # collect nonzero coordinates from mask into new padded sca array
-    for i in range(xyz.shape[0]):
-        idx = 0
-        for j in range(xyz.shape[1]):
-            if exist[i, j, 0]:
-                new_xyz[i, idx, :] = xyz[i, j, :]
-                idx += 1
+    exist = ~np.isnan(xyz[..., 0])
+    # move existing atoms to the front (keeping their order) and collect them into the padded sca array
+    order = np.argsort(~exist, axis=1, kind='stable')[:, :14]
+    new_xyz = np.take_along_axis(xyz, order[..., None], axis=1)
+    new_xyz[~np.take_along_axis(exist, order, axis=1)] = 0
     new_xyz[new_xyz == 0] = np.nan
     return new_xyz
 
 
+def _get_parse_atoms(ca_only, side_chains):
+    if ca_only:
+        return ['CA']
+    elif side_chains:
+        return ALL_ATOMS
+    return BACKBONE_ATOMS
+
+
+SIDE_CHAIN_ATOMS = ["N", "CA", "C", "O", "SC1", "SC2", "SC3", "SC4", "SC5", "SC6", "SC7", "SC8", "SC9", "SC10"]
+
+
+def _get_structure_atoms(ca_only, side_chains):
+    """Atom names stored in the parsed Structure"""
+    if ca_only:
+        return ['CA']
+    elif side_chains:  # auto-load all atoms
+        return SIDE_CHAIN_ATOMS
+    return BACKBONE_ATOMS
+
+
 def parse_PDB_biounits(x, atoms=['N', 'CA', 'C'], chain=None):
     '''
   input:  x = PDB filename
           atoms = atoms to extract (optional)
   output: (length, atoms, coords=(x,y,z)), sequence
   '''
-
-    alpha_1 = list("ARNDCQEGHILKMFPSTWYV-")
-    states = len(alpha_1)
-    alpha_3 = ['ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'GLN', 'GLU', 'GLY', 'HIS', 'ILE',
-               'LEU', 'LYS', 'MET', 'PHE', 'PRO', 'SER', 'THR', 'TRP', 'TYR', 'VAL', 'GAP']
-
-    aa_1_N = {a: n for n, a in enumerate(alpha_1)}
-    aa_3_N = {a: n for n, a in enumerate(alpha_3)}
-    aa_N_1 = {n: a for n, a in enumerate(alpha_1)}
-    aa_1_3 = {a: b for a, b in zip(alpha_1, alpha_3)}
-    aa_3_1 = {b: a for a, b in zip(alpha_1, alpha_3)}
-
-    def AA_to_N(x):
-        # ["ARND"] -> [[0,1,2,3]]
-        x = np.array(x)
-        if x.ndim == 0:
-            x = x[None]
-        return [[aa_1_N.get(a, states - 1) for a in y] for y in x]
-
-    def N_to_AA(x):
-        # [[0,1,2,3]] -> ["ARND"]
-        x = np.array(x)
-        if x.ndim == 1:
-            x = x[None]
-        return ["".join([aa_N_1.get(a, "-") for a in y]) for y in x]
-
-    xyz, seq, min_resn, max_resn = {}, {}, 1e6, -1e6
-    for line in open(x, "rb"):
-        line = line.decode("utf-8", "ignore").rstrip()
-
-        if line[:6] == "HETATM" and line[17:17 + 3] == "MSE":
-            line = line.replace("HETATM", "ATOM  ")
-            line = line.replace("MSE", "MET")
-
-        if line[:4] == "ATOM":
-            ch = line[21:22]
-            if ch == chain or chain is None:
-                atom = line[12:12 + 4].strip()
-                resi = line[17:17 + 3]
-                resn = line[22:22 + 5].strip()
-                x, y, z = (float(line[i:(i + 8)]) for i in [30, 38, 46])
-
-                if resn[-1].isalpha():
-                    resa, resn = resn[-1], int(resn[:-1]) - 1
-                else:
-                    resa, resn = "", int(resn) - 1
-                if resn < min_resn:
-                    min_resn = resn
-                if resn > max_resn:
-                    max_resn = resn
-                if resn not in xyz:
-                    xyz[resn] = {}
-                if resa not in xyz[resn]:
-                    xyz[resn][resa] = {}
-                if resn not in seq:
-                    seq[resn] = {}
-                if resa not in seq[resn]:
-                    seq[resn][resa] = resi
-
-                if atom not in xyz[resn][resa]:
-                    xyz[resn][resa][atom] = np.array([x, y, z])
-
-    # convert to numpy arrays, fill in missing values
-    seq_, xyz_ = [], []
-    try:
-        for resn in range(min_resn, max_resn + 1):
-            if resn in seq:
-                for k in sorted(seq[resn]):
-                    seq_.append(aa_3_N.get(seq[resn][k], 20))
-            else:
-                seq_.append(20)
-            if resn in xyz:
-                for k in sorted(xyz[resn]):
-                    for atom in atoms:
-                        if atom in xyz[resn][k]:
-                            xyz_.append(xyz[resn][k][atom])
-                        else:
-                            xyz_.append(np.full(3, np.nan))
-            else:
-                for atom in atoms:
-                    xyz_.append(np.full(3, np.nan))
-        return np.array(xyz_).reshape(-1, len(atoms), 3), N_to_AA(np.array(seq_))
-    except TypeError:
+    parsed = chain_arrays(read_pdb_chains(x, split_chains=chain is not None).get(chain), atoms)
+    if parsed is None:
         return 'no_chain', 'no_chain'
+    xyz, seq, _ = parsed
+    return xyz, [seq]
 
 
 def parse_PDB(path_to_pdb, input_chain_list=None, ca_only=False, side_chains=False):
     c = 0
     pdb_dict_list = []
-    init_alphabet = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M', 'N', 'O', 'P', 'Q', 'R', 'S', 'T',
-                     'U', 'V', 'W', 'X', 'Y', 'Z', 'a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k', 'l', 'm', 'n',
-                     'o', 'p', 'q', 'r', 's', 't', 'u', 'v', 'w', 'x', 'y', 'z']
-    extra_alphabet = [str(item) for item in list(np.arange(300))]
-    chain_alphabet = init_alphabet + extra_alphabet
+    chain_alphabet = CHAIN_ALPHABET
 
     if input_chain_list:
         chain_alphabet = input_chain_list
 
+    sidechain_atoms = _get_parse_atoms(ca_only, side_chains)
     biounit_names = [path_to_pdb]
     for biounit in biounit_names:
-        my_dict = {}
-        s = 0
-        concat_seq = ''
+        # read the file once and pull every chain out of the same records
+        chains = read_pdb_chains(biounit)
+        letters, xyz_list, seq_list = [], [], []
         for letter in chain_alphabet:
-            if ca_only:
-                sidechain_atoms = ['CA']
-            elif side_chains:
-                sidechain_atoms = ["N", "CA", "C", "O", "CB",
-                                   "CG", "CG1", "OG1", "OG2", "CG2", "OG", "SG",
-                                   "CD", "SD", "CD1", "ND1", "CD2", "OD1", "OD2", "ND2",
-                                   "CE", "CE1", "NE1", "OE1", "NE2", "OE2", "NE", "CE2", "CE3",
-                                   "NZ", "CZ", "CZ2", "CZ3", "CH2", "OH", "NH1", "NH2"]
-            else:
-                sidechain_atoms = ['N', 'CA', 'C', 'O']
-            xyz, seq = parse_PDB_biounits(biounit, atoms=sidechain_atoms, chain=letter)
+            parsed = chain_arrays(chains.get(letter), sidechain_atoms)
 
-            if not isinstance(xyz, str):
-                concat_seq += seq[0]
-                my_dict['seq_chain_' + letter] = seq[0]
-                coords_dict_chain = {}
-                if ca_only:
-                    coords_dict_chain['CA_chain_' + letter] = xyz.tolist()
-                elif side_chains:  # auto-load all atoms
-                    xyz = collapse_side_chains(xyz)
-                    sc_atoms = ["N", "CA", "C", "O",
-                                "SC1", "SC2", "SC3", "SC4",
-                                "SC5", "SC6", "SC7", "SC8",
-                                "SC9", "SC10"]
-                    for sc_idx, sca in enumerate(sc_atoms):
-                        coords_dict_chain[f'{sca}_chain_{letter}'] = xyz[:, sc_idx, :].tolist()
-                else:
-                    # TODO henry load variable coord dict sets
-                    coords_dict_chain['N_chain_' + letter] = xyz[:, 0, :].tolist()
-                    coords_dict_chain['CA_chain_' + letter] = xyz[:, 1, :].tolist()
-                    coords_dict_chain['C_chain_' + letter] = xyz[:, 2, :].tolist()
-                    coords_dict_chain['O_chain_' + letter] = xyz[:, 3, :].tolist()
-                my_dict['coords_chain_' + letter] = coords_dict_chain
-                s += 1
+            if parsed is not None:
+                xyz, seq, _ = parsed
+                letters.append(letter)
+                xyz_list.append(collapse_side_chains(xyz) if side_chains and not ca_only else xyz)
+                seq_list.append(seq)
         fi = biounit.rfind("/")
-        my_dict['name'] = biounit[(fi + 1):-4]
-        my_dict['num_of_chains'] = s
-        my_dict['seq'] = concat_seq
+        my_dict = Structure(biounit[(fi + 1):-4], letters, xyz_list, seq_list,
+                            _get_structure_atoms(ca_only, side_chains))
+        s = len(letters)
         if s <= len(chain_alphabet):
             pdb_dict_list.append(my_dict)
             c += 1
@@ -203,167 +112,43 @@ def alt_parse_PDB_biounits(x, atoms=['N', 'CA', 'C'], chain=None):
     '''
   input:  x = PDB filename
           atoms = atoms to extract (optional)
-  output: (length, atoms, coords=(x,y,z)), sequence
+  output: (length, atoms, coords=(x,y,z)), sequence, raw residue numbers (with insertion codes)
   '''
-
-    alpha_1 = list("ARNDCQEGHILKMFPSTWYV-")
-    states = len(alpha_1)
-    alpha_3 = ['ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'GLN', 'GLU', 'GLY', 'HIS', 'ILE',
-               'LEU', 'LYS', 'MET', 'PHE', 'PRO', 'SER', 'THR', 'TRP', 'TYR', 'VAL', 'GAP']
-
-    aa_1_N = {a: n for n, a in enumerate(alpha_1)}
-    aa_3_N = {a: n for n, a in enumerate(alpha_3)}
-    aa_N_1 = {n: a for n, a in enumerate(alpha_1)}
-    aa_1_3 = {a: b for a, b in zip(alpha_1, alpha_3)}
-    aa_3_1 = {b: a for a, b in zip(alpha_1, alpha_3)}
-
-    def AA_to_N(x):
-        # ["ARND"] -> [[0,1,2,3]]
-        x = np.array(x)
-        if x.ndim == 0:
-            x = x[None]
-        return [[aa_1_N.get(a, states - 1) for a in y] for y in x]
-
-    def N_to_AA(x):
-        # [[0,1,2,3]] -> ["ARND"]
-        x = np.array(x)
-        if x.ndim == 1:
-            x = x[None]
-        return ["".join([aa_N_1.get(a, "-") for a in y]) for y in x]
-
-    xyz, seq, min_resn, max_resn = {}, {}, 1e6, -1e6
-    resn_list = []
-    for line in open(x, "rb"):
-        line = line.decode("utf-8", "ignore").rstrip()
-
-        if line[:6] == "HETATM" and line[17:17 + 3] == "MSE":
-            line = line.replace("HETATM", "ATOM  ")
-            line = line.replace("MSE", "MET")
-
-        if line[:4] == "ATOM":
-            ch = line[21:22]
-            if ch == chain or chain is None:
-                atom = line[12:12 + 4].strip()
-                resi = line[17:17 + 3]
-                resn = line[22:22 + 5].strip()
-                # RAW resn is defined HERE
-                if resn not in resn_list:
-                    resn_list.append(resn)  # NEED to keep ins code here
-                x, y, z = (float(line[i:(i + 8)]) for i in [30, 38, 46])
-                if resn[-1].isalpha():
-                    resa, resn = resn[-1], int(resn[:-1]) - 1
-                else:
-                    resa, resn = "", int(resn) - 1
-                if resn < min_resn:
-                    min_resn = resn
-                if resn > max_resn:
-                    max_resn = resn
-                if resn not in xyz:
-                    xyz[resn] = {}
-                if resa not in xyz[resn]:
-                    xyz[resn][resa] = {}
-                if resn not in seq:
-                    seq[resn] = {}
-                if resa not in seq[resn]:
-                    seq[resn][resa] = resi
-
-                if atom not in xyz[resn][resa]:
-                    xyz[resn][resa][atom] = np.array([x, y, z])
-
-    # convert to numpy arrays, fill in missing values
-    seq_, xyz_ = [], []
-
-    try:
-        for resn in range(min_resn, max_resn + 1):
-            if resn in seq:
-              # CLEANED resn is defined HERE
-                # resn_list.append(str(resn + 1))
-                # print(resn)
-                for k in sorted(seq[resn]):
-                    seq_.append(aa_3_N.get(seq[resn][k], 20))
-            else:
-                seq_.append(20)
-                # if str(resn - 1) not in resn_list:
-                # print(resn, '**')
-                # resn_list.append('DASH')
-            # print(resn, resn_list[-1])
-            if resn in xyz:
-                for k in sorted(xyz[resn]):
-                    for atom in atoms:
-                        if atom in xyz[resn][k]:
-                            xyz_.append(xyz[resn][k][atom])
-                        else:
-                            xyz_.append(np.full(3, np.nan))
-            else:
-                for atom in atoms:
-                    xyz_.append(np.full(3, np.nan))
-        # assert len(seq_) == len(list(dict.fromkeys(resn_list)))
-        return np.array(xyz_).reshape(-1, len(atoms), 3), N_to_AA(np.array(seq_)), list(dict.fromkeys(resn_list))
-    except TypeError:
+    parsed = chain_arrays(read_pdb_chains(x, split_chains=chain is not None).get(chain), atoms, resn_mode='unique')
+    if parsed is None:
         return 'no_chain', 'no_chain', 'no_chain'
+    xyz, seq, resn_list = parsed
+    return xyz, [seq], resn_list
 
 
 def alt_parse_PDB(path_to_pdb, input_chain_list=None, ca_only=False, side_chains=False):
     c = 0
     pdb_dict_list = []
-    init_alphabet = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M', 'N', 'O', 'P', 'Q', 'R', 'S', 'T',
-                     'U', 'V', 'W', 'X', 'Y', 'Z', 'a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k', 'l', 'm', 'n',
-                     'o', 'p', 'q', 'r', 's', 't', 'u', 'v', 'w', 'x', 'y', 'z']
-    extra_alphabet = [str(item) for item in list(np.arange(300))]
-    chain_alphabet = init_alphabet + extra_alphabet
+    chain_alphabet = CHAIN_ALPHABET
 
     if input_chain_list:
         chain_alphabet = input_chain_list
 
+    sidechain_atoms = _get_parse_atoms(ca_only, side_chains)
     biounit_names = [path_to_pdb]
     for biounit in biounit_names:
-        my_dict = {}
-        my_dict['resn_list'] = []
-        s = 0
-        concat_seq = ''
+        # read the file once and pull every chain out of the same records
+        chains = read_pdb_chains(biounit)
+        letters, xyz_list, seq_list = [], [], []
+        resn_list = []
         for letter in chain_alphabet:
-            if ca_only:
-                sidechain_atoms = ['CA']
-            elif side_chains:
-                sidechain_atoms = ["N", "CA", "C", "O", "CB",
-                                   "CG", "CG1", "OG1", "OG2", "CG2", "OG", "SG",
-                                   "CD", "SD", "CD1", "ND1", "CD2", "OD1", "OD2", "ND2",
-                                   "CE", "CE1", "NE1", "OE1", "NE2", "OE2", "NE", "CE2", "CE3",
-                                   "NZ", "CZ", "CZ2", "CZ3", "CH2", "OH", "NH1", "NH2"]
-            else:
-                sidechain_atoms = ['N', 'CA', 'C', 'O']
-            xyz, seq, resn_list = alt_parse_PDB_biounits(biounit, atoms=sidechain_atoms, chain=letter)
-            if resn_list != 'no_chain':
-                my_dict['resn_list'] = resn_list
-
-            if not isinstance(xyz, str):
-                concat_seq += seq[0]
-                my_dict['seq_chain_' + letter] = seq[0]
-                coords_dict_chain = {}
-                if ca_only:
-                    coords_dict_chain['CA_chain_' + letter] = xyz.tolist()
-                elif side_chains:  # auto-load all atoms
-                    if side_chains:
-                        xyz = collapse_side_chains(xyz)
-                    sc_atoms = ["N", "CA", "C", "O",
-                                "SC1", "SC2", "SC3", "SC4",
-                                "SC5", "SC6", "SC7", "SC8",
-                                "SC9", "SC10"]
-                    for sc_idx, sca in enumerate(sc_atoms):
-                        coords_dict_chain[f'{sca}_chain_{letter}'] = xyz[:, sc_idx, :].tolist()
-                else:
-                    # TODO henry handle variable letter list
-                    coords_dict_chain['N_chain_' + letter] = xyz[:, 0, :].tolist()
-                    coords_dict_chain['CA_chain_' + letter] = xyz[:, 1, :].tolist()
-                    coords_dict_chain['C_chain_' + letter] = xyz[:, 2, :].tolist()
-                    coords_dict_chain['O_chain_' + letter] = xyz[:, 3, :].tolist()
-
-                my_dict['coords_chain_' + letter] = coords_dict_chain
-                s += 1
+            parsed = chain_arrays(chains.get(letter), sidechain_atoms, resn_mode='unique')
+
+            if parsed is not None:
+                xyz, seq, resn_list = parsed
+                letters.append(letter)
+                xyz_list.append(collapse_side_chains(xyz) if side_chains and not ca_only else xyz)
+                seq_list.append(seq)
         fi = biounit.rfind("/")
-        my_dict['name'] = biounit[(fi + 1):-4]
-        my_dict['num_of_chains'] = s
-        my_dict['seq'] = concat_seq
+        my_dict = Structure(biounit[(fi + 1):-4], letters, xyz_list, seq_list,
+                            _get_structure_atoms(ca_only, side_chains))
+        my_dict['resn_list'] = resn_list
+        s = len(letters)
 
         # old handling for resn lists
         # my_dict['resn_list'] = list(resn_list)
@@ -1062,8 +847,9 @@ class CA_ProteinFeatures(nn.Module):
         return RBF
 
     def _get_rbf(self, A, B, E_idx):
-        D_A_B = torch.sqrt(torch.sum((A[:, :, None, :] - B[:, None, :, :]) ** 2, -1) + 1e-6)  # [B, L, L]
-        D_A_B_neighbors = gather_edges(D_A_B[:, :, :, None], E_idx)[:, :, :, 0]  # [B,L,K]
+        # gather neighbors before taking distances so only [B, L, K] distances are ever built
+        B_neighbors = gather_nodes(B, E_idx)  # [B, L, K, 3]
+        D_A_B_neighbors = torch.sqrt(torch.sum((A[:, :, None, :] - B_neighbors) ** 2, -1) + 1e-6)  # [B,L,K]
         RBF_A_B = self._rbf(D_A_B_neighbors)
         return RBF_A_B
 
@@ -1129,6 +915,17 @@ class ProteinFeatures(nn.Module):
         self.edge_embedding = nn.Linear(edge_in, edge_features, bias=False)
         self.norm_edges = nn.LayerNorm(edge_features)
 
+        # (A, B) atom pairs after Ca-Ca, indexing [N, Ca, C, O, Cb]; the order sets the RBF feature layout
+        self.rbf_pairs = [list(idx) for idx in zip(*[
+            (0, 0), (2, 2), (3, 3), (4, 4),  # N-N, C-C, O-O, Cb-Cb
+            (1, 0), (1, 2), (1, 3), (1, 4),  # Ca-N, Ca-C, Ca-O, Ca-Cb
+            (0, 2), (0, 3), (0, 4),  # N-C, N-O, N-Cb
+            (4, 2), (4, 3), (3, 2),  # Cb-C, Cb-O, O-C
+            (0, 1), (2, 1), (3, 1), (4, 1),  # N-Ca, C-Ca, O-Ca, Cb-Ca
+            (2, 0), (3, 0), (4, 0),  # C-N, O-N, Cb-N
+            (2, 4), (3, 4), (2, 3),  # C-Cb, O-Cb, C-O
+        ])]
+
     def _dist(self, X, mask, eps=1E-6):
         mask_2D = torch.unsqueeze(mask, 1) * torch.unsqueeze(mask, 2)
         dX = torch.unsqueeze(X, 1) - torch.unsqueeze(X, 2)
@@ -1149,12 +946,6 @@ class ProteinFeatures(nn.Module):
         RBF = torch.exp(-((D_expand - D_mu) / D_sigma) ** 2)
         return RBF
 
-    def _get_rbf(self, A, B, E_idx):
-        D_A_B = torch.sqrt(torch.sum((A[:, :, None, :] - B[:, None, :, :]) ** 2, -1) + 1e-6)  # [B, L, L]
-        D_A_B_neighbors = gather_edges(D_A_B[:, :, :, None], E_idx)[:, :, :, 0]  # [B,L,K]
-        RBF_A_B = self._rbf(D_A_B_neighbors)
-        return RBF_A_B
-
     def forward(self, X, mask, residue_idx, chain_labels):
         if self.augment_eps > 0:
             X = X + self.augment_eps * torch.randn_like(X)
@@ -1170,40 +961,19 @@ class ProteinFeatures(nn.Module):
 
         D_neighbors, E_idx = self._dist(Ca, mask)
 
-        RBF_all = []
-        RBF_all.append(self._rbf(D_neighbors))  # Ca-Ca
-        RBF_all.append(self._get_rbf(N, N, E_idx))  # N-N
-        RBF_all.append(self._get_rbf(C, C, E_idx))  # C-C
-        RBF_all.append(self._get_rbf(O, O, E_idx))  # O-O
-        RBF_all.append(self._get_rbf(Cb, Cb, E_idx))  # Cb-Cb
-        RBF_all.append(self._get_rbf(Ca, N, E_idx))  # Ca-N
-        RBF_all.append(self._get_rbf(Ca, C, E_idx))  # Ca-C
-        RBF_all.append(self._get_rbf(Ca, O, E_idx))  # Ca-O
-        RBF_all.append(self._get_rbf(Ca, Cb, E_idx))  # Ca-Cb
-        RBF_all.append(self._get_rbf(N, C, E_idx))  # N-C
-        RBF_all.append(self._get_rbf(N, O, E_idx))  # N-O
-        RBF_all.append(self._get_rbf(N, Cb, E_idx))  # N-Cb
-        RBF_all.append(self._get_rbf(Cb, C, E_idx))  # Cb-C
-        RBF_all.append(self._get_rbf(Cb, O, E_idx))  # Cb-O
-        RBF_all.append(self._get_rbf(O, C, E_idx))  # O-C
-        RBF_all.append(self._get_rbf(N, Ca, E_idx))  # N-Ca
-        RBF_all.append(self._get_rbf(C, Ca, E_idx))  # C-Ca
-        RBF_all.append(self._get_rbf(O, Ca, E_idx))  # O-Ca
-        RBF_all.append(self._get_rbf(Cb, Ca, E_idx))  # Cb-Ca
-        RBF_all.append(self._get_rbf(C, N, E_idx))  # C-N
-        RBF_all.append(self._get_rbf(O, N, E_idx))  # O-N
-        RBF_all.append(self._get_rbf(Cb, N, E_idx))  # Cb-N
-        RBF_all.append(self._get_rbf(C, Cb, E_idx))  # C-Cb
-        RBF_all.append(self._get_rbf(O, Cb, E_idx))  # O-Cb
-        RBF_all.append(self._get_rbf(C, O, E_idx))  # C-O
-        RBF_all = torch.cat(tuple(RBF_all), dim=-1)
+        # all remaining atom pairs from a single neighbor gather: [B, L, K, pairs] distances
+        atoms = torch.stack((N, Ca, C, O, Cb), 2)  # [B, L, 5, 3]
+        atoms_neighbors = gather_nodes(atoms.flatten(2), E_idx).view(*E_idx.shape, 5, 3)  # [B, L, K, 5, 3]
+        A = atoms[:, :, None, self.rbf_pairs[0], :]
+        B = atoms_neighbors[:, :, :, self.rbf_pairs[1], :]
+        D_pairs = torch.sqrt(torch.sum((A - B) ** 2, -1) + 1e-6)  # [B, L, K, pairs]
+        RBF_pairs = self._rbf(D_pairs).flatten(3)  # [B, L, K, pairs * num_rbf]
+        RBF_all = torch.cat((self._rbf(D_neighbors), RBF_pairs), dim=-1)  # Ca-Ca first
 
-        offset = residue_idx[:, :, None] - residue_idx[:, None, :]
-        offset = gather_edges(offset[:, :, :, None], E_idx)[:, :, :, 0]  # [B, L, K]
+        offset = residue_idx[:, :, None] - gather_nodes(residue_idx[:, :, None], E_idx)[:, :, :, 0]  # [B, L, K]
 
-        d_chains = ((chain_labels[:, :, None] - chain_labels[:, None,
-                                                             :]) == 0).long()  # find self vs non-self interaction
-        E_chains = gather_edges(d_chains[:, :, :, None], E_idx)[:, :, :, 0]
+        # find self vs non-self interaction
+        E_chains = (chain_labels[:, :, None] - gather_nodes(chain_labels[:, :, None], E_idx)[:, :, :, 0] == 0).long()
         E_positional = self.embeddings(offset.long(), E_chains)
         E = torch.cat((E_positional, RBF_all), -1)
         E = self.edge_embedding(E)
@@ -1259,9 +1029,20 @@ class ProteinMPNN(nn.Module):
 
     def forward(self, X, S, mask, chain_M, residue_idx, chain_encoding_all, randn=None, mut_positions=None):
         """ Graph-conditioned sequence model """
-        device = X.device
-        # Prepare node and edge embeddings
+        # all residues are visible to the decoder, so the decoding order (randn) does not change the output
+        all_hidden, h_S, h_E, _ = self.embed(X, S, mask, chain_M, residue_idx, chain_encoding_all, mut_positions)
+        logits = self.W_out(all_hidden[0])
+        log_probs = F.log_softmax(logits, dim=-1)
+        return all_hidden, h_S, log_probs, h_E
 
+    def embed(self, X, S, mask, chain_M, residue_idx, chain_encoding_all, mut_positions=None):
+        """ Encoder/decoder embeddings without the sequence logits.
+
+        Returns (decoder hidden states, last layer first), sequence embeddings h_S, encoder edges h_E and the
+        neighbor indices E_idx. Every residue is visible to the decoder, so the [B, L, L] order mask reduces to
+        a per-residue visibility vector (chain_M * mask, with mut_positions hidden for zero-shot predictions).
+        """
+        # Prepare node and edge embeddings
         E, E_idx = self.features(X, mask, residue_idx, chain_encoding_all)
         h_V = torch.zeros((E.shape[0], E.shape[1], E.shape[-1]), device=E.device)
         h_E = self.W_e(E)
@@ -1283,56 +1064,26 @@ class ProteinMPNN(nn.Module):
         h_EX_encoder = cat_neighbors_nodes(torch.zeros_like(h_S), h_E, E_idx)
         h_EXV_encoder = cat_neighbors_nodes(h_V, h_EX_encoder, E_idx)
 
-        chain_M = chain_M * mask  # update chain_M to include missing regions
-
-        # default ProteinMPNN random autoregressive decoding
-        if randn is not None:
-            randn = torch.randn(chain_M.shape, device=X.device)
-            # [numbers will be smaller for places where chain_M = 0.0 and higher for places where chain_M = 1.0]
-            decoding_order = torch.argsort((chain_M + 0.0001) * (torch.abs(randn)))
-
-        # left-to-right decoding order
-        else:
-            decoding_order = torch.arange(0, X.size(1), device=device).unsqueeze(0).repeat(X.size(0), 1)
-
-        mask_size = E_idx.shape[1]
-        # one hot encode decoding order
-        permutation_matrix_reverse = torch.nn.functional.one_hot(decoding_order, num_classes=mask_size).float()
-        order_mask_backward = torch.einsum(
-            'ij, biq, bjp->bqp',
-            (1 -
-             torch.triu(
-                 torch.ones(
-                     mask_size,
-                     mask_size,
-                     device=device))),
-            permutation_matrix_reverse,
-            permutation_matrix_reverse)  # [1, L_max, L_max] array of visibility ordered backward
-
-        # set all residues to be visible
-        order_mask_backward = torch.ones_like(order_mask_backward)
+        visible = chain_M * mask  # update chain_M to include missing regions
         # passing mut_positions tensor to mask out certain position(s) for zero-shot ProteinMPNN predictions
         if mut_positions is not None:
-            for b in range(order_mask_backward.shape[0]):
-                order_mask_backward[b, mut_positions[b, 0], :] = 0
-                order_mask_backward[b, mut_positions[b, 1], :] = 0
-                # order_mask_backward[b, mut_positions[b], :] = 0
-
-        # apply padding/visible residue mask
-        chain_applied = chain_M.unsqueeze(-1).repeat(1, 1, order_mask_backward.shape[2])
-        order_mask_backward = order_mask_backward * chain_applied
-
-        mask_attend = torch.gather(order_mask_backward, 2, E_idx).unsqueeze(-1)
+            visible = visible.clone()
+            batch_idx = torch.arange(visible.shape[0], device=visible.device)
+            visible[batch_idx, mut_positions[:, 0]] = 0
+            visible[batch_idx, mut_positions[:, 1]] = 0
 
+        # a residue sees either all of its neighbors or none of them
+        mask_attend = visible[:, :, None, None]
         mask_1D = mask.view([mask.size(0), mask.size(1), 1, 1])
         mask_bw = mask_1D * mask_attend  # 1 if decoded already, 0 if not yet decoded
         mask_fw = mask_1D * (1. - mask_attend)  # inverse of bw mask
 
-        # Create neighbors of X
-        E_idx_flat = E_idx.view((*E_idx.shape[:-2], -1))
-        E_idx_flat = E_idx_flat[..., None, None].expand(-1, -1, *X.shape[-2:])
-        X_neighbors = torch.gather(X, -3, E_idx_flat)
-        X_neighbors = X_neighbors.view((*E_idx.shape, -1, 3))
+        if self.use_ipmp:
+            # Create neighbors of X
+            E_idx_flat = E_idx.view((*E_idx.shape[:-2], -1))
+            E_idx_flat = E_idx_flat[..., None, None].expand(-1, -1, *X.shape[-2:])
+            X_neighbors = torch.gather(X, -3, E_idx_flat)
+            X_neighbors = X_neighbors.view((*E_idx.shape, -1, 3))
 
         all_hidden = []
         h_EXV_encoder_fw = mask_fw * h_EXV_encoder  # [1, L_max, k_neighbors, embedding_dim (384)]
@@ -1347,10 +1098,7 @@ class ProteinMPNN(nn.Module):
 
             all_hidden.append(h_V)
 
-        # collect ONLY required hidden layers
-        logits = self.W_out(h_V)
-        log_probs = F.log_softmax(logits, dim=-1)
-        return list(reversed(all_hidden)), h_S, log_probs, h_E
+        return list(reversed(all_hidden)), h_S, h_E, E_idx
 
     def sample(self, X, randn, S_true, chain_mask, chain_encoding_all, residue_idx, mask=None, temperature=1.0,
                omit_AAs_np=None, bias_AAs_np=None, chain_M_pos=None, omit_AA_mask=None, pssm_coef=None, pssm_bias=None,
@@ -627,8 +627,9 @@ class ProteinFeatures(nn.Module):
         return RBF
 
     def _get_rbf(self, A, B, E_idx):
-        D_A_B = torch.sqrt(torch.sum((A[:, :, None, :] - B[:, None, :, :])**2, -1) + 1e-6)  # [B, L, L]
-        D_A_B_neighbors = gather_edges(D_A_B[:, :, :, None], E_idx)[:, :, :, 0]  # [B,L,K]
+        # gather neighbors before taking distances so only [B, L, K] distances are ever built
+        B_neighbors = gather_nodes(B, E_idx)  # [B, L, K, 3]
+        D_A_B_neighbors = torch.sqrt(torch.sum((A[:, :, None, :] - B_neighbors)**2, -1) + 1e-6)  # [B,L,K]
         RBF_A_B = self._rbf(D_A_B_neighbors)
         return RBF_A_B
 
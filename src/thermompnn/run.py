@@ -1,220 +1,300 @@
 import argparse
+import hashlib
+import itertools
+import json
 import os
+import re
+import shutil
 import time
-from typing import List, Literal, Optional
+import warnings
+from typing import List, Literal, Optional, Union
 
 import numpy as np
 import pandas as pd
 import torch
-from torch.utils.data import DataLoader
+from scipy.spatial import cKDTree
 from tqdm import tqdm
 
 from thermompnn.datasets.dataset_utils import Mutation
 from thermompnn.datasets.v2_datasets import tied_featurize_mut
-from thermompnn.model.v2_model import _dist, batched_index_select
-from thermompnn.ssm_utils import (distance_filter, disulfide_penalty,
-                                  get_config, get_dmat, get_model, load_pdb,
-                                  renumber_pdb)
-
-
-def get_ssm_mutations_double(pdb, dthresh):
-    # make mutation list for SSM run
+from thermompnn.encoder_cache import EncoderCache
+from thermompnn.model.v2_model import (ModelEnsemble, _dist,
+                                       batched_index_select, gather_pair_edges)
+from thermompnn.ssm_utils import (DISULFIDE_PENALTY, export_fused,
+                                  get_config, get_contact_pairs,
+                                  get_disulfide_residues, get_ensemble,
+                                  idx_to_pdb_num, load_pdb, residue_labels,
+                                  resolve_positions, spatial_index)
+from thermompnn.sinks import SINKS, load_ssm_arrays
+
+
+def get_ssm_pairs_double(pdb, dthresh):
+    """Position pairs (i < j) closer than dthresh (Ca-Ca) and their wildtype amino acids"""
     ALPHABET = "ACDEFGHIKLMNPQRSTVWYX"
-    MUT_POS, MUT_WT = [], []
-    for seq_pos in range(len(pdb["seq"])):
-        wtAA = pdb["seq"][seq_pos]
-        # check for missing residues
-        if wtAA != "-":
-            MUT_POS.append(seq_pos)
-            MUT_WT.append(wtAA)
-        else:
-            MUT_WT.append("-")
 
     # Use distance filter BEFORE data setup / inference for speedup
-    from thermompnn.ssm_utils import get_dmat
-
-    dmat = np.triu(get_dmat(pdb))  # [L, L]
-    mask = (dmat < dthresh) & (dmat > 0.0)
-    pos1, pos2 = np.where(mask)
-    pos_combos = [(p1, p2) for p1, p2 in zip(pos1, pos2)]
-    pos_combos = np.array(pos_combos)  # [combos, 2]
-    wtAA = np.zeros_like(pos_combos)
-    # fill in wtAA for each pos combo
-    for p_idx in range(pos_combos.shape[0]):
-        wtAA[p_idx, 0] = ALPHABET.index(MUT_WT[pos_combos[p_idx, 0]])
-        wtAA[p_idx, 1] = ALPHABET.index(MUT_WT[pos_combos[p_idx, 1]])
-
-    # make default mutAA bundle for broadcasting
-    one = np.arange(20).repeat(20)
-    two = np.tile(np.arange(20), 20)
-    mutAA = np.stack([one, two]).T  # [400, 2]
-    n_comb = pos_combos.shape[0]
-    mutAA = np.tile(mutAA, (n_comb, 1))
-
-    # the problem is 2nd wtAA/pos_combos and 2nd mutAA are correlated so they always show up together
-    # repeat these 20x20 times
-    wtAA = np.repeat(wtAA, 400, axis=0)
-    pos_combos = np.repeat(pos_combos, 400, axis=0)
-
-    # filter out self-mutations and single-mutations
-    mask = np.sum(mutAA == wtAA, -1).astype(bool)
-    pos_combos = pos_combos[~mask, :]
-    mutAA = mutAA[~mask, :]
-    wtAA = wtAA[~mask, :]
-
-    # filter out upper-triangle portions - if mutAA or pos is larger, it's already been checked
-    mask = pos_combos[:, 0] > pos_combos[:, 1]
-    pos_combos = pos_combos[~mask, :]
-    mutAA = mutAA[~mask, :]
-    wtAA = wtAA[~mask, :]
-
-    return torch.tensor(pos_combos), torch.tensor(wtAA), torch.tensor(mutAA)
+    pos_combos, _ = get_contact_pairs(pdb, dthresh)  # [combos, 2]
+
+    # missing residues have NaN coordinates and never pass the distance filter
+    seq_idx = np.array([ALPHABET.find(aa) for aa in pdb["seq"]], dtype=np.int64)
+    wtAA = seq_idx[pos_combos]
+    return torch.tensor(pos_combos), torch.tensor(wtAA)
+
+
+def iter_ssm_mutations_double(pdb, dthresh, batch_size=2048):
+    """Yields the double mutants of get_ssm_mutations_double lazily as (pos, wtAA, mutAA) blocks.
+
+    Each block covers max(1, batch_size // 400) consecutive position pairs. Its rows are computed from the pair index
+    and the amino acid indices, and self-mutations are dropped per block, so the full list is never built.
+    """
+    pos_combos, wtAA = get_ssm_pairs_double(pdb, dthresh)
+    pairs_per_block = max(1, batch_size // 400)
+    grid = torch.arange(pairs_per_block * 400)
+    mutAA = torch.stack([grid // 20 % 20, grid % 20], -1)  # [pairs_per_block * 400, 2]
+    for start in range(0, pos_combos.shape[0], pairs_per_block):
+        pair = start + grid // 400
+        pair, mut = pair[pair < pos_combos.shape[0]], mutAA[: (pos_combos.shape[0] - start) * 400]
+        pos, wt = pos_combos[pair], wtAA[pair]
+        keep = (mut != wt).all(-1)  # drop self-mutations and single-mutations
+        yield pos[keep], wt[keep], mut[keep]
+
+
+def get_ssm_mutations_double(pdb, dthresh):
+    """Every double mutant of the position pairs within dthresh as (pos, wtAA, mutAA) [N, 2] tensors, in (pair,
+    mutant 1, mutant 2) order (see iter_ssm_mutations_double)"""
+    blocks = list(zip(*iter_ssm_mutations_double(pdb, dthresh)))
+    if not blocks:
+        return (torch.zeros([0, 2], dtype=torch.long),) * 3
+    return tuple(torch.cat(b) for b in blocks)
 
 
 def run_double(
     all_mpnn_hid, mpnn_embed, cfg, loader, batch_size, model, X, mask, mpnn_edges_raw, device="cuda"
 ):
-    """Batched mutation processing using shared protein embeddings and only stability prediction module head"""
+    """Batched mutation processing using shared protein embeddings and only stability prediction module head.
+
+    loader yields (pos, wtAA, mutAA) batches, e.g. iter_ssm_mutations_double or TensorBatches over SSMDataset fields.
+    """
 
     all_mpnn_hid = torch.cat(all_mpnn_hid[: cfg.model.num_final_layers], -1)
-    all_mpnn_hid = all_mpnn_hid.repeat(batch_size, 1, 1)
-    mpnn_embed = mpnn_embed.repeat(batch_size, 1, 1)
-    mpnn_edges_raw = mpnn_edges_raw.repeat(batch_size, 1, 1, 1)
-    # get edges between the two mutated residues
+    # get edges between the two mutated residues (structure tensors are shared by every mutation in a batch)
     D_n, E_idx = _dist(X[:, :, 1, :], mask)
-    E_idx = E_idx.repeat(batch_size, 1, 1)
 
     preds = []
     for b in tqdm(loader):
         pos, wtAA, mutAA = b
         pos = pos.to(device)
-        wtAA = wtAA.to(device)
         mutAA = mutAA.to(device)
-        mut_mutant_AAs = mutAA
-        mut_positions = pos
-        REAL_batch_size = mutAA.shape[0]
-
-        # get sequence embedding for mutant aa
-        mut_embed_list = []
-        for m in range(mut_mutant_AAs.shape[-1]):
-            mut_embed_list.append(model.prot_mpnn.W_s(mut_mutant_AAs[:, m]))
-        mut_embed = torch.cat(
-            [m.unsqueeze(-1) for m in mut_embed_list], -1
-        )  # shape: (Batch, Embed, N_muts)
-
-        n_mutations = [0, 1]
-        edges = []
-        for n_current in n_mutations:  # iterate over N-order mutations
-            # select the edges at the current mutated positions
-            if (
-                REAL_batch_size != mpnn_edges_raw.shape[0]
-            ):  # last batch will throw error if not corrected
-                mpnn_edges_raw = mpnn_edges_raw[:REAL_batch_size, ...]
-                E_idx = E_idx[:REAL_batch_size, ...]
-                all_mpnn_hid = all_mpnn_hid[:REAL_batch_size, ...]
-                mpnn_embed = mpnn_embed[:REAL_batch_size, ...]
-
-            mpnn_edges_tmp = torch.squeeze(
-                batched_index_select(
-                    mpnn_edges_raw, 1, mut_positions[:, n_current: n_current + 1]
-                ),
-                1,
-            )
-            E_idx_tmp = torch.squeeze(
-                batched_index_select(
-                    E_idx, 1, mut_positions[:, n_current: n_current + 1]
-                ),
-                1,
-            )
-
-            n_other = [a for a in n_mutations if a != n_current]
-            mp_other = mut_positions[:, n_other]  # [B, 1]
-            # E_idx_tmp [B, K]
-            mp_other = mp_other[..., None].repeat(
-                1, 1, E_idx_tmp.shape[-1]
-            )  # [B, 1, 48]
-            idx = torch.where(
-                E_idx_tmp[:, None, :] == mp_other
-            )  # get indices where the neighbor list matches the mutations we want
-            a, b, c = idx
-            # start w/empty edges and fill in as you go, then set remaining edges to 0
-            edge = torch.full(
-                [REAL_batch_size, mpnn_edges_tmp.shape[-1]],
-                torch.nan,
-                device=E_idx.device,
-            )  # [B, 128]
-            # idx is (a, b, c) tuple of tensors
-            # a has indices of batch members; b is all 0s; c has indices of actual neighbors for edge grabbing
-            edge[a, :] = mpnn_edges_tmp[a, c, :]
-            edge = torch.nan_to_num(edge, nan=0)
-            edges.append(edge)
-
-        mpnn_edges = torch.stack(
-            edges, dim=-1
+        mpnn_edges = gather_pair_edges(
+            mpnn_edges_raw, E_idx, pos
         )  # this should get two edges per set of doubles (one for each)
+        ddg = _double_head(model, cfg, all_mpnn_hid, mpnn_embed, mpnn_edges, pos, mutAA)
+        preds += list(ddg.detach().cpu().numpy())
+    return np.squeeze(preds)
 
-        # gather final representation from seq and structure embeddings
-        final_embed = []
-        for i in range(mut_mutant_AAs.shape[-1]):
-            # gather embedding for a specific position
-            current_positions = mut_positions[:, i: i + 1]  # [B, 1]
-            g_struct_embed = torch.gather(
-                all_mpnn_hid,
-                1,
-                current_positions.unsqueeze(-1).expand(
-                    current_positions.size(0),
-                    current_positions.size(1),
-                    all_mpnn_hid.size(2),
-                ),
-            )
-            g_struct_embed = torch.squeeze(g_struct_embed, 1)  # [B, E * nfl]
-            # add specific mutant embedding to gathered embed based on which mutation is being gathered
-            g_seq_embed = torch.gather(
-                mpnn_embed,
-                1,
-                current_positions.unsqueeze(-1).expand(
-                    current_positions.size(0),
-                    current_positions.size(1),
-                    mpnn_embed.size(2),
-                ),
-            )
-            g_seq_embed = torch.squeeze(g_seq_embed, 1)  # [B, E]
-            # if mut embed enabled, subtract it from the wt embed directly to keep dims low
-            if cfg.model.mutant_embedding:
-                if REAL_batch_size != mut_embed.shape[0]:
-                    mut_embed = mut_embed[:REAL_batch_size, ...]
-                g_seq_embed = g_seq_embed - mut_embed[:, :, i]  # [B, E]
-            g_embed = torch.cat([g_struct_embed, g_seq_embed], -1)  # [B, E * (nfl + 1)]
-
-            # if edges enabled, concatenate them onto the end of the embedding
-            if cfg.model.edges:
-                g_edge_embed = mpnn_edges[:, :, i]
-                g_embed = torch.cat([g_embed, g_edge_embed], -1)  # [B, E * (nfl + 2)]
-            final_embed.append(
-                g_embed
-            )  # list with length N_mutations - used to make permutations
-        final_embed = torch.stack(final_embed, dim=0)  # [2, B, E x (nfl + 1)]
-
-        # do initial dim reduction
-        final_embed = model.light_attention(final_embed)  # [2, B, E]
-
-        # if batch is only single mutations, pad it out with a "zero" mutation
-        if final_embed.shape[0] == 1:
-            zero_embed = torch.zeros(
-                final_embed.shape, dtype=torch.float32, device=E_idx.device
-            )
-            final_embed = torch.cat([final_embed, zero_embed], dim=0)
 
-        # make two copies, one with AB order and other with BA order of mutation
-        embedAB = torch.cat((final_embed[0, :, :], final_embed[1, :, :]), dim=-1)
-        embedBA = torch.cat((final_embed[1, :, :], final_embed[0, :, :]), dim=-1)
+def _double_head(model, cfg, all_mpnn_hid, mpnn_embed, mpnn_edges, pos, mutAA):
+    """Epistatic ddG [B] of mutating pos [B, N] to mutAA [B, N] (N = 1 for single, 2 for double mutants).
+
+    all_mpnn_hid [1, L, E * nfl] and mpnn_embed [1, L, E] are shared by all mutations, mpnn_edges [B, E, N] are the
+    edges between the mutated residues (see gather_pair_edges).
+    """
+    # gather final representation from seq and structure embeddings
+    final_embed = []
+    for i in range(pos.shape[-1]):
+        g_struct_embed = all_mpnn_hid[0, pos[:, i]]  # [B, E * nfl]
+        g_seq_embed = mpnn_embed[0, pos[:, i]]  # [B, E]
+        # if mut embed enabled, subtract it from the wt embed directly to keep dims low
+        if cfg.model.mutant_embedding:
+            g_seq_embed = g_seq_embed - model.prot_mpnn.W_s(mutAA[:, i])  # [B, E]
+        g_embed = torch.cat([g_struct_embed, g_seq_embed], -1)  # [B, E * (nfl + 1)]
+
+        # if edges enabled, concatenate them onto the end of the embedding
+        if cfg.model.edges:
+            g_embed = torch.cat([g_embed, mpnn_edges[:, :, i]], -1)  # [B, E * (nfl + 2)]
+        final_embed.append(g_embed)  # list with length N_mutations - used to make permutations
+    final_embed = torch.stack(final_embed, dim=0)  # [N, B, E x (nfl + 1)]
+
+    # do initial dim reduction
+    final_embed = model.light_attention(final_embed)  # [N, B, E]
+
+    # if batch is only single mutations, pad it out with a "zero" mutation
+    if final_embed.shape[0] == 1:
+        final_embed = torch.cat([final_embed, torch.zeros_like(final_embed)], dim=0)
+
+    # make two copies, one with AB order and other with BA order of mutation
+    embedAB = torch.cat((final_embed[0, :, :], final_embed[1, :, :]), dim=-1)
+    embedBA = torch.cat((final_embed[1, :, :], final_embed[0, :, :]), dim=-1)
+
+    ddG_A = model.ddg_out(embedAB)  # [B, 1]
+    ddG_B = model.ddg_out(embedBA)  # [B, 1]
+
+    ddg = (ddG_A + ddG_B) / 2.0
+    return torch.squeeze(ddg, dim=-1)
+
+
+def factorize_double(all_mpnn_hid, mpnn_embed, cfg, model):
+    """Splits the first light attention layer into per-residue and per-amino-acid terms.
+
+    light_attention starts with LayerNorm -> Linear on [structure, wt seq - mutant seq, edge] features. The LayerNorm
+    gain is folded into the Linear weights and the LayerNorm mean / variance are assembled from per-part sums, so
+    the projection of every (position, mutant amino acid) combination is computed once for the whole protein.
+    """
+    norm, proj = model.light_attention[0], model.light_attention[1]
+    struct = torch.cat(all_mpnn_hid[: cfg.model.num_final_layers], -1)[0]  # [L, E * nfl]
+    wt_embed = mpnn_embed[0]  # [L, E]
+    if cfg.model.mutant_embedding:
+        mut_embed = model.prot_mpnn.W_s.weight[:20]  # [20, E]
+    else:
+        mut_embed = torch.zeros_like(model.prot_mpnn.W_s.weight[:20])
+    seq = wt_embed[:, None, :] - mut_embed[None, :, :]  # [L, 20, E]
+
+    weight = proj.weight * norm.weight[None, :]  # LayerNorm gain folded into the projection
+    n_struct, n_seq = struct.shape[-1], seq.shape[-1]
+    w_struct, w_seq, w_edge = weight[:, :n_struct], weight[:, n_struct: n_struct + n_seq], weight[:, n_struct + n_seq:]
+
+    # per-(position, mutant aa) projection and running sums for the LayerNorm statistics
+    proj_pa = (struct @ w_struct.T)[:, None, :] + seq @ w_seq.T  # [L, 20, H]
+    struct, seq = struct.double(), seq.double()
+    sum_pa = struct.sum(-1)[:, None] + seq.sum(-1)  # [L, 20]
+    sq_pa = (struct ** 2).sum(-1)[:, None] + (seq ** 2).sum(-1)  # [L, 20]
+
+    return {
+        "proj": proj_pa,
+        "sum": sum_pa,
+        "sq": sq_pa,
+        "w_edge": w_edge,
+        "w_sum": weight.sum(-1),  # projection of the LayerNorm mean
+        "bias": proj.weight @ norm.bias + proj.bias,
+    }
+
+
+def _light_attention_factorized(factors, model, pos, edge):
+    """light_attention output for all 20 mutant amino acids at pos [P], given the edge [P, E] of each pair
+
+    Same as light_attention(cat([structure, wt seq - mutant seq, edge])) up to float rounding.
+    """
+    norm, n_features = model.light_attention[0], model.light_attention[1].in_features
+    proj = factors["proj"][pos]  # [P, 20, H]
+    edge_sum = edge.double().sum(-1)[:, None]
+    edge_sq = (edge.double() ** 2).sum(-1)[:, None]
+    proj = proj + (edge @ factors["w_edge"].T)[:, None, :]
+
+    mean = (factors["sum"][pos] + edge_sum) / n_features  # [P, 20]
+    var = (factors["sq"][pos] + edge_sq) / n_features - mean ** 2
+    rstd = torch.rsqrt(var + norm.eps).to(proj.dtype)[..., None]
+    mean = mean.to(proj.dtype)[..., None]
 
-        ddG_A = model.ddg_out(embedAB)  # [B, 1]
-        ddG_B = model.ddg_out(embedBA)  # [B, 1]
+    hidden = (proj - mean * factors["w_sum"]) * rstd + factors["bias"]
+    return model.light_attention[2:](hidden)  # [P, 20, H]
 
-        ddg = (ddG_A + ddG_B) / 2.0
-        preds += list(torch.squeeze(ddg, dim=-1).detach().cpu().numpy())
-    return np.squeeze(preds)
+
+def score_pairs_double(factors, model, pos, mpnn_edges):
+    """Epistatic ddG of all 20 x 20 mutant combinations for each position pair.
+
+    pos [P, 2] and mpnn_edges [P, E, 2] (edge of each position to the other one) -> ddG [P, 20, 20].
+    Structure work is done once per pair and the first ddg_out layer is split into its AB / BA halves,
+    so only the remaining ddg_out layers run on every mutation.
+    """
+    embed_A = _light_attention_factorized(factors, model, pos[:, 0], mpnn_edges[:, :, 0])  # [P, 20, H]
+    embed_B = _light_attention_factorized(factors, model, pos[:, 1], mpnn_edges[:, :, 1])  # [P, 20, H]
+
+    first = model.ddg_out[0]
+    H = embed_A.shape[-1]
+    w_first, w_second = first.weight[:, :H], first.weight[:, H:]
+
+    # embedAB = [A, B] and embedBA = [B, A], laid out on the (mutAA1, mutAA2) grid
+    hid_AB = (embed_A @ w_first.T)[:, :, None, :] + (embed_B @ w_second.T)[:, None, :, :] + first.bias
+    hid_BA = (embed_A @ w_second.T)[:, :, None, :] + (embed_B @ w_first.T)[:, None, :, :] + first.bias
+    ddG_A, ddG_B = model.ddg_out[1:](torch.stack([hid_AB, hid_BA], dim=0))  # [P, 20, 20, 1]
+
+    ddg = (ddG_A + ddG_B) / 2.0
+    return torch.squeeze(ddg, dim=-1)
+
+
+def run_heads(model, fn, *args, in_dims=None):
+    """fn(model, *args), stacked along a leading member dimension for a ModelEnsemble (in_dims as in members)"""
+    if isinstance(model, ModelEnsemble):
+        return model.members(fn, *args, in_dims=in_dims)
+    return fn(model, *args)
+
+
+def iter_double_factorized(all_mpnn_hid, mpnn_embed, cfg, pos, batch_size, model, X, mask, mpnn_edges_raw,
+                           E_idx=None):
+    """Yields (start, ddG [(members,) p, 20, 20]) for consecutive batches pos[start: start + p] of the position
+    pairs pos [P, 2]. Predictions stay on the device (see run_double_factorized)."""
+    pairs_per_batch = max(1, batch_size // 400)
+    with torch.no_grad():
+        if E_idx is None:
+            D_n, E_idx = _dist(X[:, :, 1, :], mask)
+        factors = run_heads(model, lambda m, *a: factorize_double(*a, m), all_mpnn_hid, mpnn_embed, cfg)
+
+    for b, (pos_batch,) in enumerate(tqdm(TensorBatches(pos, batch_size=pairs_per_batch, device=E_idx.device))):
+        start = b * pairs_per_batch
+        with torch.no_grad():
+            mpnn_edges = gather_pair_edges(mpnn_edges_raw, E_idx, pos_batch)  # [P, E, 2]
+            if not cfg.model.edges:
+                mpnn_edges = mpnn_edges[:, :0]
+            ddg = run_heads(model, lambda m, f, *a: score_pairs_double(f, m, *a), factors, pos_batch, mpnn_edges,
+                            in_dims=(0, None, None))
+        yield start, ddg
+
+
+def run_double_factorized(all_mpnn_hid, mpnn_embed, cfg, pos, batch_size, model, X, mask, mpnn_edges_raw,
+                          E_idx=None):
+    """Scores every double mutant at the position pairs pos [P, 2], sharing per-pair work across the 20 x 20 grid.
+
+    batch_size is the number of mutations per step, rounded down to whole position pairs (at least one).
+    E_idx are the ProteinMPNN neighbors of mpnn_edges_raw (recomputed from X if not given).
+    Returns ddG [P, 20, 20] ([members, P, 20, 20] for a ModelEnsemble) on the CPU.
+    """
+    if pos.shape[0] == 0:
+        return torch.zeros(([len(model)] if isinstance(model, ModelEnsemble) else []) + [0, 20, 20])
+    batches = iter_double_factorized(all_mpnn_hid, mpnn_embed, cfg, pos, batch_size, model, X, mask,
+                                     mpnn_edges_raw, E_idx)
+    return torch.cat([ddg.cpu() for _, ddg in batches], dim=-3)
+
+
+def select_pairs_double(ddg, wtAA, threshold=None):
+    """Selects the double mutants of a batch of position pairs on the device.
+
+    ddg [(members,) P, 20, 20] and wtAA [P, 2] -> pair index [n], mutant amino acids [n, 2] and ddg [n] ([n, members])
+    of the mutations with ddG <= threshold, in (pair, mutant 1, mutant 2) order. Self-mutations are dropped and
+    ensembles are filtered on the member mean.
+    """
+    mean = ddg.mean(0) if ddg.dim() == 4 else ddg
+    aa = torch.arange(20, device=ddg.device)
+    valid = (aa[None, :, None] != wtAA[:, 0, None, None]) & (aa[None, None, :] != wtAA[:, 1, None, None])
+    if threshold is not None:
+        valid &= mean <= threshold
+    p, a1, a2 = torch.nonzero(valid, as_tuple=True)
+    values = ddg[p, a1, a2] if ddg.dim() == 3 else ddg[:, p, a1, a2].T
+    return p, torch.stack([a1, a2], -1), values
+
+
+class TopKDoubles:
+    """Running selection of the k double mutants with the lowest (mean) ddG, kept on the device"""
+
+    def __init__(self, k):
+        self.k = k
+        self.pair = self.mut = self.ddg = None
+
+    def update(self, pair, mut, ddg):
+        if self.ddg is not None:
+            pair, mut, ddg = torch.cat([self.pair, pair]), torch.cat([self.mut, mut]), torch.cat([self.ddg, ddg])
+        score = ddg.mean(-1) if ddg.dim() == 2 else ddg
+        if score.shape[0] > self.k:
+            keep = torch.topk(score, self.k, largest=False).indices
+            pair, mut, ddg = pair[keep], mut[keep], ddg[keep]
+        self.pair, self.mut, self.ddg = pair, mut, ddg
+
+    def result(self):
+        """(pair, mut, ddg) sorted by ddG"""
+        if self.ddg is None:
+            return None
+        score = self.ddg.mean(-1) if self.ddg.dim() == 2 else self.ddg
+        order = torch.sort(score, stable=True).indices
+        return self.pair[order], self.mut[order], self.ddg[order]
 
 
 class SSMDataset(torch.utils.data.Dataset):
@@ -230,63 +310,170 @@ class SSMDataset(torch.utils.data.Dataset):
         return self.POS[index, :], self.WTAA[index, :], self.MUTAA[index, :]
 
 
-def run_single_ssm(pdb, cfg, model, device='cuda'):
-    """Runs single-mutant SSM sweep with ThermoMPNN v2"""
+class TensorBatches:
+    """In-process replacement for a DataLoader over tensors that are already in memory, e.g. SSMDataset fields.
+
+    Yields tuples of consecutive row slices of tensors (equal first dimension). By default the tensors are moved to
+    device once and every batch is a view of them. With prefetch, they stay on the host (pinned on CUDA) and the next
+    batch is copied to device asynchronously while the current one is used.
+    """
+
+    def __init__(self, *tensors, batch_size, device=None, prefetch=False):
+        self.batch_size = batch_size
+        self.device = torch.device(device) if device is not None else tensors[0].device
+        self.prefetch = prefetch
+        if prefetch:
+            pin = self.device.type == 'cuda' and torch.cuda.is_available()
+            self.tensors = tuple(t.cpu().contiguous().pin_memory() if pin else t.cpu().contiguous() for t in tensors)
+        else:
+            self.tensors = tuple(t.to(self.device).contiguous() for t in tensors)
+
+    def __len__(self):
+        return (self.tensors[0].shape[0] + self.batch_size - 1) // self.batch_size
+
+    def _batch(self, start):
+        batch = tuple(t[start: start + self.batch_size] for t in self.tensors)
+        if self.prefetch:
+            batch = tuple(t.to(self.device, non_blocking=True) for t in batch)
+        return batch
+
+    def __iter__(self):
+        n = self.tensors[0].shape[0]
+        if not self.prefetch:
+            for start in range(0, n, self.batch_size):
+                yield self._batch(start)
+            return
+
+        batch = self._batch(0) if n > 0 else None
+        for start in range(self.batch_size, n + self.batch_size, self.batch_size):
+            upcoming = self._batch(start) if start < n else None
+            yield batch
+            batch = upcoming
+
+
+def receptive_field(X, mask, positions, model):
+    """Sorted indices of the residues that the ProteinMPNN embeddings of positions depend on.
+
+    Every encoder and decoder layer passes messages between the top_k nearest (Ca) neighbors, so a residue only sees
+    residues within one neighbor hop per layer. Neighbors are looked up in a KD-tree of the resolved residues of X
+    [1, L, 4, 3] with a small distance margin, so ties and rounding can only add residues to the field.
+    """
+    prot_mpnn = model.prot_mpnn
+    top_k = prot_mpnn.features.top_k
+    present = np.flatnonzero(mask[0].cpu().numpy() > 0)
+    if present.shape[0] <= top_k:  # every residue neighbors all others
+        return np.arange(X.shape[1])
+
+    ca = X[0, present, 1].cpu().numpy().astype(np.float64)
+    tree = cKDTree(ca)
+    kth, _ = tree.query(ca, k=top_k)
+    neighbors = [np.zeros(0, dtype=np.int64)] * X.shape[1]  # missing residues are nobody's neighbors
+    for i, ball in zip(present, tree.query_ball_point(ca, kth[:, -1] + 1e-3)):
+        neighbors[i] = present[ball]
+
+    field = frontier = np.unique(positions)
+    for _ in range(len(prot_mpnn.encoder_layers) + len(prot_mpnn.decoder_layers)):
+        reached = np.unique(np.concatenate([field] + [neighbors[i] for i in frontier]))
+        frontier, field = np.setdiff1d(reached, field), reached
+    return field
+
+
+def crop_features(crop, *features):
+    """Featurized tensors [1, L, ...] restricted to the residues crop"""
+    crop = torch.as_tensor(crop, device=features[0].device)
+    return tuple(t[:, crop] for t in features)
+
 
+def crop_cache_key(key, crop):
+    """EncoderCache key of a cropped structure (None without a key)"""
+    if key is None:
+        return None
+    return hashlib.sha1(f"{key} {np.asarray(crop).tolist()}".encode()).hexdigest()
+
+
+def run_single_ssm_batch(pdbs, cfg, model, device='cuda', cache=None, keys=None, positions=None):
+    """Runs single-mutant SSM sweeps for several structures with one ProteinMPNN pass.
+
+    With an EncoderCache, keys holds the cache key of each structure and only uncached structures are encoded.
+    Returns a list of (ddg [L, 21], S [L]) per structure, normalized to the wildtype amino acid.
+    For a ModelEnsemble, ddg holds every member: [members, L, 21].
+
+    With positions (0-based, single structure only), the network only runs on their receptive field and ddg is NaN
+    at all other positions.
+    """
+    if positions is not None and len(pdbs) != 1:
+        raise ValueError("positions are only supported for a single structure")
     model.eval()
     model.to(device)
-    stime = time.time()
 
     # placeholder mutation to keep featurization from throwing error
-    pdb["mutation"] = Mutation([0], ["A"], ["A"], [0.0], "")
+    for pdb in pdbs:
+        pdb["mutation"] = Mutation([0], ["A"], ["A"], [0.0], "")
 
     # featurize input
-    batch = tied_featurize_mut([pdb])
-    (
-        X,
-        S,
-        mask,
-        lengths,
-        chain_M,
-        chain_encoding_all,
-        residue_idx,
-        mut_positions,
-        mut_wildtype_AAs,
-        mut_mutant_AAs,
-        mut_ddGs,
-        atom_mask,
-    ) = batch
+    X, S, mask, lengths, chain_M, chain_encoding_all, residue_idx = tied_featurize_mut(pdbs)[:7]
 
     X = X.to(device)
     S = S.to(device)
     mask = mask.to(device)
-    lengths = torch.Tensor(lengths).to(device)
     chain_M = chain_M.to(device)
     chain_encoding_all = chain_encoding_all.to(device)
     residue_idx = residue_idx.to(device)
-    mut_ddGs = mut_ddGs.to(device)
 
-    # do single pass through thermompnn
-    X = torch.nan_to_num(X, nan=0.0)
-    all_mpnn_hid, mpnn_embed, _, mpnn_edges = model.prot_mpnn(
-        X, S, mask, chain_M, residue_idx, chain_encoding_all
-    )
+    if positions is not None:
+        full_S, full_length = S, lengths[0]
+        crop = receptive_field(X, mask, positions, model)
+        X, S, mask, chain_M, chain_encoding_all, residue_idx = crop_features(
+            crop, X, S, mask, chain_M, chain_encoding_all, residue_idx
+        )
+        lengths, keys = [len(crop)], [crop_cache_key(keys[0] if keys else None, crop)]
+        print(f"Cropped to the receptive field of {len(positions)} positions: {len(crop)} of {full_length} residues")
+
+    with torch.no_grad():
+        # do single pass through thermompnn
+        X = torch.nan_to_num(X, nan=0.0)
+        if cache is None:
+            all_mpnn_hid, mpnn_embed, mpnn_edges, _ = model.prot_mpnn.embed(
+                X, S, mask, chain_M, residue_idx, chain_encoding_all
+            )
+        else:
+            all_mpnn_hid, mpnn_embed, mpnn_edges, _ = cache.embed(
+                model, keys, X, S, mask, chain_M, residue_idx, chain_encoding_all, lengths
+            )
+
+        all_mpnn_hid = torch.cat(all_mpnn_hid[: cfg.model.num_final_layers], -1)
+        all_mpnn_hid = torch.cat([all_mpnn_hid, mpnn_embed], -1).flatten(0, 1)  # [B * L, E]
+
+        ddg = run_heads(model, _single_head, all_mpnn_hid, S.flatten())  # [(members,) B * L, 21]
+        ddg = ddg.unflatten(-2, S.shape)  # [(members,) B, L, 21]
+
+    if positions is not None:  # back to full length, NaN outside of positions
+        keep = np.flatnonzero(np.isin(crop, positions))
+        full = torch.full(ddg.shape[:-2] + (full_length, 21), torch.nan, device=ddg.device)
+        full[..., 0, crop[keep], :] = ddg[..., 0, keep, :]
+        ddg, S, lengths = full, full_S, [full_length]
+
+    return [(ddg[..., b, :length, :], S[b, :length]) for b, length in enumerate(lengths)]
 
-    all_mpnn_hid = torch.cat(all_mpnn_hid[: cfg.model.num_final_layers], -1)
-    all_mpnn_hid = torch.squeeze(torch.cat([all_mpnn_hid, mpnn_embed], -1), 0)  # [L, E]
 
+def _single_head(model, all_mpnn_hid, S):
+    """Single mutant ddG [B * L, 21] of the head of model, normalized to the wildtype amino acid S [B * L]"""
     all_mpnn_hid = model.light_attention(torch.unsqueeze(all_mpnn_hid, -1))
 
-    ddg = model.ddg_out(all_mpnn_hid)  # [L, 21]
+    ddg = model.ddg_out(all_mpnn_hid)  # [B * L, 21]
 
     # subtract wildtype ddgs to normalize
-    S = torch.squeeze(S)  # [L, ]
+    wt_ddg = batched_index_select(ddg, dim=-1, index=S)  # [B * L, 1]
+    return ddg - wt_ddg.expand(-1, 21)
 
-    wt_ddg = batched_index_select(ddg, dim=-1, index=S)  # [L, 1]
-    ddg = ddg - wt_ddg.expand(-1, 21)  # [L, 21]
+
+def run_single_ssm(pdb, cfg, model, device='cuda', cache=None, key=None, positions=None):
+    """Runs single-mutant SSM sweep with ThermoMPNN v2 (only at positions if given, see run_single_ssm_batch)"""
+    stime = time.time()
+    ddg, S = run_single_ssm_batch([pdb], cfg, model, device=device, cache=cache, keys=[key], positions=positions)[0]
     etime = time.time()
     elapsed = etime - stime
-    length = ddg.shape[0]
+    length = S.shape[0]
     print(
         f"ThermoMPNN single mutant predictions generated for protein of length {length} in {round(elapsed, 2)} seconds."
     )
@@ -295,6 +482,7 @@ def run_single_ssm(pdb, cfg, model, device='cuda'):
 
 def expand_additive(ddg):
     """Uses torch broadcasting to add all possible single mutants to each other in a vectorized operation."""
+    warnings.warn("expand_additive is deprecated, use additive_ssm_rows", DeprecationWarning, stacklevel=2)
     # ddg [L, 21]
     dims = ddg.shape
     ddgA = ddg.reshape(dims[0], dims[1], 1, 1)  # [L, 21, 1, 1]
@@ -302,76 +490,105 @@ def expand_additive(ddg):
     ddg = ddgA + ddgB  # L, 21, L, 21
 
     # mask out diagonal representing two mutations at the same position - this is invalid
-    for i in range(dims[0]):
-        ddg[i, :, i, :] = torch.nan
+    diag = np.arange(dims[0])
+    ddg[diag, :, diag, :] = torch.nan
 
     return ddg
 
 
-def format_output_single(ddg, S, threshold=-0.5):
-    """Converts raw SSM predictions into nice format for analysis"""
-    ALPHABET = "ACDEFGHIKLMNPQRSTVWYX"
-    ddg = ddg.cpu().detach().numpy()
-    ddg = ddg[:, :20]
+def single_mutation_rows(ddg, S, threshold=-0.5):
+    """Single mutants with ddG <= threshold as numpy arrays like iter_epistatic_ssm: pos, wtAA, mutAA [n, 1] and ddg
+    [n] (or [n, members] for ensemble predictions [members, L, 21], filtered on the member mean)"""
+    ddg = ddg.cpu().detach().numpy()[..., :20]
+    members = ddg if ddg.ndim == 3 else None
+    if members is not None:
+        ddg = members.mean(0)
 
     keep_L, keep_AA = np.where(ddg <= threshold)
-    ddg = ddg[ddg <= threshold]  # [N, ]
+    ddg = ddg[keep_L, keep_AA] if members is None else members[:, keep_L, keep_AA].T
+    return keep_L[:, None], np.asarray(S.cpu())[keep_L, None], keep_AA[:, None], ddg
+
+
+def format_output_single(ddg, S, threshold=-0.5):
+    """Converts raw SSM predictions into nice format for analysis.
 
-    mutlist = []
-    for L_idx, AA_idx in tqdm(zip(keep_L, keep_AA)):
-        wtAA = ALPHABET[S[L_idx]]
-        mutAA = ALPHABET[AA_idx]
-        mutlist.append(wtAA + str(L_idx + 1) + mutAA)
+    Ensemble predictions [members, L, 21] are filtered on the member mean and returned as [N, members].
+    """
+    pos, wtAA, mutAA, ddg = single_mutation_rows(ddg, S, threshold)
+    return ddg, single_mutation_names(pos, wtAA, mutAA)
 
-    return ddg, mutlist
 
+def iter_additive_ssm(ddg, S, threshold, pdb, distance, chunk_size=4096):
+    """Additive double mutants with ddG <= threshold of the residue pairs within distance (KD-tree neighbor list).
 
-def format_output_double(ddg, S, threshold, pdb, distance):
-    """Converts raw SSM predictions into nice format for analysis"""
-    stime = time.time()
-    ALPHABET = "ACDEFGHIKLMNPQRSTVWYX"
-    ddg = ddg.cpu().detach().numpy()  # [L, 21]
-    L, AA = ddg.shape
-
-    ddg = expand_additive(ddg)  # [L, 21, L, 21]
-    ddg = ddg[:, :20, :, :20]  # drop X predictions
-
-    # Pre-mask matrix with distance constraints for speedup
-    dmat = get_dmat(pdb)
-    assert ddg.shape[0] == dmat.shape[0]
-    valid_mask = (
-        (ddg <= threshold)
-        * (dmat < distance)[:, None, :, None]
-        * (dmat != 0.0)[:, None, :, None]
-    )
-    p1s, a1s, p2s, a2s = np.where(valid_mask)
+    Pairs are scored in chunks of chunk_size, so memory scales with the number of contacts instead of (L x 21)^2, and
+    each chunk is yielded as numpy arrays like iter_epistatic_ssm: pos, wtAA, mutAA [n, 2] and ddg [n] (or [n, members]
+    for ensemble predictions [members, L, 21], filtered on the member mean).
+    """
+    ddg = ddg.cpu().detach().numpy()[..., :20]  # [L, 20], drop X predictions
+    members = np.moveaxis(ddg, 0, -1) if ddg.ndim == 3 else None  # [L, 20, members]
+    if members is not None:
+        ddg = members.mean(-1)
+    S = np.asarray(S.cpu())
+
+    pairs, _ = get_contact_pairs(pdb, distance)  # [P, 2] with p1 < p2
+    aa = np.arange(20)
+    for start in range(0, pairs.shape[0], chunk_size):
+        p1, p2 = pairs[start: start + chunk_size].T
+        ddg_pair = ddg[p1][:, :, None] + ddg[p2][:, None, :]  # [chunk, 20, 20]
+
+        # drop self-mutations and ddgs that miss the threshold
+        valid = ddg_pair <= threshold
+        valid &= (aa[None, :, None] != S[p1, None, None]) & (aa[None, None, :] != S[p2, None, None])
+        c, a1, a2 = np.where(valid)
+        pos = np.stack([p1[c], p2[c]], -1)
+        if members is not None:
+            yield pos, S[pos], np.stack([a1, a2], -1), members[p1[c], a1] + members[p2[c], a2]  # [n, members]
+        else:
+            yield pos, S[pos], np.stack([a1, a2], -1), ddg_pair[c, a1, a2]
+
+
+def empty_rows(order):
+    """pos, wtAA, mutAA [0, order] and ddg [0] of a sweep without results"""
+    empty = np.zeros([0, order], dtype=np.int64)
+    return empty, empty, empty, np.zeros([0], dtype=np.float32)
 
-    cond = p1s < p2s  # filter to keep only upper triangle
-    p1s, a1s, p2s, a2s = p1s[cond], a1s[cond], p2s[cond], a2s[cond]
-    wt_seq = [ALPHABET[S[ppp]] for ppp in np.arange(L)]
 
-    mutlist, ddglist = [], []
-    for p1, a1, p2, a2 in tqdm(zip(p1s, a1s, p2s, a2s)):
-        wt1, wt2 = wt_seq[p1], wt_seq[p2]
-        mut1, mut2 = ALPHABET[a1], ALPHABET[a2]
+def additive_ssm_rows(ddg, S, threshold, pdb, distance, chunk_size=4096):
+    """All additive double mutants of iter_additive_ssm as numpy arrays: pos, wtAA, mutAA [n, 2] and ddg [n] (or
+    [n, members]), in the order of scanning the dense [L, 20, L, 20] tensor"""
+    stime = time.time()
+    chunks = list(tqdm(iter_additive_ssm(ddg, S, threshold, pdb, distance, chunk_size)))
+    if not chunks:  # no contacts at all
+        return empty_rows(2)
+    pos, wtAA, mutAA, ddg = (np.concatenate(x) for x in zip(*chunks))
 
-        if (wt1 != mut1) and (wt2 != mut2):  # drop self-mutations
-            mutation = f"{wt1}{p1 + 1}{mut1}:{wt2}{p2 + 1}{mut2}"
-            mutlist.append(mutation)
-            ddglist.append(ddg[p1, a1, p2, a2])
+    # same order as scanning the dense [L, 20, L, 20] tensor
+    order = np.lexsort((mutAA[:, 1], pos[:, 1], mutAA[:, 0], pos[:, 0]))
 
     etime = time.time()
     elapsed = etime - stime
     print(
         f"ThermoMPNN double mutant additive model predictions calculated in {round(elapsed, 2)} seconds."
     )
-    return ddglist, mutlist
+    return pos[order], wtAA[order], mutAA[order], ddg[order]
+
+
+def format_output_double(ddg, S, threshold, pdb, distance, chunk_size=4096):
+    """Converts raw SSM predictions into nice format for analysis (see additive_ssm_rows).
+
+    Ensemble predictions [members, L, 21] are filtered on the member mean and returned as [N, members].
+    """
+    pos, wtAA, mutAA, ddglist = additive_ssm_rows(ddg, S, threshold, pdb, distance, chunk_size)
+    mutlist = double_mutation_names(pos, wtAA, mutAA)
+    if ddglist.ndim == 2:
+        return ddglist, mutlist
+    return list(ddglist), mutlist
 
 
 def format_output_epistatic(ddg, S, pos, wtAA, mutAA, threshold=-0.5):
     "Converts raw SSM predictions into nice format for analysis."
     stime = time.time()
-    ALPHABET = "ACDEFGHIKLMNPQRSTVWYX"
     S = torch.squeeze(S)
 
     # filter out ddgs that miss the threshold
@@ -380,15 +597,7 @@ def format_output_epistatic(ddg, S, pos, wtAA, mutAA, threshold=-0.5):
     wtAA = wtAA[mask, :]
     mutAA = mutAA[mask, :]
     pos = pos[mask, :]
-    mut_list = []
-    # a bunch of repeats in here?!
-    for b in tqdm(range(ddg.shape[0])):
-        w1 = ALPHABET[wtAA[b, 0]]
-        w2 = ALPHABET[wtAA[b, 1]]
-        m1 = ALPHABET[mutAA[b, 0]]
-        m2 = ALPHABET[mutAA[b, 1]]
-        mut_name = f"{w1}{pos[b, 0] + 1}{m1}:{w2}{pos[b, 1] + 1}{m2}"
-        mut_list.append(mut_name)
+    mut_list = double_mutation_names(*(np.asarray(x.cpu()) for x in (pos, wtAA, mutAA)))
     etime = time.time()
     elapsed = etime - stime
     print(
@@ -397,66 +606,325 @@ def format_output_epistatic(ddg, S, pos, wtAA, mutAA, threshold=-0.5):
     return ddg, mut_list
 
 
-def run_epistatic_ssm(pdb, cfg, model, distance, threshold, batch_size, device="cuda"):
-    """Run epistatic model on double mutations"""
+def embed_ssm_structure(pdb, model, device="cuda", cache=None, key=None, positions=None):
+    """Featurizes pdb and runs ProteinMPNN on it once (on the receptive field of positions if given).
 
+    Returns X, mask, all_mpnn_hid, mpnn_embed, mpnn_edges, E_idx and crop, the residues that were kept (None
+    without positions). cache and key as in run_single_ssm.
+    """
     model.eval()
     model.to(device)
-    stime = time.time()
 
     # placeholder mutation to keep featurization from throwing error
     pdb["mutation"] = Mutation([0], ["A"], ["A"], [0.0], "")
 
     # featurize input
-    batch = tied_featurize_mut([pdb])
-    (
-        X,
-        S,
-        mask,
-        lengths,
-        chain_M,
-        chain_encoding_all,
-        residue_idx,
-        mut_positions,
-        mut_wildtype_AAs,
-        mut_mutant_AAs,
-        mut_ddGs,
-        atom_mask,
-    ) = batch
+    X, S, mask, lengths, chain_M, chain_encoding_all, residue_idx = tied_featurize_mut([pdb])[:7]
+    X, S, mask, chain_M, chain_encoding_all, residue_idx = (
+        t.to(device) for t in (X, S, mask, chain_M, chain_encoding_all, residue_idx)
+    )
 
-    X = X.to(device)
-    S = S.to(device)
-    mask = mask.to(device)
-    lengths = torch.Tensor(lengths).to(device)
-    chain_M = chain_M.to(device)
-    chain_encoding_all = chain_encoding_all.to(device)
-    residue_idx = residue_idx.to(device)
-    mut_ddGs = mut_ddGs.to(device)
+    crop = None
+    if positions is not None:
+        crop = receptive_field(X, mask, positions, model)
+        X, S, mask, chain_M, chain_encoding_all, residue_idx = crop_features(
+            crop, X, S, mask, chain_M, chain_encoding_all, residue_idx
+        )
+        full_length, lengths, key = lengths[0], [len(crop)], crop_cache_key(key, crop)
+        print(f"Cropped to the receptive field of {len(positions)} positions: {len(crop)} of {full_length} residues")
 
     # do single pass through thermompnn
     X = torch.nan_to_num(X, nan=0.0)
-    all_mpnn_hid, mpnn_embed, _, mpnn_edges = model.prot_mpnn(
-        X, S, mask, chain_M, residue_idx, chain_encoding_all
-    )
+    with torch.no_grad():
+        if cache is None:
+            all_mpnn_hid, mpnn_embed, mpnn_edges, E_idx = model.prot_mpnn.embed(
+                X, S, mask, chain_M, residue_idx, chain_encoding_all
+            )
+        else:
+            all_mpnn_hid, mpnn_embed, mpnn_edges, E_idx = cache.embed(
+                model, [key], X, S, mask, chain_M, residue_idx, chain_encoding_all, lengths
+            )
+    return X, mask, all_mpnn_hid, mpnn_embed, mpnn_edges, E_idx, crop
+
 
-    # grab double mutation inputs
-    MUT_POS, MUT_WT_AA, MUT_MUT_AA = get_ssm_mutations_double(pdb, distance)
-    dataset = SSMDataset(MUT_POS, MUT_WT_AA, MUT_MUT_AA)
-    loader = DataLoader(dataset, shuffle=False, batch_size=batch_size, num_workers=8)
+def iter_epistatic_ssm(pdb, cfg, model, distance, threshold, batch_size, device="cuda", top_k=None, cache=None,
+                       key=None, positions=None):
+    """Runs the epistatic model on every double mutant of the residue pairs within distance.
 
-    preds = run_double(
-        all_mpnn_hid, mpnn_embed, cfg, loader, batch_size, model, X, mask, mpnn_edges, device=device
+    Mutations with ddG <= threshold (None keeps all) are selected on the device and yielded batch by batch as numpy
+    arrays (pos [n, 2], wtAA [n, 2], mutAA [n, 2], ddg [n] or [n, members]), so memory does not grow with the
+    number of scored mutations. With top_k, only the top_k mutations with the lowest ddG are kept and yielded at the
+    end, sorted by ddG. cache, key and positions as in run_single_ssm; with positions, both residues of a pair must
+    be among them.
+    """
+    # grab position pairs; all 20 x 20 double mutants of a pair are scored together
+    MUT_POS, MUT_WT_AA = get_ssm_pairs_double(pdb, distance)
+    if positions is not None:
+        keep = np.isin(MUT_POS.numpy(), positions).all(-1)
+        MUT_POS, MUT_WT_AA = MUT_POS[keep], MUT_WT_AA[keep]
+
+    X, mask, all_mpnn_hid, mpnn_embed, mpnn_edges, E_idx, crop = embed_ssm_structure(
+        pdb, model, device, cache, key, positions
     )
-    ddg, mutations = format_output_epistatic(
-        preds, S, MUT_POS, MUT_WT_AA, MUT_MUT_AA, threshold
+    pair_pos = MUT_POS if crop is None else torch.as_tensor(np.searchsorted(crop, MUT_POS.numpy()))
+    wt_aa = MUT_WT_AA.to(device)
+
+    def chunk(pair, mut, ddg):
+        pair = pair.cpu().numpy()
+        return MUT_POS.numpy()[pair], MUT_WT_AA.numpy()[pair], mut.cpu().numpy(), ddg.cpu().numpy()
+
+    best = TopKDoubles(top_k) if top_k else None
+    batches = iter_double_factorized(
+        all_mpnn_hid, mpnn_embed, cfg, pair_pos, batch_size, model, X, mask, mpnn_edges, E_idx
     )
+    for start, ddg in batches:
+        pair, mut, ddg = select_pairs_double(ddg, wt_aa[start: start + ddg.shape[-3]], threshold)
+        pair = pair + start
+        if best is not None:
+            best.update(pair, mut, ddg)
+        elif pair.shape[0] > 0:
+            yield chunk(pair, mut, ddg)
+
+    if best is not None and best.result() is not None:
+        yield chunk(*best.result())
+
+
+def _label_table(pos, labels):
+    """Residue labels as an object array for element-wise string concatenation (1-based sequence indices if None)"""
+    if labels is None:
+        labels = np.arange(pos.max() + 1 if pos.size else 0) + 1
+    return np.asarray(labels).astype(str).astype(object)
+
+
+def single_mutation_names(pos, wtAA, mutAA, labels=None):
+    """Mutation names like "A12G" for pos, wtAA and mutAA [n, 1] (labels: residue number of each position).
+
+    Names are concatenated element-wise from amino acid and residue label lookup tables instead of per-row formatting.
+    """
+    AA = np.array(list("ACDEFGHIKLMNPQRSTVWYX"), dtype=object)
+    labels = _label_table(pos, labels)
+    return (AA[wtAA[:, 0]] + labels[pos[:, 0]] + AA[mutAA[:, 0]]).tolist()
+
+
+def double_mutation_names(pos, wtAA, mutAA, labels=None):
+    """Mutation names like "A12G:K15E" for pos, wtAA and mutAA [n, 2] (labels: residue number of each position), built
+    like single_mutation_names"""
+    AA = np.array(list("ACDEFGHIKLMNPQRSTVWYX"), dtype=object)
+    labels = _label_table(pos, labels)
+    first = AA[wtAA[:, 0]] + labels[pos[:, 0]] + AA[mutAA[:, 0]]
+    second = (":" + AA)[wtAA[:, 1]] + labels[pos[:, 1]] + AA[mutAA[:, 1]]
+    return (first + second).tolist()
+
+
+def epistatic_ssm_rows(pdb, cfg, model, distance, threshold, batch_size, device="cuda", top_k=None, cache=None,
+                       key=None, positions=None):
+    """Run epistatic model on double mutations (see iter_epistatic_ssm). Returns all batches as numpy arrays: pos,
+    wtAA, mutAA [n, 2] and ddg [n] (or [n, members])"""
+    stime = time.time()
+    chunks = list(iter_epistatic_ssm(pdb, cfg, model, distance, threshold, batch_size, device=device, top_k=top_k,
+                                     cache=cache, key=key, positions=positions))
+    rows = tuple(np.concatenate(x) for x in zip(*chunks)) if chunks else empty_rows(2)
 
     etime = time.time()
     elapsed = etime - stime
     print(
         f"ThermoMPNN double mutant epistatic model predictions generated in {round(elapsed, 2)} seconds."
     )
-    return ddg, mutations
+    return rows
+
+
+def run_epistatic_ssm(pdb, cfg, model, distance, threshold, batch_size, device="cuda", top_k=None, cache=None,
+                      key=None, positions=None):
+    """Run epistatic model on double mutations (see iter_epistatic_ssm). Returns (ddg, mutation names)"""
+    pos, wtAA, mutAA, ddg = epistatic_ssm_rows(pdb, cfg, model, distance, threshold, batch_size, device=device,
+                                               top_k=top_k, cache=cache, key=key, positions=positions)
+    return ddg, double_mutation_names(pos, wtAA, mutAA)
+
+
+def _remove_output(path):
+    """Removes an output file or NpySink directory if it exists"""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def stream_ssm_table(pdb, cfg, model, mode, out_path, output_format, threshold, distance, batch_size, device="cuda",
+                     top_k=None, ss_penalty=False, cache=None, key=None, positions=None):
+    """Runs an SSM sweep and writes it with the sink of output_format (see sinks.SINKS: the CSV table of
+    ThermoMPNN.process, typed columns in a Parquet or Arrow file, or NumPy arrays in a directory) batch by batch as
+    they are scored: the single mutant table at once, additive pairs per contact chunk (iter_additive_ssm) and
+    epistatic pairs per scoring batch (iter_epistatic_ssm).
+
+    The output is written under a temporary name, which is removed if the sweep fails, and moved into place when
+    done. Returns the number of mutations.
+    Like format_ssm_rows, CSV output raises a ValueError (without writing out_path) if none passed the filters; the
+    other formats are written empty.
+    """
+    stime = time.time()
+    ensemble = isinstance(model, ModelEnsemble)
+    order = 1 if mode == "single" else 2
+    options = {"sort_ddg": threshold <= -0.0} if output_format == "csv" else {}
+    try:
+        with SINKS[output_format](out_path + ".tmp", pdb, order, ensemble, ss_penalty, **options) as sink:
+            if mode in ("single", "additive"):
+                ddg, S = run_single_ssm(pdb, cfg, model, device=device, cache=cache, key=key, positions=positions)
+                if mode == "single":
+                    chunks = [single_mutation_rows(ddg, S, threshold)]
+                else:
+                    chunks = iter_additive_ssm(ddg, S, threshold, pdb, distance)
+            elif mode == "epistatic":
+                chunks = iter_epistatic_ssm(pdb, cfg, model, distance, threshold, batch_size, device=device,
+                                            top_k=top_k, cache=cache, key=key, positions=positions)
+            else:
+                raise ValueError("Invalid mode selected!")
+            for chunk in chunks:
+                if chunk[0].shape[0] > 0:
+                    sink.write(*chunk)
+        if output_format == "csv":
+            check_df_size(sink.rows)
+    except BaseException:  # also on interruption: no partial output is left behind
+        _remove_output(out_path + ".tmp")
+        raise
+    if os.path.isdir(out_path):  # NpySink output of an earlier run
+        shutil.rmtree(out_path)
+    os.replace(out_path + ".tmp", out_path)
+
+    etime = time.time()
+    elapsed = etime - stime
+    print(f"ThermoMPNN {mode} predictions written to {out_path} in {round(elapsed, 2)} seconds.")
+    return sink.rows
+
+
+def load_mutation_list(path):
+    """Mutation names from a CSV file (the "Mutation" column, or else the first column) or a JSON list of names
+    (or of lists of single mutations)"""
+    if path.endswith(".json"):
+        with open(path) as f:
+            names = json.load(f)
+        return [name if isinstance(name, str) else ":".join(name) for name in names]
+
+    df = pd.read_csv(path)
+    column = next((c for c in df.columns if str(c).lower() == "mutation"), None)
+    if column is None:  # no header
+        return pd.read_csv(path, header=None).iloc[:, 0].astype(str).str.strip().tolist()
+    return df[column].astype(str).str.strip().tolist()
+
+
+def parse_mutation_list(pdb, names):
+    """Parses mutation names in the output numbering, i.e. wildtype + chain + residue number + mutant with ":" between
+    the mutations of a variant (e.g. "TA20A" or "TA20A:LA21C").
+
+    Returns one int array [n, 3] of (0-based position, wildtype aa, mutant aa) per variant.
+    """
+    ALPHABET = "ACDEFGHIKLMNPQRSTVWYX"
+    index = {label: idx for idx, label in enumerate(idx_to_pdb_num(pdb, range(len(pdb["seq"]))))}
+    variants = []
+    for name in names:
+        variant = []
+        for mut in name.split(":"):
+            match = re.fullmatch(r"([A-Z])(\w-?\d+[A-Za-z]?)([A-Z])", mut.strip())
+            if match is None or match.group(2) not in index or match.group(3) not in ALPHABET[:20]:
+                raise ValueError(f"Invalid mutation {mut} in {name}, expected wildtype + chain + residue number + "
+                                 "mutant (e.g. TA20A)")
+            wt, label, mt = match.groups()
+            pos = index[label]
+            seq_wt = pdb["seq"][pos] if pdb["seq"][pos] in ALPHABET else "X"  # gaps are named X in the output
+            if seq_wt != wt:
+                raise ValueError(f"Wildtype of {mut} does not match residue {label} ({seq_wt}) of the PDB")
+            variant.append((pos, ALPHABET.index(wt), ALPHABET.index(mt)))
+        variant = np.array(variant, dtype=np.int64)
+        if np.unique(variant[:, 0]).shape[0] < variant.shape[0]:
+            raise ValueError(f"{name} mutates a residue more than once")
+        variants.append(variant)
+    return variants
+
+
+def score_mutation_list(pdb, cfg, model, mode, variants, batch_size=256, device="cuda", cache=None, key=None):
+    """Scores exactly the given variants (see parse_mutation_list) with one ProteinMPNN pass over the receptive field
+    of the mutated residues.
+
+    single and additive add up the single mutant ddGs of each variant. epistatic predicts single and double mutants
+    directly; higher-order variants get the sum of their single mutant ddGs plus the epistatic coupling
+    (ddG_ij - ddG_i - ddG_j) of every pair. Returns ddG [V] ([V, members] for a ModelEnsemble).
+    """
+    if not variants:
+        raise ValueError("No mutations to score")
+    stime = time.time()
+    muts = np.concatenate(variants)
+    owner = np.repeat(np.arange(len(variants)), [len(v) for v in variants])
+    positions = np.unique(muts[:, 0])
+
+    if mode in ("single", "additive"):
+        table, _ = run_single_ssm(pdb, cfg, model, device=device, cache=cache, key=key, positions=positions)
+        terms = table.cpu()[..., muts[:, 0], muts[:, 2]]  # [(members,) M]
+        term_owner, coef = torch.as_tensor(owner), torch.ones(muts.shape[0])
+
+    elif mode == "epistatic":
+        X, mask, all_mpnn_hid, mpnn_embed, mpnn_edges, E_idx, crop = embed_ssm_structure(
+            pdb, model, device, cache, key, positions
+        )
+        all_mpnn_hid = torch.cat(all_mpnn_hid[: cfg.model.num_final_layers], -1)
+
+        # unique single and double mutant terms of every variant
+        singles, pairs, terms, term_owner, coef = {}, {}, [], [], []
+        for v, variant in enumerate(variants):
+            variant = [(int(p), int(m)) for p, _, m in variant[np.argsort(variant[:, 0])]]
+            if len(variant) != 2:
+                for mut in variant:
+                    terms.append((0, singles.setdefault((mut,), len(singles))))
+                    term_owner.append(v)
+                    coef.append(1.0 if len(variant) == 1 else 2.0 - len(variant))
+            for pair in itertools.combinations(variant, 2):
+                terms.append((1, pairs.setdefault(pair, len(pairs))))
+                term_owner.append(v)
+                coef.append(1.0)
+        term_owner, coef = torch.as_tensor(term_owner), torch.as_tensor(coef)
+
+        def score(muts):
+            """ddG [(members,) T] of the mutations [T, N, 2] of (position, mutant aa)"""
+            if not muts:
+                return torch.zeros(([len(model)] if isinstance(model, ModelEnsemble) else []) + [0])
+            muts = torch.as_tensor(list(muts))
+            pos, mut = torch.as_tensor(np.searchsorted(crop, muts[..., 0].numpy())), muts[..., 1]
+            ddg = []
+            for pos_batch, mut_batch in TensorBatches(pos, mut, batch_size=batch_size, device=device):
+                edges = gather_pair_edges(mpnn_edges, E_idx, pos_batch)
+                ddg.append(run_heads(model, lambda m, *a: _double_head(m, cfg, *a), all_mpnn_hid, mpnn_embed,
+                                     edges, pos_batch, mut_batch).cpu())
+            return torch.cat(ddg, -1)
+
+        with torch.no_grad():
+            ddg_terms = torch.cat([score(singles), score(pairs)], -1)
+        kind, idx = torch.as_tensor(terms).T
+        terms = ddg_terms[..., idx + kind * len(singles)]
+
+    else:
+        raise ValueError("Invalid mode selected!")
+
+    ddg = torch.zeros(terms.shape[:-1] + (len(variants),), dtype=terms.dtype)
+    ddg = ddg.index_add(-1, term_owner, terms * coef.to(terms.dtype))
+    ddg = ddg.numpy()
+    ddg = ddg.T if ddg.ndim == 2 else ddg
+
+    etime = time.time()
+    print(f"ThermoMPNN scored {len(variants)} variants in {round(etime - stime, 2)} seconds.")
+    return ddg
+
+
+def format_mutation_df(ddg, names, pdb, variants, ss_penalty=False):
+    """Output DataFrame of score_mutation_list, in the order of names (ensembles as in format_ssm_rows)"""
+    spread = None
+    if np.ndim(ddg) == 2:
+        ddg, spread = ddg.mean(-1), ddg.std(-1)
+    if ss_penalty:
+        bad_resns = get_disulfide_residues(pdb)
+        broken = np.array([bool((np.isin(v[:, 0], bad_resns) & (v[:, 1] != v[:, 2])).any()) for v in variants])
+        ddg = np.where(broken, ddg + ddg.dtype.type(DISULFIDE_PENALTY), ddg)
+    df = pd.DataFrame({"ddG (kcal/mol)": ddg, "Mutation": names})
+    if spread is not None:
+        df["ddG std (kcal/mol)"] = spread
+    return df
 
 
 def check_df_size(size):
@@ -465,6 +933,63 @@ def check_df_size(size):
             "No valid mutations passed your distance and ddG filters. Please increase one or both of these parameters and try again.")
 
 
+def output_labels(pdb):
+    """PDB numbering (chain + residue number) of every position index, or None (1-based sequence indices) if the PDB
+    cannot be renumbered"""
+    labels = residue_labels(pdb)
+    if labels.shape[0] < len(pdb["seq"]):
+        print(
+            "PDB renumbering failed (sorry!) You can still use the raw position data. "
+            "Or, you can renumber your PDB, fill any weird gaps, and try again."
+        )
+        return None
+    return labels
+
+
+def format_ssm_rows(pos, wtAA, mutAA, ddg, pdb_data, mode, threshold=-0.5, distance=5.0, ss_penalty=False):
+    """Filters, sorts and renumbers SSM predictions into the output DataFrame.
+
+    Takes the numpy arrays of single_mutation_rows, additive_ssm_rows or epistatic_ssm_rows (pos, wtAA, mutAA
+    [n, order] and ddg [n] or [n, members]). The distance filter, disulfide penalty and sorting work on these index
+    arrays, and mutation names are only built for the rows that are kept. Ensemble predictions are reported as the
+    member mean plus their standard deviation.
+    """
+    check_df_size(pos.shape[0])
+    spread = None
+    if np.ndim(ddg) == 2:
+        ddg, spread = ddg.mean(-1), ddg.std(-1)
+
+    keep = ~np.isnan(ddg)
+    dist = None
+    if mode != "single":
+        dist = spatial_index(pdb_data).distances(pos)
+        keep &= (dist <= distance) & (dist != 0.0)
+        print("Distance matrix generated.")
+
+    if ss_penalty:
+        bad_resns = np.array(get_disulfide_residues(pdb_data), dtype=np.int64)
+        broken = (np.isin(pos, bad_resns) & (wtAA != mutAA)).any(-1)
+        ddg = np.where(broken, ddg + ddg.dtype.type(DISULFIDE_PENALTY), ddg)
+
+    order = np.flatnonzero(keep)
+    if threshold <= -0.0:
+        order = order[np.argsort(ddg[order], kind="quicksort")]
+    if mode != "single":  # sort to have neat output order
+        order = order[np.lexsort((pos[order, 1], pos[order, 0]))]
+    check_df_size(order.shape[0])
+
+    pos, wtAA, mutAA = pos[order], wtAA[order], mutAA[order]
+    labels = output_labels(pdb_data)
+    names = single_mutation_names if mode == "single" else double_mutation_names
+    df = pd.DataFrame({"ddG (kcal/mol)": ddg[order], "Mutation": names(pos, wtAA, mutAA, labels)})
+    if dist is not None:
+        df["CA-CA Distance"] = dist[order].round(2)
+    if spread is not None:
+        df["ddG std (kcal/mol)"] = spread[order]
+    print("ThermoMPNN predictions renumbered.")
+    return df
+
+
 class ThermoMPNN:
     """
     ThermoMPNN class for running ThermoMPNN models.
@@ -479,6 +1004,23 @@ class ThermoMPNN:
             To save all mutations, set this really high (e.g., 100).
         distance (float, optional): Filter for double mutant predictions using pairwise Ca distance cutoff (default is 5 A).
         ss_penalty (bool, optional): Add explicit disulfide breakage penalty. Default is False.
+        top_k (Optional[int], optional): Only keep the top_k epistatic double mutants with the lowest ddG (on top
+            of the threshold). Defaults to None.
+        positions (Optional[List[str]], optional): Only mutate these residues, given as chain + residue number (e.g.
+            A45) or ranges (A40-60). The network then only runs on the part of the structure these residues see,
+            with the same predictions as a full run. Double mutants need both residues among them. Defaults to None.
+        mutations (Optional[Union[str, List[str]]], optional): Score only these variants instead of a scan: a CSV or
+            JSON file (see load_mutation_list) or a list of names in the output numbering, e.g. "TA20A:LA21C".
+            Single and additive modes add up single mutant ddGs; see score_mutation_list for the epistatic model.
+            threshold, distance and top_k do not apply. Defaults to None.
+        ensemble (int, optional): Number of ensemble checkpoints to average. The members share one ProteinMPNN pass
+            and the output gains a "ddG std (kcal/mol)" column with their spread. Defaults to 1.
+        cache (Optional[EncoderCache], optional): Reuse ProteinMPNN encoder outputs across runs (e.g., one cache
+            shared by single, additive and epistatic runs on the same PDB). Defaults to None.
+        output_format (str, optional): Format of the output written batch by batch by stream (see sinks.SINKS):
+            "csv" for the table of process, "parquet" / "arrow" for typed columns (see sinks.ColumnarSink; needs
+            pyarrow) or "npy" for a dense single mutant matrix / sparse double mutant arrays (see sinks.NpySink).
+            Defaults to "csv".
     """
 
     def __init__(
@@ -492,6 +1034,12 @@ class ThermoMPNN:
             distance: float = 5.0,
             ss_penalty: bool = False,
             device: str = 'cuda',
+            top_k: Optional[int] = None,
+            positions: Optional[List[str]] = None,
+            mutations: Optional[Union[str, List[str]]] = None,
+            ensemble: int = 1,
+            cache: Optional[EncoderCache] = None,
+            output_format: str = "csv",
     ) -> None:
         self.pdb = pdb
         self.out = out
@@ -502,6 +1050,18 @@ class ThermoMPNN:
         self.ss_penalty = ss_penalty
         self.mode = mode
         self.device = device
+        self.top_k = top_k
+        self.positions = positions
+        self.mutations = mutations
+        self.ensemble = ensemble
+        self.cache = cache
+        self.output_format = output_format
+        self.cfg = None
+        self.model = None
+        if output_format not in SINKS:
+            raise ValueError(f"Invalid output format {output_format}, choose from {', '.join(SINKS)}")
+        if output_format != "csv" and mutations is not None:
+            raise ValueError("Scores of mutation lists are only written as csv")
 
         self.pick_device()
 
@@ -523,74 +1083,135 @@ class ThermoMPNN:
         print(f"Using device: {self.device}")
         print('-' * 79)
 
+    def load_model(self):
+        """Loads the config and model of the selected mode once and keeps them for later calls"""
+        if self.model is None:
+            self.cfg = get_config(self.mode)
+            self.model = get_ensemble(self.mode, self.cfg, self.ensemble)
+        return self.cfg, self.model
+
+    def cache_key(self, pdb_path, chains):
+        """EncoderCache key of a PDB file (None without a cache)"""
+        if self.cache is None:
+            return None
+        return self.cache.key(pdb_path, chains, self.load_model()[1])
+
+    def resolve_positions(self, pdb_data):
+        """0-based indices of the selected positions in pdb_data (None for all)"""
+        if self.positions is None:
+            return None
+        return resolve_positions(pdb_data, self.positions)
+
     def process(self, save_csv:bool=True) -> pd.DataFrame:
         '''
         Run ThermoMPNN on a PDB file.
         '''
 
-        cfg = get_config(self.mode)
-        model = get_model(self.mode, cfg)
+        cfg, model = self.load_model()
+        key = self.cache_key(self.pdb, self.chains)
         pdb_data = load_pdb(self.pdb, self.chains)
         pdbname = os.path.basename(self.pdb)
         print(f"Loaded PDB {pdbname}")
+        positions = self.resolve_positions(pdb_data)
+
+        if self.mutations is not None:
+            names = load_mutation_list(self.mutations) if isinstance(self.mutations, str) else list(self.mutations)
+            variants = parse_mutation_list(pdb_data, names)
+            ddg = score_mutation_list(pdb_data, cfg, model, self.mode, variants, self.batch_size, device=self.device,
+                                      cache=self.cache, key=key)
+            df = format_mutation_df(ddg, names, pdb_data, variants, self.ss_penalty)
+            if save_csv:
+                df.to_csv(self.out + ".csv")
+            return df
 
         if (self.mode == "single") or (self.mode == "additive"):
-            ddg, S = run_single_ssm(pdb_data, cfg, model, device=self.device)
+            ddg, S = run_single_ssm(pdb_data, cfg, model, device=self.device, cache=self.cache, key=key,
+                                    positions=positions)
 
             if self.mode == "single":
-                ddg, mutations = format_output_single(ddg, S, self.threshold)
+                rows = single_mutation_rows(ddg, S, self.threshold)
             else:
-                ddg, mutations = format_output_double(
-                    ddg, S, self.threshold, pdb_data, self.distance
-                )
+                rows = additive_ssm_rows(ddg, S, self.threshold, pdb_data, self.distance)
 
         elif self.mode == "epistatic":
-            ddg, mutations = run_epistatic_ssm(
-                pdb_data, cfg, model, self.distance, self.threshold, self.batch_size, device=self.device
+            rows = epistatic_ssm_rows(
+                pdb_data, cfg, model, self.distance, self.threshold, self.batch_size, device=self.device,
+                top_k=self.top_k, cache=self.cache, key=key, positions=positions
             )
 
         else:
             raise ValueError("Invalid mode selected!")
 
-        df = pd.DataFrame({"ddG (kcal/mol)": ddg, "Mutation": mutations})
-
-        check_df_size(df.shape[0])
-
-        if self.mode != "single":
-            df = distance_filter(df, pdb_data, self.distance)
+        df = format_ssm_rows(*rows, pdb_data, self.mode, self.threshold, self.distance, self.ss_penalty)
 
-        if self.ss_penalty:
-            df = disulfide_penalty(df, pdb_data, self.mode)
-
-        df = df.dropna(subset=["ddG (kcal/mol)"])
-        if self.threshold <= -0.0:
-            df = df.sort_values(by=["ddG (kcal/mol)"])
+        if save_csv:
+            df.to_csv(self.out + ".csv")
 
-        if self.mode != "single":  # sort to have neat output order
-            df[["mut1", "mut2"]] = df["Mutation"].str.split(":", n=2, expand=True)
-            df["pos1"] = df["mut1"].str[1:-1].astype(int) + 1
-            df["pos2"] = df["mut2"].str[1:-1].astype(int) + 1
+        return df
 
-            df = df.sort_values(by=["pos1", "pos2"])
-            df = df[["ddG (kcal/mol)", "Mutation", "CA-CA Distance"]].reset_index(drop=True)
+    def stream(self) -> str:
+        '''
+        Run ThermoMPNN on a PDB file and save <out>.csv (or <out>.parquet, <out>.arrow, <out>_arrays/, see
+        output_format). Predictions are written while they are scored instead of being collected in memory first
+        (see stream_ssm_table). Returns the output path.
+        '''
+        if self.mutations is not None:
+            self.process(save_csv=True)
+            return self.out + ".csv"
 
-        check_df_size(df.shape[0])
+        cfg, model = self.load_model()
+        key = self.cache_key(self.pdb, self.chains)
+        pdb_data = load_pdb(self.pdb, self.chains)
+        print(f"Loaded PDB {os.path.basename(self.pdb)}")
+        return self.stream_table(self.output_format, cfg, model, key, pdb_data)
+
+    def stream_table(self, output_format, cfg, model, key, pdb_data):
+        out_path = self.out + SINKS[output_format].extension
+        stream_ssm_table(
+            pdb_data, cfg, model, self.mode, out_path, output_format, self.threshold, self.distance,
+            self.batch_size, device=self.device, top_k=self.top_k, ss_penalty=self.ss_penalty, cache=self.cache,
+            key=key, positions=self.resolve_positions(pdb_data)
+        )
+        return out_path
+
+    def arrays(self):
+        '''
+        Run ThermoMPNN on a PDB file, save the "npy" output (<out>_arrays/) and return its arrays without any
+        per-mutation string formatting: the single mutant matrix ddg [L, 20] or the double mutant COO arrays pos1, aa1,
+        pos2, aa2 and ddg (memory-mapped), plus the residue table (see sinks.load_ssm_arrays).
+        '''
+        if self.mutations is not None:
+            raise ValueError("Scores of mutation lists are only written as csv")
+        cfg, model = self.load_model()
+        key = self.cache_key(self.pdb, self.chains)
+        pdb_data = load_pdb(self.pdb, self.chains)
+        print(f"Loaded PDB {os.path.basename(self.pdb)}")
+        return load_ssm_arrays(self.stream_table("npy", cfg, model, key, pdb_data))
 
-        try:
-            df = renumber_pdb(df, pdb_data, self.mode)
 
-        except (KeyError, IndexError):
-            print(
-                "PDB renumbering failed (sorry!) You can still use the raw position data. Or, you can renumber your PDB, fill any weird gaps, and try again."
-            )
+def add_cache_arguments(parser):
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        help="directory to cache ProteinMPNN encoder outputs in, so that repeated or multi-mode runs on the same "
+             "PDB skip the encoder. Default is no cache.",
+    )
+    parser.add_argument(
+        "--cache_size", type=float, default=8.0, help="maximum size of the --cache_dir cache in GB (default 8)"
+    )
 
-        if save_csv:
-            df.to_csv(self.out + ".csv")
 
-        return df
+def cache_from_args(args):
+    if args.cache_dir is None:
+        return None
+    return EncoderCache(args.cache_dir, max_disk=int(args.cache_size * 2 ** 30))
 
 
 def main():
+    # imported here since batch_ssm and server build on this module
+    from thermompnn.batch_ssm import add_batch_arguments, batch_main
+    from thermompnn.server import add_serve_arguments, serve_main
+
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--mode",
@@ -634,7 +1255,65 @@ def main():
     parser.add_argument(
         "--device", type=str, help="device to use", default="cpu"
     )
+    parser.add_argument(
+        "--top_k",
+        type=int,
+        help="only keep the top K epistatic double mutants with the lowest ddG. Default is to keep all.",
+    )
+    parser.add_argument(
+        "--positions",
+        nargs="+",
+        help="residues to mutate, as chain + residue number or ranges. Only their receptive field of the structure "
+             "is run. Default is None, which will use all residues. Example: A45 A50-60 B12",
+    )
+    parser.add_argument(
+        "--mutations",
+        type=str,
+        help="CSV (Mutation column) or JSON file of variants to score instead of a full scan, named like the output "
+             "(e.g. TA20A or TA20A:LA21C for a double mutant). Default is None.",
+    )
+    parser.add_argument(
+        "--ensemble",
+        type=int,
+        default=1,
+        help="number of ensemble checkpoints to average (mean and std are reported). Default is 1.",
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=["csv", "parquet", "arrow", "npy"],
+        default="csv",
+        help="output format. parquet and arrow store typed position, amino acid and ddG columns (needs pyarrow), npy "
+             "a dense L x 20 single mutant matrix or sparse double mutant arrays in <out>_arrays/. All formats are "
+             "written as batches are scored. Default is csv.",
+    )
+    add_cache_arguments(parser)
+    subparsers = parser.add_subparsers(dest="command")
+    add_batch_arguments(
+        subparsers.add_parser("batch", help="run SSM sweeps over many PDB files (thermompnn batch -h for options)")
+    )
+    add_serve_arguments(
+        subparsers.add_parser("serve", help="keep the models loaded and serve SSM requests over HTTP or a Unix socket "
+                                            "(thermompnn serve -h for options)")
+    )
+    export_parser = subparsers.add_parser(
+        "export", help="write fused, memory-mapped weight files of the checkpoints for faster model loading"
+    )
+    export_parser.add_argument("--mode", type=str, help="mode to export (single | additive | epistatic)",
+                               default="single")
+    export_parser.add_argument("--ensemble", type=int, default=1, help="number of ensemble checkpoints to export")
     args = parser.parse_args()
+    if args.command == "export":
+        for path in export_fused(args.mode, args.ensemble):
+            print(f"Fused weights written to {path}")
+        return
+    if args.command == "batch":
+        batch_main(args)
+        return
+    if args.command == "serve":
+        serve_main(args)
+        return
+
     m = ThermoMPNN(
         pdb=args.pdb,
         out=args.out,
@@ -645,5 +1324,11 @@ def main():
         distance=args.distance,
         ss_penalty=args.ss_penalty,
         device=args.device,
+        top_k=args.top_k,
+        positions=args.positions,
+        mutations=args.mutations,
+        ensemble=args.ensemble,
+        cache=cache_from_args(args),
+        output_format=args.format,
     )
-    m.process()
+    m.stream()
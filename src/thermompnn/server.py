@@ -0,0 +1,422 @@
+import http.client
+import io
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from thermompnn.batch_ssm import _count_resolved, bucket_by_length
+from thermompnn.encoder_cache import EncoderCache
+from thermompnn.run import (ThermoMPNN, add_cache_arguments,
+                            additive_ssm_rows, cache_from_args,
+                            epistatic_ssm_rows, format_ssm_rows,
+                            run_single_ssm_batch, single_mutation_rows)
+from thermompnn.ssm_utils import load_pdb
+
+MODES = ("single", "additive", "epistatic")
+
+
+class _Request:
+    """One queued SSM request; the worker fills in result or error and sets done"""
+
+    def __init__(self, pdb_data, mode, options, key=None):
+        self.pdb_data = pdb_data
+        self.mode = mode
+        self.family = "epistatic" if mode == "epistatic" else "single"
+        self.options = options
+        self.key = key
+        self.length = len(pdb_data["seq"])
+        self.submitted = time.perf_counter()
+        self.started = None
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SSMServer:
+    """
+    Resident ThermoMPNN SSM server. Models are loaded once and kept in memory, and concurrent single / additive
+    requests are coalesced into shared length-bucketed ProteinMPNN passes (see ThermoMPNNBatch).
+    A request waits at most max_wait seconds for other requests to share its pass. Single / additive and epistatic
+    requests have separate queues and worker threads, so a long epistatic scan does not hold up the others.
+    Args:
+        device (str, optional): Device to use. Defaults to 'cpu'.
+        max_residues (int, optional): Maximum number of (padded) residues per ProteinMPNN pass. Defaults to 4096;
+            0 runs one structure per pass, i.e. turns coalescing off.
+        max_wait (float, optional): Latency budget in seconds for coalescing requests. Defaults to 0.01.
+        batch_size (int, optional): Batch size of the epistatic model. Defaults to 256.
+        ensemble (int, optional): Number of ensemble checkpoints to average. Defaults to 1.
+        cache (Optional[EncoderCache], optional): Encoder output cache shared by all requests. Defaults to None.
+    """
+
+    def __init__(
+            self,
+            device: str = 'cpu',
+            max_residues: Optional[int] = None,
+            max_wait: float = 0.01,
+            batch_size: int = 256,
+            ensemble: int = 1,
+            cache: Optional[EncoderCache] = None,
+    ) -> None:
+        self.runners = {
+            family: ThermoMPNN(None, mode=family, batch_size=batch_size, device=device, ensemble=ensemble,
+                               cache=cache)
+            for family in ("single", "epistatic")
+        }
+        self.device = self.runners["single"].device
+        self.max_residues = 4096 if max_residues is None else max_residues
+        self.max_wait = max_wait
+        self.batch_size = batch_size
+        self.cache = cache
+
+        self._pending = {family: deque() for family in self.runners}
+        self._cond = threading.Condition()
+        self._closed = False
+        self._workers = {}
+        self._load_lock = threading.Lock()
+        self._http = None
+
+        self._stats_lock = threading.Lock()
+        self._started = time.time()
+        self._counts = {"requests": 0, "errors": 0, "batches": 0, "batched_requests": 0}
+        self._latency = deque(maxlen=1000)
+        self._queue_wait = deque(maxlen=1000)
+
+    # ----- request handling -----
+
+    def submit(self, pdb_path, mode="single", chains=None, threshold=-0.5, distance=5.0):
+        """Queues an SSM request for a PDB file. Returns the request to wait on"""
+        if mode not in MODES:
+            raise ValueError("Invalid mode selected!")
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(pdb_path, chains, self.load_model("epistatic" if mode == "epistatic" else "single")[1])
+        options = {"threshold": threshold, "distance": distance}
+        request = _Request(load_pdb(pdb_path, chains), mode, options, key)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Server is closed")
+            self._pending[request.family].append(request)
+            self._cond.notify_all()
+        return request
+
+    def load_model(self, family):
+        """Config and model of a model family ("single" or "epistatic"), loaded once by whichever thread asks first"""
+        with self._load_lock:
+            return self.runners[family].load_model()
+
+    def predict(self, pdb_path, mode="single", chains=None, threshold=-0.5, distance=5.0, ss_penalty=False):
+        """Runs an SSM sweep through the shared queue and returns the same DataFrame as ThermoMPNN.process (which
+        raises a ValueError if no mutation passes the filters)"""
+        start = time.perf_counter()
+        try:
+            request = self.submit(pdb_path, mode, chains, threshold, distance)
+            request.done.wait()
+            if request.error is not None:
+                raise request.error
+
+            if mode == "epistatic":
+                rows = request.result
+            else:
+                ddg, S = request.result
+                if mode == "single":
+                    rows = single_mutation_rows(ddg, S, threshold)
+                else:
+                    rows = additive_ssm_rows(ddg, S, threshold, request.pdb_data, distance)
+            df = format_ssm_rows(*rows, request.pdb_data, mode, threshold, distance, ss_penalty)
+        except Exception:
+            self._record(start, None, error=True)
+            raise
+        self._record(start, request)
+        return df
+
+    def _record(self, start, request, error=False):
+        with self._stats_lock:
+            self._counts["requests"] += 1
+            self._counts["errors"] += int(error)
+            self._latency.append(time.perf_counter() - start)
+            if request is not None and request.started is not None:
+                self._queue_wait.append(request.started - request.submitted)
+
+    def stats(self):
+        """Queue depth, throughput and latency statistics (milliseconds)"""
+        with self._cond:
+            depth = sum(len(pending) for pending in self._pending.values())
+        with self._stats_lock:
+            latency = np.array(self._latency) * 1000
+            wait = np.array(self._queue_wait) * 1000
+            counts = dict(self._counts)
+
+        def summary(x):
+            if x.size == 0:
+                return {"mean": None, "p50": None, "p95": None, "max": None}
+            return {"mean": float(x.mean()), "p50": float(np.percentile(x, 50)),
+                    "p95": float(np.percentile(x, 95)), "max": float(x.max())}
+
+        batches = counts.pop("batches")
+        batched = counts.pop("batched_requests")
+        return {
+            "queue_depth": depth,
+            **counts,
+            "batches": batches,
+            "mean_batch_size": batched / batches if batches else None,
+            "latency_ms": summary(latency),
+            "queue_wait_ms": summary(wait),
+            "uptime_s": time.time() - self._started,
+        }
+
+    # ----- worker -----
+
+    def start(self):
+        """Starts the worker threads that run the models, one per model family"""
+        for family in self.runners:
+            if family not in self._workers:
+                self._workers[family] = threading.Thread(target=self._loop, args=(family,),
+                                                         name=f"thermompnn-{family}", daemon=True)
+                self._workers[family].start()
+        return self
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._http is not None:
+            self._http.shutdown()
+            self._http.server_close()
+        for worker in self._workers.values():
+            worker.join()
+
+    def _take(self, family):
+        """Blocks for the next request of a model family and collects the requests that arrive within the latency
+        budget (epistatic requests run one at a time)"""
+        pending = self._pending[family]
+        with self._cond:
+            while not pending:
+                if self._closed:
+                    return None
+                self._cond.wait()
+            batch = [pending.popleft()]
+            if family == "epistatic":
+                return batch
+
+            deadline = batch[0].submitted + self.max_wait
+            while True:
+                while pending:
+                    batch.append(pending.popleft())
+                remaining = deadline - time.perf_counter()
+                full = sum(request.length for request in batch) >= self.max_residues
+                if full or remaining <= 0 or self._closed:
+                    return batch
+                self._cond.wait(remaining)
+
+    def _loop(self, family):
+        while True:
+            batch = self._take(family)
+            if batch is None:
+                return
+            now = time.perf_counter()
+            for request in batch:
+                request.started = now
+
+            try:
+                cfg, model = self.load_model(family)
+                if family == "epistatic":
+                    request = batch[0]
+                    request.result = epistatic_ssm_rows(
+                        request.pdb_data, cfg, model, request.options["distance"], request.options["threshold"],
+                        self.batch_size, device=self.device,
+                        cache=self.cache, key=request.key
+                    )
+                    buckets = [[0]]
+                else:
+                    top_k = model.prot_mpnn.features.top_k
+                    lengths = [request.length for request in batch]
+                    exact = [_count_resolved(request.pdb_data) <= top_k for request in batch]
+                    buckets = bucket_by_length(lengths, self.max_residues, exact)
+                    for bucket in buckets:
+                        results = run_single_ssm_batch(
+                            [batch[i].pdb_data for i in bucket], cfg, model, device=self.device, cache=self.cache,
+                            keys=[batch[i].key for i in bucket]
+                        )
+                        for i, result in zip(bucket, results):
+                            batch[i].result = result
+            except Exception as e:
+                buckets = []
+                for request in batch:
+                    request.error = e
+
+            with self._stats_lock:
+                self._counts["batches"] += len(buckets)
+                self._counts["batched_requests"] += sum(len(bucket) for bucket in buckets)
+            for request in batch:
+                request.done.set()
+
+    # ----- HTTP -----
+
+    def serve(self, host="127.0.0.1", port=8000, socket_path=None):
+        """Serves HTTP on host:port, or on a Unix socket if socket_path is given, until interrupted"""
+        self.start()
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self._http = _UnixHTTPServer(socket_path, _make_handler(self))
+            print(f"ThermoMPNN server listening on {socket_path}")
+        else:
+            self._http = ThreadingHTTPServer((host, port), _make_handler(self))
+            print(f"ThermoMPNN server listening on http://{host}:{self._http.server_address[1]}")
+        return self._http
+
+    def serve_forever(self, host="127.0.0.1", port=8000, socket_path=None):
+        http_server = self.serve(host, port, socket_path)
+        try:
+            http_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        """
+        POST /predict  JSON {"pdb": <PDB file contents>, "mode", "chains", "threshold", "distance", "ss_penalty"}
+                       -> the SSM table as JSON (pandas orient="split", without index)
+        GET  /stats    -> queue depth and latency statistics
+        GET  /health   -> {"status": "ok"}
+        """
+
+        def address_string(self):
+            return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+        def log_message(self, format, *args):
+            pass  # one line per request would flood the log of a busy pipeline
+
+        def _send(self, code, body):
+            body = body.encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send(200, json.dumps(server.stats()))
+            elif self.path == "/health":
+                self._send(200, json.dumps({"status": "ok"}))
+            else:
+                self._send(404, json.dumps({"error": f"Unknown path {self.path}"}))
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._send(404, json.dumps({"error": f"Unknown path {self.path}"}))
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                with tempfile.TemporaryDirectory() as tmp:
+                    name = os.path.basename(payload.get("name") or "input")
+                    pdb_path = os.path.join(tmp, name + ".pdb")
+                    with open(pdb_path, "w") as f:
+                        f.write(payload["pdb"])
+                    df = server.predict(
+                        pdb_path,
+                        mode=payload.get("mode", "single"),
+                        chains=payload.get("chains"),
+                        threshold=float(payload.get("threshold", -0.5)),
+                        distance=float(payload.get("distance", 5.0)),
+                        ss_penalty=bool(payload.get("ss_penalty", False)),
+                    )
+            except (KeyError, ValueError, AssertionError) as e:  # bad request: missing PDB, unknown mode or chain, or
+                # filters that no mutation passes
+                self._send(400, json.dumps({"error": repr(e)}))
+                return
+            except Exception as e:
+                self._send(500, json.dumps({"error": repr(e)}))
+                return
+            self._send(200, df.to_json(orient="split", index=False, double_precision=15))
+
+    return Handler
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request_ssm(address, pdb_path, mode="single", chains=None, threshold=-0.5, distance=5.0, ss_penalty=False,
+                timeout=None):
+    """Client for SSMServer: address is "host:port" or the path of a Unix socket. Returns the SSM DataFrame"""
+    if os.path.exists(address):
+        conn = _UnixHTTPConnection(address, timeout=timeout)
+    else:
+        host, port = address.rsplit(":", 1)
+        conn = http.client.HTTPConnection(host, int(port), timeout=timeout)
+
+    with open(pdb_path) as f:
+        payload = {
+            "pdb": f.read(),
+            "name": os.path.splitext(os.path.basename(pdb_path))[0],
+            "mode": mode,
+            "chains": chains,
+            "threshold": threshold,
+            "distance": distance,
+            "ss_penalty": ss_penalty,
+        }
+    try:
+        conn.request("POST", "/predict", body=json.dumps(payload), headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        body = response.read().decode()
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise RuntimeError(f"ThermoMPNN server error {response.status}: {json.loads(body)['error']}")
+    return pd.read_json(io.StringIO(body), orient="split")
+
+
+def add_serve_arguments(parser):
+    """Command line options of `thermompnn serve`"""
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="host to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument("--socket", type=str, help="listen on this Unix socket instead of host:port")
+    parser.add_argument("--device", type=str, help="device to use", default="cpu")
+    parser.add_argument(
+        "--max_residues", type=int, default=None,
+        help="maximum number of padded residues per ProteinMPNN pass; 0 runs one structure per pass. "
+             "Default is 4096.",
+    )
+    parser.add_argument(
+        "--max_wait", type=float, default=0.01, help="seconds a request waits for others to share its pass"
+    )
+    parser.add_argument("--batch_size", type=int, help="batch size for the epistatic model", default=256)
+    parser.add_argument("--ensemble", type=int, default=1, help="number of ensemble checkpoints to average")
+    add_cache_arguments(parser)
+
+
+def serve_main(args):
+    SSMServer(
+        device=args.device,
+        max_residues=args.max_residues,
+        max_wait=args.max_wait,
+        batch_size=args.batch_size,
+        ensemble=args.ensemble,
+        cache=cache_from_args(args),
+    ).serve_forever(host=args.host, port=args.port, socket_path=args.socket)
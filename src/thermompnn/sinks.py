@@ -0,0 +1,294 @@
+import json
+import os
+import struct
+from abc import ABC, abstractmethod
+
+import numpy as np
+import pandas as pd
+
+from thermompnn.ssm_utils import (DISULFIDE_PENALTY, get_disulfide_residues,
+                                  idx_to_pdb_num, spatial_index)
+
+ALPHABET = "ACDEFGHIKLMNPQRSTVWYX"
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet  # noqa: F401
+    except ImportError as e:
+        raise ImportError("Parquet and Arrow output need pyarrow (pip install 'thermompnn[parquet]')") from e
+    return pyarrow
+
+
+def residue_table(pdb):
+    """Lookup tables stored once per output file: the amino acid alphabet of the wt/mut columns, the sequence and the
+    PDB numbering (chain + residue number) of every position index"""
+    try:
+        residues = idx_to_pdb_num(pdb, range(len(pdb["seq"])))
+    except (KeyError, IndexError):
+        print("PDB renumbering failed (sorry!) Positions are stored as 1-based sequence indices instead.")
+        residues = [str(i + 1) for i in range(len(pdb["seq"]))]
+    return {"alphabet": ALPHABET, "sequence": pdb["seq"], "residues": residues}
+
+
+class SSMSink(ABC):
+    """Base of the output sinks of stream_ssm_table: takes scored batches (pos, wtAA, mutAA [n, order] and ddg [n] or
+    [n, members]) and applies the ensemble mean / std and, with ss_penalty, the disulfide breakage penalty as in the
+    CSV output. Use as a context manager."""
+    extension = None
+
+    def __init__(self, path, pdb, order=1, ensemble=False, ss_penalty=False):
+        self.path = path
+        self.order = order
+        self.ensemble = ensemble
+        self.bad_resns = np.array(get_disulfide_residues(pdb), dtype=np.int64) if ss_penalty else None
+        self.table = residue_table(pdb)
+        self.rows = 0
+
+    @abstractmethod
+    def open(self):
+        """Creates the output"""
+
+    @abstractmethod
+    def close(self):
+        """Finalizes the output"""
+
+    @abstractmethod
+    def write(self, pos, wtAA, mutAA, ddg):
+        """pos, wtAA, mutAA [n, order] and ddg [n] or [n, members]"""
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        if self.rows == 0 and exc[0] is None:
+            print("No valid mutations passed your distance and ddG filters.")
+        self.close()
+
+    def reduce(self, pos, wtAA, mutAA, ddg):
+        """Member mean (with ss_penalty) and std (None for single models) of a batch"""
+        spread = None
+        if ddg.ndim == 2:  # ensemble members
+            ddg, spread = ddg.mean(-1), ddg.std(-1)
+        if self.bad_resns is not None:
+            broken = (np.isin(pos, self.bad_resns) & (wtAA != mutAA)).any(-1)
+            ddg = np.where(broken, ddg + ddg.dtype.type(DISULFIDE_PENALTY), ddg)
+        return ddg, spread
+
+
+class CSVSink(SSMSink):
+    """Writes SSM results batch by batch to a CSV file in the format of ThermoMPNN.process.
+
+    Mutations are named in the PDB numbering and double mutants get their CA-CA distance. Single mutants must come in
+    one batch and double mutant batches must hold whole position pairs in ascending order, so the file is sorted like
+    format_ssm_rows output: by ddG if sort_ddg, and double mutants by position pair first.
+    """
+    extension = ".csv"
+
+    def __init__(self, path, pdb, order=1, ensemble=False, ss_penalty=False, sort_ddg=True):
+        # imported here since run builds on this module
+        from thermompnn.run import double_mutation_names, single_mutation_names
+
+        super().__init__(path, pdb, order, ensemble, ss_penalty)
+        self.names = single_mutation_names if order == 1 else double_mutation_names
+        self.index = spatial_index(pdb) if order == 2 else None
+        self.sort_ddg = sort_ddg
+        self.file = None
+
+    def open(self):
+        self.file = open(self.path, "w")
+
+    def close(self):
+        self.file.close()
+
+    def write(self, pos, wtAA, mutAA, ddg):
+        """pos, wtAA, mutAA [n, order] and ddg [n] or [n, members]"""
+        ddg, spread = self.reduce(pos, wtAA, mutAA, ddg)
+        if self.order == 1:
+            order = np.argsort(ddg, kind="quicksort") if self.sort_ddg else np.arange(len(ddg))
+        else:
+            order = np.lexsort((ddg, pos[:, 1], pos[:, 0]) if self.sort_ddg else (pos[:, 1], pos[:, 0]))
+        pos, wtAA, mutAA = pos[order], wtAA[order], mutAA[order]
+
+        df = pd.DataFrame(
+            {"ddG (kcal/mol)": ddg[order], "Mutation": self.names(pos, wtAA, mutAA, self.table["residues"])},
+            index=np.arange(self.rows, self.rows + len(order)),
+        )
+        if self.order == 2:
+            df["CA-CA Distance"] = self.index.distances(pos).round(2)
+        if spread is not None:
+            df["ddG std (kcal/mol)"] = spread[order]
+        df.to_csv(self.file, header=self.rows == 0)
+        self.rows += len(df)
+
+
+class ColumnarSink(SSMSink):
+    """Writes SSM results batch by batch as typed columns, one row group (record batch) per write.
+
+    Columns: pos, wt, mut (order 1) or pos1, wt1, mut1, pos2, wt2, mut2 (order 2), ddg, ddg_std for ensembles and
+    distance (CA-CA, order 2). Positions are 0-based int32 indices into the residue table, amino acids are int8
+    dictionary columns over ALPHABET (categoricals in pandas), and the residue table is stored once in the schema
+    metadata (see read_ssm_table). Rows are written in the order they are scored.
+    """
+
+    def __init__(self, path, pdb, order=1, ensemble=False, ss_penalty=False):
+        super().__init__(path, pdb, order, ensemble, ss_penalty)
+        self.pa = _import_pyarrow()
+        self.index = spatial_index(pdb) if order == 2 else None
+        self.alphabet = self.pa.array(list(ALPHABET))
+        self.schema = self.make_schema(self.table, ensemble)
+        self.writer = None
+
+    def make_schema(self, table, ensemble):
+        pa = self.pa
+        aa = pa.dictionary(pa.int8(), pa.string())
+        suffixes = [""] if self.order == 1 else ["1", "2"]
+        fields = []
+        for s in suffixes:
+            fields += [pa.field(f"pos{s}", pa.int32()), pa.field(f"wt{s}", aa), pa.field(f"mut{s}", aa)]
+        fields.append(pa.field("ddg", pa.float32()))
+        if ensemble:
+            fields.append(pa.field("ddg_std", pa.float32()))
+        if self.order == 2:
+            fields.append(pa.field("distance", pa.float32()))
+        return pa.schema(fields, metadata={"thermompnn": json.dumps(table)})
+
+    @abstractmethod
+    def open_writer(self):
+        """pyarrow writer of self.schema to self.path (with write_batch and close)"""
+
+    def open(self):
+        self.writer = self.open_writer()
+
+    def close(self):
+        self.writer.close()
+
+    def write(self, pos, wtAA, mutAA, ddg):
+        """pos, wtAA, mutAA [n, order] and ddg [n] or [n, members]"""
+        pa = self.pa
+        ddg, spread = self.reduce(pos, wtAA, mutAA, ddg)
+
+        columns = []
+        for i in range(self.order):
+            columns.append(pa.array(pos[:, i].astype(np.int32)))
+            for aa in (wtAA, mutAA):
+                columns.append(pa.DictionaryArray.from_arrays(pa.array(aa[:, i].astype(np.int8)), self.alphabet))
+        columns.append(pa.array(ddg.astype(np.float32)))
+        if spread is not None:
+            columns.append(pa.array(spread.astype(np.float32)))
+        if self.order == 2:
+            dist = self.index.distances(pos)
+            columns.append(pa.array(dist.astype(np.float32)))
+        self.writer.write_batch(pa.record_batch(columns, schema=self.schema))
+        self.rows += len(ddg)
+
+
+class ParquetSink(ColumnarSink):
+    """ColumnarSink writing a Parquet file"""
+    extension = ".parquet"
+
+    def open_writer(self):
+        return self.pa.parquet.ParquetWriter(self.path, self.schema)
+
+
+class ArrowSink(ColumnarSink):
+    """ColumnarSink writing an Arrow IPC (Feather v2) file"""
+    extension = ".arrow"
+
+    def open_writer(self):
+        return self.pa.ipc.new_file(self.path, self.schema)
+
+
+class NpySink(SSMSink):
+    """Writes SSM results as NumPy arrays to a directory, for callers that want matrices instead of a table.
+
+    Single mutants (order 1) go into the dense, memory-mapped ddg.npy [L, 20] (NaN for mutations that were not
+    scored or missed the threshold). Double mutants (order 2) are stored sparse (COO) as the columns pos1.npy, aa1.npy,
+    pos2.npy, aa2.npy and ddg.npy, appended batch by batch. Ensembles add ddg_std.npy. residues.json holds the residue
+    table (see residue_table) once. Read with load_ssm_arrays.
+    """
+    extension = "_arrays"
+    HEADER_SIZE = 128  # room for the final shape, so columns can be appended and their header rewritten in place
+
+    def __init__(self, path, pdb, order=1, ensemble=False, ss_penalty=False):
+        super().__init__(path, pdb, order, ensemble, ss_penalty)
+        self.length = len(pdb["seq"])
+        self.columns = {"ddg": np.float32}
+        if ensemble:
+            self.columns["ddg_std"] = np.float32
+        if order == 2:
+            self.columns = {"pos1": np.int32, "aa1": np.int8, "pos2": np.int32, "aa2": np.int8, **self.columns}
+        self.files = {}
+
+    def _npy_header(self, dtype, shape):
+        header = repr({"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False,
+                       "shape": tuple(shape)}).encode("latin1")
+        padding = self.HEADER_SIZE - 10 - len(header) - 1
+        return b"\x93NUMPY\x01\x00" + struct.pack("<H", self.HEADER_SIZE - 10) + header + b" " * padding + b"\n"
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, "residues.json"), "w") as f:
+            json.dump(self.table, f)
+        for name, dtype in self.columns.items():
+            path = os.path.join(self.path, f"{name}.npy")
+            if self.order == 1:
+                self.files[name] = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(self.length, 20))
+                self.files[name][:] = np.nan
+            else:
+                self.files[name] = open(path, "wb")
+                self.files[name].write(self._npy_header(dtype, (0,)))
+
+    def close(self):
+        for name, dtype in self.columns.items():
+            if self.order == 1:
+                self.files[name].flush()
+            else:
+                self.files[name].seek(0)
+                self.files[name].write(self._npy_header(dtype, (self.rows,)))
+                self.files[name].close()
+        self.files = {}
+
+    def write(self, pos, wtAA, mutAA, ddg):
+        """pos, wtAA, mutAA [n, order] and ddg [n] or [n, members]"""
+        ddg, spread = self.reduce(pos, wtAA, mutAA, ddg)
+        values = {"ddg": ddg, "ddg_std": spread}
+        if self.order == 1:
+            for name in self.columns:
+                self.files[name][pos[:, 0], mutAA[:, 0]] = values[name]
+        else:
+            values.update(pos1=pos[:, 0], aa1=mutAA[:, 0], pos2=pos[:, 1], aa2=mutAA[:, 1])
+            for name, dtype in self.columns.items():
+                self.files[name].write(np.ascontiguousarray(values[name], dtype=dtype).tobytes())
+        self.rows += len(ddg)
+
+
+SINKS = {"csv": CSVSink, "parquet": ParquetSink, "arrow": ArrowSink, "npy": NpySink}
+
+
+def read_ssm_table(path):
+    """Reads a Parquet or Arrow output file into a DataFrame; the residue table is in df.attrs["thermompnn"] (map
+    positions to PDB numbering with np.array(df.attrs["thermompnn"]["residues"])[df["pos"]])"""
+    pa = _import_pyarrow()
+    if path.endswith(ParquetSink.extension):
+        table = pa.parquet.read_table(path)
+    else:
+        with pa.memory_map(path) as source:
+            table = pa.ipc.open_file(source).read_all()
+    df = table.to_pandas()
+    df.attrs["thermompnn"] = json.loads(table.schema.metadata[b"thermompnn"])
+    return df
+
+
+def load_ssm_arrays(path):
+    """Reads the output directory of NpySink: returns the arrays by name (memory-mapped, read-only) and the residue
+    table, e.g. arrays["ddg"] [L, 20] for single mutants or the COO columns pos1, aa1, pos2, aa2 and ddg"""
+    with open(os.path.join(path, "residues.json")) as f:
+        table = json.load(f)
+    arrays = {
+        name[:-len(".npy")]: np.load(os.path.join(path, name), mmap_mode="r")
+        for name in sorted(os.listdir(path)) if name.endswith(".npy")
+    }
+    return arrays, table
@@ -1,42 +1,180 @@
+import json
+import math
 import os
 import re
+import struct
+import warnings
 from typing import Literal
 
 import numpy as np
-from Bio.PDB import PDBParser
+import torch
 from omegaconf import OmegaConf
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist
-from tqdm import tqdm
 
-from thermompnn.train_thermompnn import parse_cfg
-from thermompnn.trainer.v2_trainer import (TransferModelPLv2,
-                                           TransferModelPLv2Siamese)
+from thermompnn.model.v2_model import (ModelEnsemble, TransferModelv2,
+                                       TransferModelv2Siamese)
+from thermompnn.pdb_utils import (ALL_ATOMS, BACKBONE_ATOMS, CHAIN_ALPHABET,
+                                  SSM_RESIDUE_MAP, Structure, chain_arrays,
+                                  read_pdb_chains)
+from thermompnn.utils.config import parse_cfg
 from thermompnn.utils.get_weights import thermompnn_weigths
 
 CONFIG_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "configs")
+DISULFIDE_PENALTY = 2  # in kcal/mol - higher is less stable
+FUSED_SUFFIX = ".fused"
+FUSED_ALIGN = 64  # byte alignment of the tensors in fused weight files
 
 
-def get_model(mode: Literal['single', 'epistatic'], config):
+def get_model(mode: Literal['single', 'epistatic'], config, member: int = 1):
+    """Loads ensemble member `member` (ThermoMPNN-ens<member>.ckpt / ThermoMPNN-D-ens<member>.ckpt) of a mode, from
+    its fused weight file if one was written with export_fused and the checkpoint has not changed since"""
     model_dir = thermompnn_weigths.setup()
+    name = checkpoint_name(mode, member)
+    fused_path = os.path.join(model_dir, name + FUSED_SUFFIX)
+    model_path = os.path.join(model_dir, name + ".ckpt")
+    if os.path.isfile(fused_path) and _fused_is_current(fused_path, model_path):
+        return load_fused(fused_path)
+
+    _check_checkpoint(model_path)
+    return load_checkpoint(_model_class(mode)(config), model_path)
 
-    if (mode.lower() == "single") or (mode.lower() == "additive"):
-        model_path = os.path.join(model_dir, "ThermoMPNN-ens1.ckpt")
-        return TransferModelPLv2.load_from_checkpoint(model_path, cfg=config).model
 
+def checkpoint_name(mode, member):
+    """File name (without extension) of ensemble member `member` of a mode"""
+    if (mode.lower() == "single") or (mode.lower() == "additive"):
+        return f"ThermoMPNN-ens{member}"
     if mode.lower() == "epistatic":
-        model_path = os.path.join(model_dir, "ThermoMPNN-D-ens1.ckpt")
-        return TransferModelPLv2Siamese.load_from_checkpoint(
-            model_path, cfg=config
-        ).model
+        return f"ThermoMPNN-D-ens{member}"
     raise ValueError(f"Invalid model mode {mode.lower()} specified")
 
 
+def _model_class(mode):
+    return TransferModelv2Siamese if mode.lower() == "epistatic" else TransferModelv2
+
+
+def _check_checkpoint(model_path):
+    if not os.path.isfile(model_path):
+        found = sorted(f for f in os.listdir(os.path.dirname(model_path)) if f.endswith(".ckpt"))
+        raise FileNotFoundError(f"Model weights {os.path.basename(model_path)} not found. Available: {found}")
+
+
+def _checkpoint_stamp(model_path):
+    """Size and modification time of a checkpoint, stored in the fused files exported from it"""
+    stat = os.stat(model_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _fused_is_current(fused_path, model_path):
+    """False if the checkpoint was replaced (e.g. updated or re-downloaded) after the fused file was exported from it"""
+    if not os.path.isfile(model_path):
+        return True  # only the fused file is available
+    stamp = _read_fused_header(fused_path).get("checkpoint")
+    if stamp is None:  # exported before the checkpoint stamp was stored
+        current = os.path.getmtime(fused_path) >= os.path.getmtime(model_path)
+    else:
+        current = stamp == _checkpoint_stamp(model_path)
+    if not current:
+        print(f"{os.path.basename(fused_path)} is older than {os.path.basename(model_path)}, loading the checkpoint "
+              f"instead. Run `thermompnn export` again to update it.")
+    return current
+
+
+def load_checkpoint(model, model_path):
+    """Loads the weights of a training checkpoint into its inference model, i.e. the `model.` entries of the
+    Lightning state_dict, without building the Lightning module (or importing the training stack)"""
+    checkpoint = torch.load(model_path, map_location="cpu", weights_only=False)
+    prefix = "model."
+    state_dict = {k[len(prefix):]: v for k, v in checkpoint["state_dict"].items() if k.startswith(prefix)}
+    model.load_state_dict(state_dict)
+    return model
+
+
+def export_fused(mode: Literal['single', 'epistatic'], members: int = 1):
+    """Writes the first `members` checkpoints of a mode as fused weight files next to them, which get_model then
+    prefers. Each file holds the full state_dict (ProteinMPNN and ThermoMPNN head) and the config, so loading it
+    needs neither the Lightning checkpoint nor the vanilla ProteinMPNN weights. Returns the written paths."""
+    model_dir = thermompnn_weigths.setup()
+    paths = []
+    for member in range(1, members + 1):
+        config = get_config(mode)
+        name = checkpoint_name(mode, member)
+        model_path = os.path.join(model_dir, name + ".ckpt")
+        _check_checkpoint(model_path)
+        model = load_checkpoint(_model_class(mode)(config), model_path)
+
+        config.model.load_pretrained = False  # every weight is in the fused file
+        config.model.k_neighbors = model.prot_mpnn.features.top_k
+        path = os.path.join(model_dir, name + FUSED_SUFFIX)
+        _write_fused(path + ".tmp", model.state_dict(), OmegaConf.to_container(config), _checkpoint_stamp(model_path))
+        os.replace(path + ".tmp", path)  # other processes may be mapping the old file
+        paths.append(path)
+    return paths
+
+
+def _write_fused(path, state_dict, config, checkpoint=None):
+    """Flat layout: header size (uint64), JSON header with the config, the checkpoint stamp (see _checkpoint_stamp)
+    and the dtype, shape and offset of every tensor, then the raw tensor data, each tensor aligned to FUSED_ALIGN
+    bytes"""
+    tensors, arrays, offset = {}, [], 0
+    for name, value in state_dict.items():
+        array = value.detach().cpu().contiguous().numpy()
+        offset = -(-offset // FUSED_ALIGN) * FUSED_ALIGN
+        tensors[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        arrays.append((offset, array))
+        offset += array.nbytes
+    header = json.dumps({"config": config, "checkpoint": checkpoint, "tensors": tensors}).encode()
+    header += b" " * (-(8 + len(header)) % FUSED_ALIGN)
+
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for offset, array in arrays:
+            f.seek(8 + len(header) + offset)
+            f.write(array.tobytes())
+
+
+def load_fused(path):
+    """Loads a fused weight file (see export_fused) without copying the weights: the file is memory-mapped
+    (copy-on-write) and the model takes over tensors viewing the mapping (assign=True), so processes loading the
+    same file share them via the page cache"""
+    header = _read_fused_header(path)
+    data = np.memmap(path, dtype=np.uint8, mode="c", offset=8 + header["size"])
+    state_dict = {}
+    for name, tensor in header["tensors"].items():
+        dtype = np.dtype(tensor["dtype"])
+        end = tensor["offset"] + dtype.itemsize * math.prod(tensor["shape"])
+        state_dict[name] = torch.from_numpy(data[tensor["offset"]:end].view(dtype).reshape(tensor["shape"]))
+
+    config = parse_cfg(OmegaConf.create(header["config"]))
+    # built on cpu, not the meta device: the freshly initialized weights are small, and the first meta init costs ~2 s
+    model = _model_class("epistatic" if config.model.aggregation == "siamese" else "single")(config)
+    model.load_state_dict(state_dict, assign=True)
+    return model
+
+
+def _read_fused_header(path):
+    """JSON header of a fused weight file, plus its size in bytes"""
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header["size"] = header_size
+    return header
+
+
+def get_ensemble(mode: Literal['single', 'epistatic'], config, members: int = 1):
+    """Loads the first `members` ensemble checkpoints of a mode as one ModelEnsemble (a plain model for 1)"""
+    if members == 1:
+        return get_model(mode, config)
+    return ModelEnsemble([get_model(mode, config, member) for member in range(1, members + 1)])
+
+
 def get_chains(pdb_file, chain_list):
     # collect list of chains in PDB to match with input
-    parser = PDBParser(QUIET=True)
-    structure = parser.get_structure("", pdb_file)
-    pdb_chains = [c.id for c in structure.get_chains()]
+    return _check_chains(list(read_pdb_chains(pdb_file)), chain_list)
+
 
+def _check_chains(pdb_chains, chain_list):
     if chain_list is None:  # fill in all chains if left blank
         chain_list = pdb_chains
     elif len(chain_list) < 1:
@@ -73,339 +211,208 @@ def get_config(mode):
     return parse_cfg(config)
 
 
-def get_dmat(pdb):
-    """Get LxL dmat from PDB"""
-
-    # get distance matrix
+def get_ca_coords(pdb):
+    """Get [L, 3] CA coordinates of all chains from PDB (NaN for missing residues)"""
+    if isinstance(pdb, Structure):
+        return pdb.atoms("CA", precise=True)
     coords = [k for k in pdb.keys() if k.startswith("coords_chain_")]
-    # compile all-by-all coords into big matrix
     coo_all = []
     for coord in coords:
         ch = coord.split("_")[-1]
         coo = np.stack(pdb[coord][f"CA_chain_{ch}"])  # [L, 3]
         coo_all.append(coo)
-    coo_all = np.concatenate(coo_all)  # [L_total, 3]
+    return np.concatenate(coo_all)  # [L_total, 3]
+
+
+def get_dmat(pdb):
+    """Get LxL dmat from PDB"""
+    warnings.warn("get_dmat is deprecated, use spatial_index(pdb).distances", DeprecationWarning, stacklevel=2)
+
+    # compile all-by-all coords into big matrix
+    coo_all = get_ca_coords(pdb)
     dmat = cdist(coo_all, coo_all)
     return dmat
 
 
+class SpatialIndex:
+    """KD-trees over the CA and Cys SG atoms of a parsed structure for radius queries: CA contact pairs, CA-CA
+    distances and SG-SG disulfides. Use spatial_index(pdb), which builds it once and caches it on the structure, so
+    every step of a run shares the coordinates and trees instead of recomputing L x L distance matrices. The trees are
+    built on first use."""
+
+    def __init__(self, pdb):
+        self.ca = get_ca_coords(pdb).astype(np.float64)  # [L, 3], NaN for missing residues
+        # collect all SG coordinates from all chains (None without side chains)
+        if isinstance(pdb, Structure):
+            self.sg = pdb.atoms("SG", precise=True) if "SG" in pdb.atom_names else None
+        else:
+            sg = [pdb[c].get(f"SG_chain_{c[-1]}") for c in pdb.keys() if c.startswith("coords")]
+            self.sg = None if any(x is None for x in sg) else np.concatenate(sg, axis=0).astype(np.float64)
+        self._ca_tree = None
+        self._sg_tree = None
+
+    @staticmethod
+    def _tree(coords):
+        present = np.flatnonzero(np.isfinite(coords).all(-1))  # missing atoms have no neighbors
+        return present, cKDTree(coords[present])
+
+    def contact_pairs(self, distance):
+        """Residue pairs (i < j) with 0 < CA-CA distance < distance, sorted by (i, j), and their distances"""
+        if self._ca_tree is None:
+            self._ca_tree = self._tree(self.ca)
+        present, tree = self._ca_tree
+        pairs = present[tree.query_pairs(distance, output_type="ndarray")].reshape(-1, 2)
+        pairs = np.sort(pairs, axis=-1)
+        pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+        dist = self.distances(pairs)
+        keep = (dist < distance) & (dist != 0.0)
+        return pairs[keep], dist[keep]
+
+    def distances(self, pos):
+        """CA-CA distances of position pairs pos [n, 2] (NaN if a CA is missing)"""
+        return np.sqrt(np.sum((self.ca[pos[:, 0]] - self.ca[pos[:, 1]]) ** 2, -1))
+
+    def disulfide_residues(self, cutoff=3.0):
+        """Sorted indices of residues whose Cys SG is within cutoff of another SG, once per partner"""
+        if self.sg is None:
+            raise KeyError("Disulfide detection needs SG coordinates (load the PDB with side chains)")
+        if self._sg_tree is None:
+            self._sg_tree = self._tree(self.sg)
+        present, tree = self._sg_tree
+        pairs = present[tree.query_pairs(cutoff, output_type="ndarray")].reshape(-1, 2)
+        dist = np.sqrt(np.sum((self.sg[pairs[:, 0]] - self.sg[pairs[:, 1]]) ** 2, -1))
+        pairs = pairs[(dist < cutoff) & (dist > 0)]
+        return np.sort(pairs.ravel())
+
+
+def spatial_index(pdb):
+    """SpatialIndex of pdb, built once per structure and cached in pdb["spatial_index"]"""
+    index = pdb.get("spatial_index")
+    if index is None:
+        index = pdb["spatial_index"] = SpatialIndex(pdb)
+    return index
+
+
+def get_contact_pairs(pdb, distance):
+    """
+    Get residue pairs (i < j) with 0 < CA-CA distance < distance from PDB.
+    Uses the cached KD-tree over the CA coordinates (see spatial_index), so memory scales with the number of contacts
+    instead of LxL. Returns pairs [P, 2] sorted by (i, j) and their CA-CA distances [P].
+    """
+    return spatial_index(pdb).contact_pairs(distance)
+
+
 def custom_parse_PDB_biounits(x, atoms=["N", "CA", "C"], chain=None):
     """
     input:  x = PDB filename
             atoms = atoms to extract (optional)
     output: (length, atoms, coords=(x,y,z)), sequence
     """
-
-    alpha_1 = list("ARNDCQEGHILKMFPSTWYV-")
-    states = len(alpha_1)
-    alpha_3 = [
-        "ALA",
-        "ARG",
-        "ASN",
-        "ASP",
-        "CYS",
-        "GLN",
-        "GLU",
-        "GLY",
-        "HIS",
-        "ILE",
-        "LEU",
-        "LYS",
-        "MET",
-        "PHE",
-        "PRO",
-        "SER",
-        "THR",
-        "TRP",
-        "TYR",
-        "VAL",
-        "GAP",
-    ]
-
-    aa_1_N = {a: n for n, a in enumerate(alpha_1)}
-    aa_3_N = {a: n for n, a in enumerate(alpha_3)}
-    aa_N_1 = {n: a for n, a in enumerate(alpha_1)}
-    aa_1_3 = {a: b for a, b in zip(alpha_1, alpha_3)}
-    aa_3_1 = {b: a for a, b in zip(alpha_1, alpha_3)}
-
-    def AA_to_N(x):
-        # ["ARND"] -> [[0,1,2,3]]
-        x = np.array(x)
-        if x.ndim == 0:
-            x = x[None]
-        return [[aa_1_N.get(a, states - 1) for a in y] for y in x]
-
-    def N_to_AA(x):
-        # [[0,1,2,3]] -> ["ARND"]
-        x = np.array(x)
-        if x.ndim == 1:
-            x = x[None]
-        return ["".join([aa_N_1.get(a, "-") for a in y]) for y in x]
-
-    xyz, seq, min_resn, max_resn = {}, {}, 1e6, -1e6
-    resn_list = []
-    for line in open(x, "rb"):
-        line = line.decode("utf-8", "ignore").rstrip()
-
-        # handling MSE and SEC residues
-        if line[:6] == "HETATM" and line[17: 17 + 3] == "MSE":
-            line = line.replace("HETATM", "ATOM  ")
-            line = line.replace("MSE", "MET")
-        elif line[17: 17 + 3] == "MSE":
-            line = line.replace("MSE", "MET")
-        elif line[17: 17 + 3] == "SEC":
-            line = line.replace("SEC", "CYS")
-
-        if line[:4] == "ATOM":
-            ch = line[21:22]
-            if ch == chain or chain is None:
-                atom = line[12: 12 + 4].strip()
-                resi = line[17: 17 + 3]
-                resn = line[22: 22 + 5].strip()
-
-                # Check for gaps and add them if needed
-                if (resn not in resn_list) and len(resn_list) > 0:
-                    _, num, ins_code = re.split(r"(\d+)", resn)
-                    _, num_prior, ins_code_prior = re.split(r"(\d+)", resn_list[-1])
-                    gap = int(num) - int(num_prior) - 1
-                    for g in range(gap + 1):
-                        resn_list.append(str(int(num_prior) + g))
-
-                # RAW resn is defined HERE
-                resn_list.append(resn)  # NEED to keep ins code here
-
-                x, y, z = (float(line[i: (i + 8)]) for i in [30, 38, 46])
-                if resn[-1].isalpha():
-                    resa, resn = resn[-1], int(resn[:-1]) - 1
-                else:
-                    resa, resn = "", int(resn) - 1
-                if resn < min_resn:
-                    min_resn = resn
-                if resn > max_resn:
-                    max_resn = resn
-                if resn not in xyz:
-                    xyz[resn] = {}
-                if resa not in xyz[resn]:
-                    xyz[resn][resa] = {}
-                if resn not in seq:
-                    seq[resn] = {}
-                if resa not in seq[resn]:
-                    seq[resn][resa] = resi
-
-                if atom not in xyz[resn][resa]:
-                    xyz[resn][resa][atom] = np.array([x, y, z])
-
-    # convert to numpy arrays, fill in missing values
-    seq_, xyz_ = [], []
-    try:
-        for resn in range(min_resn, max_resn + 1):
-            if resn in seq:
-                for k in sorted(seq[resn]):
-                    seq_.append(aa_3_N.get(seq[resn][k], 20))
-            else:
-                seq_.append(20)
-
-            if resn in xyz:
-                for k in sorted(xyz[resn]):
-                    for atom in atoms:
-                        if atom in xyz[resn][k]:
-                            xyz_.append(xyz[resn][k][atom])
-                        else:
-                            xyz_.append(np.full(3, np.nan))
-            else:
-                for atom in atoms:
-                    xyz_.append(np.full(3, np.nan))
-        return (
-            np.array(xyz_).reshape(-1, len(atoms), 3),
-            N_to_AA(np.array(seq_)),
-            list(dict.fromkeys(resn_list)),
-        )
-    except TypeError:
+    parsed = chain_arrays(
+        read_pdb_chains(x, split_chains=chain is not None).get(chain),
+        atoms,
+        residue_map=SSM_RESIDUE_MAP,
+        resn_mode="gapfill",
+    )
+    if parsed is None:
         return "no_chain", "no_chain", "no_chain"
+    xyz, seq, resn_list = parsed
+    return xyz, [seq], resn_list
 
 
 def custom_parse_PDB(
     path_to_pdb, input_chain_list=None, ca_only=False, side_chains=False, mut_chain=None
 ):
-    c = 0
-    pdb_dict_list = []
-    init_alphabet = [
-        "A",
-        "B",
-        "C",
-        "D",
-        "E",
-        "F",
-        "G",
-        "H",
-        "I",
-        "J",
-        "K",
-        "L",
-        "M",
-        "N",
-        "O",
-        "P",
-        "Q",
-        "R",
-        "S",
-        "T",
-        "U",
-        "V",
-        "W",
-        "X",
-        "Y",
-        "Z",
-        "a",
-        "b",
-        "c",
-        "d",
-        "e",
-        "f",
-        "g",
-        "h",
-        "i",
-        "j",
-        "k",
-        "l",
-        "m",
-        "n",
-        "o",
-        "p",
-        "q",
-        "r",
-        "s",
-        "t",
-        "u",
-        "v",
-        "w",
-        "x",
-        "y",
-        "z",
+    return [
+        _custom_pdb_dict(
+            path_to_pdb, read_pdb_chains(path_to_pdb), input_chain_list, ca_only, side_chains
+        )
     ]
-    extra_alphabet = [str(item) for item in list(np.arange(300))]
-    chain_alphabet = init_alphabet + extra_alphabet
 
+
+def _custom_pdb_dict(biounit, chains, input_chain_list=None, ca_only=False, side_chains=False):
+    """Builds the SSM Structure from records already read by read_pdb_chains"""
+    chain_alphabet = CHAIN_ALPHABET
     if input_chain_list:
         chain_alphabet = input_chain_list
 
-    biounit_names = [path_to_pdb]
-    for biounit in biounit_names:
-        my_dict = {}
-        s = 0
-        concat_seq = ""
-        for letter in chain_alphabet:
-            if ca_only:
-                sidechain_atoms = ["CA"]
-            elif side_chains:
-                sidechain_atoms = [
-                    "N",
-                    "CA",
-                    "C",
-                    "O",
-                    "CB",
-                    "CG",
-                    "CG1",
-                    "OG1",
-                    "OG2",
-                    "CG2",
-                    "OG",
-                    "SG",
-                    "CD",
-                    "SD",
-                    "CD1",
-                    "ND1",
-                    "CD2",
-                    "OD1",
-                    "OD2",
-                    "ND2",
-                    "CE",
-                    "CE1",
-                    "NE1",
-                    "OE1",
-                    "NE2",
-                    "OE2",
-                    "NE",
-                    "CE2",
-                    "CE3",
-                    "NZ",
-                    "CZ",
-                    "CZ2",
-                    "CZ3",
-                    "CH2",
-                    "OH",
-                    "NH1",
-                    "NH2",
-                ]
-            else:
-                sidechain_atoms = ["N", "CA", "C", "O"]
-            xyz, seq, resn_list = custom_parse_PDB_biounits(
-                biounit, atoms=sidechain_atoms, chain=letter
-            )
-            if resn_list != "no_chain":
-                my_dict["resn_list_" + letter] = resn_list
-
-            if not isinstance(xyz, str):
-                concat_seq += seq[0]
-                my_dict["seq_chain_" + letter] = seq[0]
-                coords_dict_chain = {}
-                if ca_only:
-                    coords_dict_chain["CA_chain_" + letter] = xyz.tolist()
-                elif side_chains:
-                    coords_dict_chain["N_chain_" + letter] = xyz[:, 0, :].tolist()
-                    coords_dict_chain["CA_chain_" + letter] = xyz[:, 1, :].tolist()
-                    coords_dict_chain["C_chain_" + letter] = xyz[:, 2, :].tolist()
-                    coords_dict_chain["O_chain_" + letter] = xyz[:, 3, :].tolist()
-                    coords_dict_chain["SG_chain_" + letter] = xyz[:, 11].tolist()
-                else:
-                    coords_dict_chain["N_chain_" + letter] = xyz[:, 0, :].tolist()
-                    coords_dict_chain["CA_chain_" + letter] = xyz[:, 1, :].tolist()
-                    coords_dict_chain["C_chain_" + letter] = xyz[:, 2, :].tolist()
-                    coords_dict_chain["O_chain_" + letter] = xyz[:, 3, :].tolist()
-                my_dict["coords_chain_" + letter] = coords_dict_chain
-                s += 1
-
-        fi = biounit.rfind("/")
-        my_dict["name"] = biounit[(fi + 1): -4]
-        my_dict["num_of_chains"] = s
-        my_dict["seq"] = concat_seq
-        if s <= len(chain_alphabet):
-            pdb_dict_list.append(my_dict)
-            c += 1
-    return pdb_dict_list
+    if ca_only:
+        sidechain_atoms = ["CA"]
+    elif side_chains:
+        sidechain_atoms = ALL_ATOMS
+    else:
+        sidechain_atoms = BACKBONE_ATOMS
+    # only the backbone (and the Cys SG for disulfides) is kept
+    atom_names = ["CA"] if ca_only else BACKBONE_ATOMS + (["SG"] if side_chains else [])
+    atom_idx = [sidechain_atoms.index(atom) for atom in atom_names]
+
+    letters, xyz_list, seq_list, resn_lists = [], [], [], []
+    for letter in chain_alphabet:
+        parsed = chain_arrays(
+            chains.get(letter),
+            sidechain_atoms,
+            residue_map=SSM_RESIDUE_MAP,
+            resn_mode="gapfill",
+        )
+        if parsed is None:
+            continue
+
+        xyz, seq, resn_list = parsed
+        letters.append(letter)
+        xyz_list.append(xyz[:, atom_idx])
+        seq_list.append(seq)
+        resn_lists.append(resn_list)
 
+    fi = biounit.rfind("/")
+    return Structure(biounit[(fi + 1): -4], letters, xyz_list, seq_list, atom_names, resn_lists=resn_lists)
 
-def idx_to_pdb_num(pdb, poslist):
-    # set up PDB resns and boundaries
-    chains = [key[-1] for key in pdb.keys() if key.startswith("resn_list_")]
-    resn_lists = [pdb[key] for key in pdb.keys() if key.startswith("resn_list")]
-    converter = {}
-    offset = 0
-    for n, rlist in enumerate(resn_lists):
-        chain = chains[n]
-        for idx, resid in enumerate(rlist):
-            converter[idx + offset] = chain + resid
-        offset += idx + 1
 
-    return [converter[pos] for pos in poslist]
+def residue_labels(pdb):
+    """PDB numbering (chain + residue number, e.g. "A45") of every position index as an array. It is built once per
+    structure and cached in pdb["residue_labels"]."""
+    labels = pdb.get("residue_labels")
+    if labels is None:
+        keys = [key for key in pdb.keys() if key.startswith("resn_list_")]
+        labels = np.array([key[-1] + resid for key in keys for resid in pdb[key]], dtype=str)
+        pdb["residue_labels"] = labels
+    return labels
+
+
+def idx_to_pdb_num(pdb, poslist):
+    """PDB numbering of 0-based position indices (see residue_labels)"""
+    return residue_labels(pdb)[np.asarray(poslist, dtype=np.int64)].tolist()
+
+
+def resolve_positions(pdb, positions):
+    """Sorted 0-based sequence indices of residues given in the output numbering, i.e. chain + residue number
+    (e.g. "A45"), or as ranges within a chain (e.g. "A40-60")"""
+    index = {label: idx for idx, label in enumerate(idx_to_pdb_num(pdb, range(len(pdb["seq"]))))}
+    resolved = []
+    for pos in positions:
+        match = re.fullmatch(r"(\w)(-?\d+[A-Za-z]?)(?:-(-?\d+[A-Za-z]?))?", str(pos))
+        if match is None:
+            raise ValueError(f"Invalid position {pos}, expected chain + residue number (e.g. A45) or a range (A40-60)")
+        chain, first, last = match.groups()
+        first, last = index.get(chain + first), index.get(chain + (last or first))
+        if first is None or last is None:
+            raise ValueError(f"Position {pos} not found in PDB")
+        if last < first:
+            raise ValueError(f"Invalid position range {pos}")
+        resolved.extend(range(first, last + 1))
+    return np.unique(np.array(resolved, dtype=np.int64))
 
 
 def distance_filter(df, pdb, distance=5.0):
     """filter df based on pdb distances"""
-    dmat = get_dmat(pdb)
-
+    warnings.warn("distance_filter is deprecated, use run.format_ssm_rows", DeprecationWarning, stacklevel=2)
     # grab positions
     df[["mut1", "mut2"]] = df["Mutation"].str.split(":", n=2, expand=True)
     df["pos1"] = df["mut1"].str[1:-1].astype(int) - 1
     df["pos2"] = df["mut2"].str[1:-1].astype(int) - 1
 
     # filter df based on positions
-    pos1, pos2 = df["pos1"].values, df["pos2"].values
-    dist_list = []
-    for p1, p2 in tqdm(zip(pos1, pos2)):
-        dist_list.append(dmat[p1, p2])
-
-    df["CA-CA Distance"] = dist_list
+    df["CA-CA Distance"] = spatial_index(pdb).distances(df[["pos1", "pos2"]].values)
     mask = (df["CA-CA Distance"] <= distance) & (df["CA-CA Distance"] != 0.0)
     df = df.loc[mask]
     df.loc[:, "CA-CA Distance"] = df["CA-CA Distance"].round(2)
@@ -417,6 +424,7 @@ def distance_filter(df, pdb, distance=5.0):
 
 def renumber_pdb(df, pdb, mode):
     """Renumber output mutations to match PDB numbering for interpretation"""
+    warnings.warn("renumber_pdb is deprecated, use run.format_ssm_rows", DeprecationWarning, stacklevel=2)
 
     if (mode.lower() == "additive") or (mode.lower() == "epistatic"):
         # grab positions
@@ -456,26 +464,18 @@ def renumber_pdb(df, pdb, mode):
     return df
 
 
+def get_disulfide_residues(pdb):
+    """Indices of disulfide engaged residues (Cys SG-SG distance below 3 A)"""
+    bad_resns = spatial_index(pdb).disulfide_residues(3.0).tolist()
+    print("Identified the following disulfide engaged residues:", bad_resns)
+    return bad_resns
+
+
 def disulfide_penalty(df, pdb, mode):
     """Automatically detects disulfide breakage based on Cys-Cys distance."""
-
-    # collect all SG coordinates from all chains
-    coords_all = [k for k in pdb.keys() if k.startswith("coords")]
-    chains = [c[-1] for c in coords_all]
-    sg_coords = [pdb[c][f"SG_chain_{chain}"] for c, chain in zip(coords_all, chains)]
-    sg_coords = np.concatenate(sg_coords, axis=0)
-
-    # calculate pairwise distance and threshold to find disulfides
-    dist = cdist(sg_coords, sg_coords)
-    dist = np.nan_to_num(dist, 10000)
-    hits = np.where((dist < 3) & (dist > 0))  # tuple of two [N] arrays of indices
-
-    # match hit indices to actual resns for penalty
-    bad_resns = []
-    for h in hits[0]:
-        bad_resns.append(h)
-    penalty = 2  # in kcal/mol - higher is less stable
-    print("Identified the following disulfide engaged residues:", bad_resns)
+    warnings.warn("disulfide_penalty is deprecated, use run.format_ssm_rows", DeprecationWarning, stacklevel=2)
+    bad_resns = get_disulfide_residues(pdb)
+    penalty = DISULFIDE_PENALTY
 
     if mode.lower() == "single":
         df["wtAA"] = df["Mutation"].str[0]
@@ -507,6 +507,8 @@ def disulfide_penalty(df, pdb, mode):
 
 
 def load_pdb(fname, chainlist):
-    chains = get_chains(fname, chainlist)
-    pdb = custom_parse_PDB(fname, input_chain_list=chains, side_chains=True)[0]
+    # single read of the PDB file for both the chain check and the parsing
+    records = read_pdb_chains(fname)
+    chains = _check_chains(list(records), chainlist)
+    pdb = _custom_pdb_dict(fname, records, input_chain_list=chains, side_chains=True)
     return pdb
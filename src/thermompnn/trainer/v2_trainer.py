@@ -3,6 +3,7 @@ import torch
 import torch.nn.functional as F
 from torch import nn
 
+from thermompnn.datasets.v2_datasets import expand_dedup_batch
 from thermompnn.model.v2_model import TransferModelv2, TransferModelv2Siamese
 from thermompnn.trainer.trainer_utils import get_metrics
 
@@ -27,12 +28,14 @@ class TransferModelPLv2(pl.LightningModule):
                 for name, metric in get_metrics(False, False).items():
                     self.metrics[split][out][name] = metric
 
-    def forward(self, *args):
-        return self.model(*args)
+    def forward(self, *args, **kwargs):
+        return self.model(*args, **kwargs)
 
     def shared_eval(self, batch, batch_idx, prefix):
 
         if self.cfg.model.subtract_mut and ('double' in self.cfg.data.mut_types):
+            if len(batch) > 12:  # the reverse pass needs mutation-specific sequences, so undo the deduplication
+                batch = expand_dedup_batch(batch)
             # do std fwd pass
             X, S, mask, lengths, chain_M, chain_encoding_all, residue_idx, mut_positions, mut_wildtype_AAs, mut_mutant_AAs, mut_ddGs, atom_mask = batch
             fwd_preds, _ = self(X, S, mask, chain_M, residue_idx, chain_encoding_all, mut_positions,
@@ -42,9 +45,12 @@ class TransferModelPLv2(pl.LightningModule):
                                    mut_positions, mut_mutant_AAs, mut_wildtype_AAs, mut_ddGs, atom_mask)
             preds = fwd_preds - backwd_preds
         else:
-            X, S, mask, lengths, chain_M, chain_encoding_all, residue_idx, mut_positions, mut_wildtype_AAs, mut_mutant_AAs, mut_ddGs, atom_mask = batch
+            struct_idx = batch[12] if len(batch) > 12 else None  # set by tied_featurize_mut_dedup
+            embeddings = batch[13] if len(batch) > 13 else None  # set by EmbeddingCache.featurize
+            X, S, mask, lengths, chain_M, chain_encoding_all, residue_idx, mut_positions, mut_wildtype_AAs, mut_mutant_AAs, mut_ddGs, atom_mask = batch[:12]
             preds, _ = self(X, S, mask, chain_M, residue_idx, chain_encoding_all, mut_positions,
-                            mut_wildtype_AAs, mut_mutant_AAs, mut_ddGs, atom_mask)
+                            mut_wildtype_AAs, mut_mutant_AAs, mut_ddGs, atom_mask, struct_idx=struct_idx,
+                            embeddings=embeddings)
             mse = F.mse_loss(preds, mut_ddGs)
 
         for out in self.out:
@@ -138,15 +144,18 @@ class TransferModelPLv2Siamese(pl.LightningModule):
                 for name, metric in get_metrics(False, sym).items():
                     self.metrics[split][out][name] = metric
 
-    def forward(self, *args):
-        return self.model(*args)
+    def forward(self, *args, **kwargs):
+        return self.model(*args, **kwargs)
 
     def shared_eval(self, batch, batch_idx, prefix):
 
-        X, S, mask, lengths, chain_M, chain_encoding_all, residue_idx, mut_positions, mut_wildtype_AAs, mut_mutant_AAs, mut_ddGs, atom_mask = batch
+        struct_idx = batch[12] if len(batch) > 12 else None  # set by tied_featurize_mut_dedup
+        embeddings = batch[13] if len(batch) > 13 else None  # set by EmbeddingCache.featurize
+        X, S, mask, lengths, chain_M, chain_encoding_all, residue_idx, mut_positions, mut_wildtype_AAs, mut_mutant_AAs, mut_ddGs, atom_mask = batch[:12]
         # siamese net gives 2x ddGs that should match (one for each ordering)
         pred_ddG_A, pred_ddG_B = self(X, S, mask, chain_M, residue_idx, chain_encoding_all,
-                                      mut_positions, mut_wildtype_AAs, mut_mutant_AAs, mut_ddGs, atom_mask)
+                                      mut_positions, mut_wildtype_AAs, mut_mutant_AAs, mut_ddGs, atom_mask,
+                                      struct_idx=struct_idx, embeddings=embeddings)
 
         # symmetric loss function
         pred_ddG_avg = (pred_ddG_A + pred_ddG_B) / 2.
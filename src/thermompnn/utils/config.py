@@ -0,0 +1,54 @@
+def parse_cfg(cfg):
+    """
+    Parse configuration scheme and set default arguments as needed
+    """
+    cfg.project = cfg.get('project', None)
+    cfg.name = cfg.get('name', 'test')
+
+    # data config
+    cfg.data = cfg.get('data', {})
+    cfg.data.mut_types = cfg.data.get('mut_types', ['single'])
+    cfg.data.splits = cfg.data.get('splits', ['train', 'val'])
+    cfg.data.side_chains = cfg.data.get('side_chains', False)
+    cfg.data.refresh_every = cfg.data.get('refresh_every', 0)
+    cfg.data.weight = cfg.data.get('weight', False)
+    cfg.data.range = cfg.data.get('range', None)
+
+    # training config
+    cfg.training = cfg.get('training', {})
+    cfg.training.num_workers = cfg.training.get('num_workers', 0)
+    cfg.training.batch_size = cfg.training.get('batch_size', 256)
+    cfg.training.epochs = cfg.training.get('epochs', 100)
+    cfg.training.batch_fraction = cfg.training.get('batch_fraction', 1.0)
+    cfg.training.shuffle = cfg.training.get('shuffle', True)
+    cfg.training.dedup_structures = cfg.training.get('dedup_structures', False)
+    cfg.training.embedding_cache = cfg.training.get('embedding_cache', None)
+
+    cfg.training.learn_rate = cfg.training.get('learn_rate', 0.0001)
+    cfg.training.mpnn_learn_rate = cfg.training.get('mpnn_learn_rate', None)
+    cfg.training.lr_schedule = cfg.training.get('lr_schedule', True)
+
+    # model config
+    cfg.model = cfg.get('model', {})
+    cfg.model.hidden_dims = cfg.model.get('hidden_dims', [64, 32])
+    cfg.model.subtract_mut = cfg.model.get('subtract_mut', True)
+    cfg.model.single_target = cfg.model.get('single_target', False)
+    cfg.model.num_final_layers = cfg.model.get('num_final_layers', 2)
+    cfg.model.freeze_weights = cfg.model.get('freeze_weights', True)
+    cfg.model.load_pretrained = cfg.model.get('load_pretrained', True)
+    cfg.model.lightattn = cfg.model.get('lightattn', True)
+    cfg.model.mutant_embedding = cfg.model.get('mutant_embedding', False)
+    cfg.model.alpha = cfg.model.get('alpha', 1.0)
+    cfg.model.beta = cfg.model.get('beta', 1.0)
+
+    # double mutant model options
+    cfg.model.dist = cfg.model.get('dist', False)
+    cfg.model.edges = cfg.model.get('edges', False)
+    cfg.model.aggregation = cfg.model.get('aggregation', None)
+    cfg.model.dropout = cfg.model.get('dropout', None)
+
+    # side chain model options
+    cfg.model.side_chain_module = cfg.model.get('side_chain_module', False)
+    cfg.model.action_centers = cfg.model.get('action_centers', None)
+
+    return cfg
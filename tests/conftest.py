@@ -0,0 +1,36 @@
+import os
+
+import pytest
+import torch
+
+from thermompnn.ssm_utils import _model_class, get_config
+
+PDB_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "examples", "pdbs")
+
+
+def random_model(mode, seed=0):
+    """Config and model of a mode with random weights, without any checkpoint or ProteinMPNN weight download"""
+    cfg = get_config(mode)
+    cfg.model.load_pretrained = False
+    cfg.model.k_neighbors = 48
+    torch.manual_seed(seed)
+    model = _model_class(mode)(cfg).eval()
+    with torch.no_grad():
+        for p in model.parameters():  # keep nothing trivially zero
+            p.add_(torch.randn_like(p) * 0.05)
+    return cfg, model
+
+
+@pytest.fixture(scope="session")
+def single_model():
+    return random_model("single")
+
+
+@pytest.fixture(scope="session")
+def epistatic_model():
+    return random_model("epistatic")
+
+
+@pytest.fixture
+def pdb_path():
+    return lambda name: os.path.join(PDB_DIR, f"{name}.pdb")
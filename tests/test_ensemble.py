@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from thermompnn.model.v2_model import ModelEnsemble
+from thermompnn.run import ThermoMPNN
+
+from conftest import random_model
+
+
+def _run(model, pdb, mode):
+    runner = ThermoMPNN(pdb, mode=mode, threshold=100.0, distance=8.0, device="cpu")
+    runner.cfg, runner.model = model
+    return runner.process(save_csv=False).set_index("Mutation")
+
+
+@pytest.mark.parametrize("mode", ["single", "epistatic"])
+def test_ensemble_matches_members(mode, pdb_path):
+    """The vmapped ensemble reports the mean and standard deviation of its members run one by one"""
+    family = "epistatic" if mode == "epistatic" else "single"
+    (cfg, first), (_, second) = random_model(family, seed=0), random_model(family, seed=1)
+    second.prot_mpnn.load_state_dict(first.prot_mpnn.state_dict())  # members share ProteinMPNN
+    members = [_run((cfg, model), pdb_path("1VII"), mode)["ddG (kcal/mol)"] for model in (first, second)]
+    ensemble = _run((cfg, ModelEnsemble([first, second])), pdb_path("1VII"), mode)
+
+    ddg = np.stack([m.loc[ensemble.index].to_numpy() for m in members])
+    assert len(ensemble) == len(members[0]) == len(members[1]) > 0
+    assert ddg.std(0).max() > 0.01  # the members differ
+    np.testing.assert_allclose(ensemble["ddG (kcal/mol)"], ddg.mean(0), rtol=0, atol=1e-5)
+    np.testing.assert_allclose(ensemble["ddG std (kcal/mol)"], ddg.std(0), rtol=0, atol=1e-5)
@@ -0,0 +1,28 @@
+import numpy as np
+import torch
+
+from thermompnn.run import (embed_ssm_structure, get_ssm_pairs_double,
+                            iter_ssm_mutations_double, run_double,
+                            run_double_factorized)
+from thermompnn.ssm_utils import load_pdb
+
+
+def test_factorized_matches_row_wise(epistatic_model, pdb_path):
+    cfg, model = epistatic_model
+    pdb = load_pdb(pdb_path("1VII"), None)
+    X, mask, all_mpnn_hid, mpnn_embed, mpnn_edges, E_idx, _ = embed_ssm_structure(pdb, model, device="cpu")
+
+    loader = iter_ssm_mutations_double(pdb, 8.0, batch_size=512)
+    with torch.no_grad():
+        rows = run_double(all_mpnn_hid, mpnn_embed, cfg, loader, 512, model, X, mask, mpnn_edges, device="cpu")
+
+    pairs, pair_wt = get_ssm_pairs_double(pdb, 8.0)
+    grid = run_double_factorized(all_mpnn_hid, mpnn_embed, cfg, pairs, 512, model, X, mask, mpnn_edges, E_idx)
+    assert grid.shape == (pairs.shape[0], 20, 20)
+
+    # rows are in (pair, mutant 1, mutant 2) order without self-mutations
+    aa = np.arange(20)
+    pair_wt = pair_wt.numpy()
+    valid = (aa[None, :, None] != pair_wt[:, 0, None, None]) & (aa[None, None, :] != pair_wt[:, 1, None, None])
+    assert len(rows) == valid.sum() > 0
+    np.testing.assert_allclose(grid.numpy()[valid], rows, rtol=0, atol=1e-4)
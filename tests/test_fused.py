@@ -0,0 +1,35 @@
+import os
+from types import SimpleNamespace
+
+import torch
+from omegaconf import OmegaConf
+
+from thermompnn import ssm_utils
+from thermompnn.ssm_utils import _checkpoint_stamp, _write_fused, checkpoint_name, get_model
+
+from conftest import random_model
+
+
+def _save_checkpoint(model, path):
+    torch.save({"state_dict": {f"model.{k}": v for k, v in model.state_dict().items()}}, path)
+
+
+def _same_weights(a, b):
+    return all(torch.equal(a.state_dict()[k], v) for k, v in b.state_dict().items())
+
+
+def test_stale_fused_falls_back_to_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setattr(ssm_utils, "thermompnn_weigths", SimpleNamespace(setup=lambda: str(tmp_path)))
+    cfg, exported = random_model("single", seed=0)
+    name = checkpoint_name("single", 1)
+    ckpt = os.path.join(tmp_path, name + ".ckpt")
+    _save_checkpoint(exported, ckpt)
+    _write_fused(os.path.join(tmp_path, name + ssm_utils.FUSED_SUFFIX), exported.state_dict(),
+                 OmegaConf.to_container(cfg), _checkpoint_stamp(ckpt))
+    assert _same_weights(get_model("single", cfg), exported)
+
+    _, updated = random_model("single", seed=1)
+    _save_checkpoint(updated, ckpt)
+    stat = os.stat(ckpt)
+    os.utime(ckpt, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))  # coarse filesystem timestamps
+    assert _same_weights(get_model("single", cfg), updated)
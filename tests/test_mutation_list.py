@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from thermompnn.run import ThermoMPNN, parse_mutation_list
+from thermompnn.ssm_utils import load_pdb
+
+
+def _run(model, pdb, mode, mutations=None):
+    runner = ThermoMPNN(pdb, mode=mode, threshold=100.0, distance=8.0, device="cpu", mutations=mutations)
+    runner.cfg, runner.model = model
+    return runner.process(save_csv=False)
+
+
+@pytest.mark.parametrize("mode", ["single", "additive", "epistatic"])
+def test_mutation_list_matches_ssm(mode, single_model, epistatic_model, pdb_path):
+    """Scoring a list of variants gives the ddGs of the same mutations in a full scan"""
+    model = epistatic_model if mode == "epistatic" else single_model
+    full = _run(model, pdb_path("1VII"), mode).set_index("Mutation")
+    names = list(np.random.default_rng(0).choice(full.index, 25, replace=False))
+
+    scored = _run(model, pdb_path("1VII"), mode, names)
+    assert scored["Mutation"].tolist() == names
+    np.testing.assert_allclose(scored["ddG (kcal/mol)"], full.loc[names, "ddG (kcal/mol)"], rtol=0, atol=1e-5)
+
+
+@pytest.mark.parametrize("name", ["LA2", "LA2C:LA99C", "AA2C", "LA2C:LA2D"])
+def test_invalid_mutation_names(name, pdb_path):
+    """Malformed names, residues missing from the PDB, wrong wildtypes and residues mutated twice are rejected"""
+    pdb = load_pdb(pdb_path("1VII"), None)
+    assert parse_mutation_list(pdb, ["LA2C"])[0].tolist() == [[1, 9, 1]]
+    with pytest.raises(ValueError):
+        parse_mutation_list(pdb, [name])
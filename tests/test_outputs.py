@@ -0,0 +1,90 @@
+import os
+
+import numpy as np
+import pytest
+
+from thermompnn import run
+from thermompnn.run import ThermoMPNN
+from thermompnn.sinks import ALPHABET, load_ssm_arrays, read_ssm_table
+
+AA = np.array(list(ALPHABET), dtype=object)
+
+
+def _runner(models, pdb, mode, out, **kwargs):
+    runner = ThermoMPNN(pdb, out=str(out), mode=mode, distance=8.0, device="cpu", **kwargs)
+    runner.cfg, runner.model = models["epistatic" if mode == "epistatic" else "single"]
+    return runner
+
+
+@pytest.fixture
+def models(single_model, epistatic_model):
+    return {"single": single_model, "epistatic": epistatic_model}
+
+
+@pytest.mark.parametrize("mode", ["single", "additive", "epistatic"])
+def test_empty_csv_is_an_error(mode, models, pdb_path, tmp_path):
+    """Every mode raises when nothing passes the filters, and leaves no (temporary) output behind"""
+    runner = _runner(models, pdb_path("1VII"), mode, tmp_path / "ssm", threshold=-1e6)
+    with pytest.raises(ValueError, match="No valid mutations"):
+        runner.stream()
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("output_format", ["csv", "parquet", "arrow", "npy"])
+def test_failed_stream_leaves_no_output(output_format, models, pdb_path, tmp_path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("scoring failed")
+
+    monkeypatch.setattr(run, "single_mutation_rows", fail)  # fails inside the sink, after it created its output
+    runner = _runner(models, pdb_path("1VII"), "single", tmp_path / "ssm", output_format=output_format)
+    with pytest.raises(RuntimeError, match="scoring failed"):
+        runner.stream()
+    assert os.listdir(tmp_path) == []
+
+
+def _strings(column):
+    return column.to_numpy(str).astype(object)
+
+
+def _table_rows(path):
+    """Mutation names, ddGs and distances (None for single mutants) of a Parquet or Arrow output file"""
+    df = read_ssm_table(path)
+    residues = np.array(df.attrs["thermompnn"]["residues"], dtype=object)
+    suffixes = [""] if "pos" in df else ["1", "2"]
+    names = [_strings(df[f"wt{s}"]) + residues[df[f"pos{s}"]] + _strings(df[f"mut{s}"]) for s in suffixes]
+    names = names[0] if len(names) == 1 else names[0] + ":" + names[1]
+    return names, df["ddg"].to_numpy(), df["distance"].to_numpy() if "distance" in df else None
+
+
+def _array_rows(path):
+    """Mutation names and ddGs of an npy output directory"""
+    arrays, table = load_ssm_arrays(path)
+    residues = np.array(table["residues"], dtype=object)
+    seq = np.array(list(table["sequence"]), dtype=object)
+    if arrays["ddg"].ndim == 2:  # dense single mutant matrix
+        pos, aa = np.nonzero(np.isfinite(arrays["ddg"]))
+        return seq[pos] + residues[pos] + AA[aa], arrays["ddg"][pos, aa]
+    first = seq[arrays["pos1"]] + residues[arrays["pos1"]] + AA[arrays["aa1"]]
+    second = seq[arrays["pos2"]] + residues[arrays["pos2"]] + AA[arrays["aa2"]]
+    return first + ":" + second, np.asarray(arrays["ddg"])
+
+
+@pytest.mark.parametrize("mode", ["single", "additive", "epistatic"])
+def test_outputs_round_trip(mode, models, pdb_path, tmp_path):
+    """Parquet, Arrow and npy outputs read back to the mutations and ddGs of process"""
+    expected = _runner(models, pdb_path("1VII"), mode, tmp_path / "csv", threshold=100.0).process(save_csv=False)
+    expected = expected.set_index("Mutation")
+
+    for output_format in ("parquet", "arrow", "npy"):
+        path = _runner(models, pdb_path("1VII"), mode, tmp_path / output_format, threshold=100.0,
+                       output_format=output_format).stream()
+        if output_format == "npy":
+            names, ddg = _array_rows(path)
+            dist = None
+        else:
+            names, ddg, dist = _table_rows(path)
+        assert len(names) == len(set(names)) == len(expected)
+        rows = expected.loc[list(names)]
+        np.testing.assert_allclose(ddg, rows["ddG (kcal/mol)"], rtol=1e-6)
+        if dist is not None:
+            np.testing.assert_allclose(dist, rows["CA-CA Distance"], atol=0.0051)
@@ -0,0 +1,31 @@
+import pandas as pd
+import pytest
+
+from thermompnn.run import ThermoMPNN
+
+POSITIONS = ["A40-44", "A60"]
+LABELS = {"A40", "A41", "A42", "A43", "A44", "A60"}
+
+
+def _run(model, pdb, mode, positions=None):
+    runner = ThermoMPNN(pdb, mode=mode, threshold=100.0, distance=5.0, device="cpu", positions=positions)
+    runner.cfg, runner.model = model
+    return runner.process(save_csv=False)
+
+
+@pytest.mark.parametrize("mode", ["single", "epistatic"])
+def test_positions_match_full_run(mode, single_model, epistatic_model, pdb_path):
+    """Runs on the receptive field of some positions give the same predictions as a full-structure run"""
+    model = epistatic_model if mode == "epistatic" else single_model
+    full = _run(model, pdb_path("1igy"), mode)
+    cropped = _run(model, pdb_path("1igy"), mode, POSITIONS)
+
+    # residue labels of the mutations, e.g. TA40A:LA41C -> {A40, A41}
+    labels = full["Mutation"].str.split(":").apply(lambda muts: {m[1:-1] for m in muts})
+    expected = full[labels.apply(LABELS.issuperset)]
+    assert len(cropped) == len(expected) > 0
+
+    merged = expected.merge(cropped, on="Mutation", suffixes=("_full", "_cropped"))
+    assert len(merged) == len(expected)
+    pd.testing.assert_series_equal(merged["ddG (kcal/mol)_full"], merged["ddG (kcal/mol)_cropped"],
+                                   check_names=False, rtol=0, atol=1e-5)
@@ -0,0 +1,43 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pytest
+
+from thermompnn.run import ThermoMPNN
+from thermompnn.server import SSMServer, request_ssm
+
+REQUESTS = [("1VII", "single"), ("1VII", "additive"), ("1VII", "single"), ("4ajy", "single"), ("1VII", "epistatic")]
+
+
+def test_server_coalesces_requests(single_model, epistatic_model, pdb_path):
+    models = {"single": single_model, "epistatic": epistatic_model}
+    server = SSMServer(device="cpu", max_residues=4096, max_wait=1.0)
+    for family, (cfg, model) in models.items():
+        server.runners[family].cfg, server.runners[family].model = cfg, model
+    http_server = server.serve(port=0)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    address = f"127.0.0.1:{http_server.server_address[1]}"
+
+    def request(item):
+        name, mode = item
+        return request_ssm(address, pdb_path(name), mode=mode, threshold=100.0, distance=8.0, timeout=300)
+
+    try:
+        with ThreadPoolExecutor(len(REQUESTS)) as pool:
+            results = list(pool.map(request, REQUESTS))
+        stats = server.stats()
+        with pytest.raises(RuntimeError, match="No valid mutations"):  # like ThermoMPNN.process
+            request_ssm(address, pdb_path("1VII"), mode="additive", threshold=-1e6, timeout=300)
+    finally:
+        server.close()
+
+    for (name, mode), df in zip(REQUESTS, results):
+        runner = ThermoMPNN(pdb_path(name), mode=mode, threshold=100.0, distance=8.0, device="cpu")
+        runner.cfg, runner.model = models["epistatic" if mode == "epistatic" else "single"]
+        expected = runner.process(save_csv=False)
+        assert len(df) > 0
+        pd.testing.assert_frame_equal(df, expected, check_dtype=False, rtol=1e-6)
+
+    assert stats["requests"] == len(REQUESTS) and stats["errors"] == 0
+    assert stats["mean_batch_size"] > 1
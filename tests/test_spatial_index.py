@@ -0,0 +1,15 @@
+import numpy as np
+
+from thermompnn.ssm_utils import load_pdb, residue_labels, spatial_index
+
+
+def test_distances_use_parsed_coordinates(pdb_path):
+    pdb = load_pdb(pdb_path("4dch"), None)
+    index = spatial_index(pdb)
+    for coords in (index.ca, index.sg):  # PDB coordinates have 3 decimals, float32 copies do not round back
+        coords = coords[np.isfinite(coords).all(-1)]
+        assert coords.dtype == np.float64 and np.array_equal(coords, np.round(coords, 3))
+
+    labels = list(residue_labels(pdb))
+    pair = np.array([[labels.index("A320"), labels.index("A321")]])
+    assert np.round(index.distances(pair), 2)[0] == 3.80  # 3.7950007 parsed, 3.7949998 from float32